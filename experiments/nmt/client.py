@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Load test client of server.py: sends the lines of a file from several
+concurrent connections and reports the throughput and the latencies.
+
+    python client.py --port 8765 --connections 32 test.src > test.trans
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import numpy
+
+async def connect(args):
+    if args.socket:
+        return await asyncio.open_unix_connection(args.socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+async def request(reader, writer, message):
+    writer.write((json.dumps(message) + "\n").encode('utf-8'))
+    await writer.drain()
+    return json.loads((await reader.readline()).decode('utf-8'))
+
+async def run(args, lines):
+    results = [None] * len(lines)
+    latencies = []
+    next_line = iter(range(len(lines)))
+
+    async def worker():
+        reader, writer = await connect(args)
+        for i in next_line:
+            start = time.time()
+            results[i] = await request(reader, writer, dict(source=lines[i]))
+            latencies.append(time.time() - start)
+        writer.close()
+
+    start = time.time()
+    await asyncio.gather(*[worker() for _ in range(args.connections)])
+    elapsed = time.time() - start
+
+    reader, writer = await connect(args)
+    server_stats = await request(reader, writer, dict(stats=True))
+    writer.close()
+    return results, numpy.array(latencies), elapsed, server_stats
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Send the sentences of a file to a translation server")
+    parser.add_argument("--host",
+            default="127.0.0.1", help="Address of the server")
+    parser.add_argument("--port",
+            type=int, default=8765, help="Port of the server")
+    parser.add_argument("--socket",
+            help="Unix socket of the server instead of a port")
+    parser.add_argument("--connections",
+            type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("source",
+            help="File of source sentences")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    with open(args.source) as src:
+        lines = [line.strip() for line in src]
+
+    results, latencies, elapsed, server_stats = asyncio.run(run(args, lines))
+    for result in results:
+        print(result.get('translation', ''))
+
+    print("{} sentences in {:.2f}s, {:.2f} sentences/s".format(
+        len(lines), elapsed, len(lines) / elapsed), file=sys.stderr)
+    if len(latencies):
+        print("Latency: mean {:.3f}s, p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s".format(
+            latencies.mean(), *numpy.percentile(latencies, [50, 90, 99])), file=sys.stderr)
+    print("Server: {}".format(json.dumps(server_stats, sort_keys=True)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -23,9 +23,10 @@ from groundhog.layers import\
         DropOp,\
         Concatenate
 from groundhog.models import LM_Model
-from groundhog.datasets import PytablesBitextIterator
+from groundhog.datasets import PytablesBitextIterator, PytablesBitextLoader
 from groundhog.utils import sample_zeros, sample_weights_orth, init_bias, sample_weights_classic
 import groundhog.utils as utils
+from groundhog.utils.function_cache import compile_function
 
 logger = logging.getLogger(__name__)
 
@@ -55,70 +56,34 @@ def create_padded_batch(state, x, y, return_dict=False):
 
     mx = state['seqlen']
     my = state['seqlen']
+    x_lens = numpy.array([len(xx) for xx in x[0]], dtype='int64')
+    y_lens = numpy.array([len(yy) for yy in y[0]], dtype='int64')
     if state['trim_batches']:
         # Similar length for all source sequences
-        mx = numpy.minimum(state['seqlen'], max([len(xx) for xx in x[0]]))+1
+        mx = numpy.minimum(state['seqlen'], x_lens.max())+1
         # Similar length for all target sequences
-        my = numpy.minimum(state['seqlen'], max([len(xx) for xx in y[0]]))+1
+        my = numpy.minimum(state['seqlen'], y_lens.max())+1
 
-    # Batch size
-    n = x[0].shape[0]
-
-    X = numpy.zeros((mx, n), dtype='int64')
-    Y = numpy.zeros((my, n), dtype='int64')
-    Xmask = numpy.zeros((mx, n), dtype='float32')
-    Ymask = numpy.zeros((my, n), dtype='float32')
-
-    # Fill X and Xmask
-    for idx in range(len(x[0])):
-        # Insert sequence idx in a column of matrix X
-        if mx < len(x[0][idx]):
-            X[:mx, idx] = x[0][idx][:mx]
-        else:
-            X[:len(x[0][idx]), idx] = x[0][idx][:mx]
-
-        # Mark the end of phrase
-        if len(x[0][idx]) < mx:
-            X[len(x[0][idx]):, idx] = state['null_sym_source']
-
-        # Initialize Xmask column with ones in all positions that
-        # were just set in X
-        Xmask[:len(x[0][idx]), idx] = 1.
-        if len(x[0][idx]) < mx:
-            Xmask[len(x[0][idx]), idx] = 1.
-
-    # Fill Y and Ymask in the same way as X and Xmask in the previous loop
-    for idx in range(len(y[0])):
-        Y[:len(y[0][idx]), idx] = y[0][idx][:my]
-        if len(y[0][idx]) < my:
-            Y[len(y[0][idx]):, idx] = state['null_sym_target']
-        Ymask[:len(y[0][idx]), idx] = 1.
-        if len(y[0][idx]) < my:
-            Ymask[len(y[0][idx]), idx] = 1.
-
-    null_inputs = numpy.zeros(X.shape[1])
+    X, Xmask = _pad_sequences(x[0], x_lens, mx, state['null_sym_source'])
+    Y, Ymask = _pad_sequences(y[0], y_lens, my, state['null_sym_target'])
 
     # We say that an input pair is valid if both:
     # - either source sequence or target sequence is non-empty
     # - source sequence and target sequence have null_sym ending
     # Why did not we filter them earlier?
-    for idx in range(X.shape[1]):
-        if numpy.sum(Xmask[:,idx]) == 0 and numpy.sum(Ymask[:,idx]) == 0:
-            null_inputs[idx] = 1
-        if Xmask[-1,idx] and X[-1,idx] != state['null_sym_source']:
-            null_inputs[idx] = 1
-        if Ymask[-1,idx] and Y[-1,idx] != state['null_sym_target']:
-            null_inputs[idx] = 1
-
-    valid_inputs = 1. - null_inputs
+    null_inputs = (Xmask.sum(axis=0) == 0) & (Ymask.sum(axis=0) == 0)
+    null_inputs |= (Xmask[-1] > 0) & (X[-1] != state['null_sym_source'])
+    null_inputs |= (Ymask[-1] > 0) & (Y[-1] != state['null_sym_target'])
 
     # Leave only valid inputs
-    X = X[:,valid_inputs.nonzero()[0]]
-    Y = Y[:,valid_inputs.nonzero()[0]]
-    Xmask = Xmask[:,valid_inputs.nonzero()[0]]
-    Ymask = Ymask[:,valid_inputs.nonzero()[0]]
-    if len(valid_inputs.nonzero()[0]) <= 0:
+    valid = (~null_inputs).nonzero()[0]
+    if len(valid) <= 0:
         return None
+    if len(valid) < X.shape[1]:
+        X = X[:, valid]
+        Y = Y[:, valid]
+        Xmask = Xmask[:, valid]
+        Ymask = Ymask[:, valid]
 
     # Unknown words
     X[X >= state['n_sym_source']] = state['unk_sym_source']
@@ -129,8 +94,46 @@ def create_padded_batch(state, x, y, return_dict=False):
     else:
         return X, Xmask, Y, Ymask
 
+def _pad_sequences(seqs, lens, max_len, null_sym):
+    """The (max_len, n) matrices of words and mask of the sequences `seqs`
+    of lengths `lens`, each in a column. The sequences are cut at
+    max_len words, shorter ones are padded with `null_sym` and their mask
+    also covers the first padding position"""
+    n = len(lens)
+    X = numpy.empty((max_len, n), dtype='int64')
+    X.fill(null_sym)
+    if lens.sum():
+        # the position and column of every word of the concatenated sequences
+        words = numpy.concatenate([seq for seq in seqs if len(seq)])
+        starts = numpy.cumsum(lens) - lens
+        positions = numpy.arange(len(words)) - numpy.repeat(starts, lens)
+        columns = numpy.repeat(numpy.arange(n), lens)
+        kept = positions < max_len
+        X[positions[kept], columns[kept]] = words[kept]
+    Xmask = (numpy.arange(max_len)[:, None] <
+            numpy.minimum(lens + 1, max_len)[None, :]).astype('float32')
+    return X, Xmask
+
 def get_batch_iterator(state):
 
+    if state['loader_workers'] > 0:
+        # the batches are read and padded in other processes
+        return PytablesBitextLoader(
+            batch_size=int(state['bs']),
+            target_file=state['target'][0],
+            source_file=state['source'][0],
+            can_fit=False,
+            output_format=lambda x, y: create_padded_batch(state, x, y, return_dict=True),
+            sort_k_batches=1 if state['bucket_width'] else state['sort_k_batches'],
+            n_workers=state['loader_workers'],
+            ring_size=state['loader_ring_size'],
+            shuffle=state['shuffle'],
+            use_infinite_loop=state['use_infinite_loop'],
+            max_len=state['seqlen'],
+            bucket_width=state['bucket_width'],
+            deterministic=state['loader_deterministic'],
+            seed=state['seed'])
+
     class Iterator(PytablesBitextIterator):
 
         def __init__(self, *args, **kwargs):
@@ -140,13 +143,14 @@ def get_batch_iterator(state):
 
         def get_homogenous_batch_iter(self):
             while True:
-                k_batches = state['sort_k_batches']
+                # the batches of the buckets are already homogenous
+                k_batches = 1 if state['bucket_width'] else state['sort_k_batches']
                 batch_size = state['bs']
-                data = [PytablesBitextIterator.next(self) for k in range(k_batches)]
+                data = [PytablesBitextIterator.__next__(self) for k in range(k_batches)]
                 x = numpy.asarray(list(itertools.chain(*list(map(operator.itemgetter(0), data)))))
                 y = numpy.asarray(list(itertools.chain(*list(map(operator.itemgetter(1), data)))))
                 lens = numpy.asarray([list(map(len, x)), list(map(len, y))])
-                order = numpy.argsort(lens.max(axis=0)) if state['sort_k_batches'] > 1 \
+                order = numpy.argsort(lens.max(axis=0)) if k_batches > 1 \
                         else numpy.arange(len(x))
                 for k in range(k_batches):
                     indices = order[k * batch_size:(k + 1) * batch_size]
@@ -174,6 +178,9 @@ def get_batch_iterator(state):
                 self.peeked_batch = batch
             return batch
 
+        def __next__(self):
+            return self.next()
+
     train_data = Iterator(
         batch_size=int(state['bs']),
         target_file=state['target'][0],
@@ -182,7 +189,9 @@ def get_batch_iterator(state):
         queue_size=1000,
         shuffle=state['shuffle'],
         use_infinite_loop=state['use_infinite_loop'],
-        max_len=state['seqlen'])
+        max_len=state['seqlen'],
+        bucket_width=state['bucket_width'],
+        seed=state['seed'])
     return train_data
 
 class RecurrentLayerWithSearch(Layer):
@@ -660,24 +669,55 @@ class RecurrentLayerWithSearch(Layer):
             the bias as well
         """
 
-        updater_below = gater_below
+        # the attention only looks at the previous hidden state, the
+        # current input is consumed by the transition
+        ctx, probs, coverage = self.attention_step(state_before, c,
+                c_mask=c_mask,
+                p_from_c=p_from_c,
+                coverage_before=coverage_before,
+                given_cov_state_below=given_cov_state_below,
+                given_cov_gater_below=given_cov_gater_below,
+                given_cov_reseter_below=given_cov_reseter_below,
+                fertility=fertility)
+
+        h = self.transition_step(state_below, state_before, ctx,
+                previous_word=previous_word,
+                gater_below=gater_below,
+                reseter_below=reseter_below,
+                mask=mask)
 
-        W_hh = self.W_hh
-        G_hh = self.G_hh
-        R_hh = self.R_hh
+        # h is the prior result from scan, which is provided to fn in scan
+        results = [h, ctx]
+        if return_alignment:
+            results += [probs]
+
+        if self.state.get('maintain_coverage', False):
+            results += [coverage]
+        
+        return results
+
+    def attention_step(self,
+                       state_before,
+                       c,
+                       c_mask=None,
+                       p_from_c=None,
+                       coverage_before=None,
+                       given_cov_state_below=None,
+                       given_cov_gater_below=None,
+                       given_cov_reseter_below=None,
+                       fertility=None):
+        """
+        Computes the attention of the hidden states `state_before` over
+        the source annotations `c`.
+
+        Returns the context vectors (target_num, c_dim), the alignment
+        probabilities (source_len, target_num) and the updated coverage
+        (None if coverage is not maintained).
+        """
         A_cp = self.A_cp
         B_hp = self.B_hp
         D_pe = self.D_pe
 
-        # added by Zhaopeng Tu, 2016-01-21
-        if self.state.get('use_context_gate', False):
-            if self.state.get('use_previous_target_word_for_context_gate', False):
-                GA_y = self.GA_y
-            if self.state.get('use_decoding_state_for_context_gate', False):
-                GA_h = self.GA_h
-            if self.state.get('use_current_context_for_context_gate', False):
-                GA_c = self.GA_c
-
         # added by Zhaopeng Tu, 2015-10-29
         if self.state.get('maintain_coverage', False):
             # for coverage
@@ -729,18 +769,56 @@ class RecurrentLayerWithSearch(Layer):
         # moved by Zhaopeng Tu, 2015-12-07
         # here we need to update coverage, as calculating ctx
         # the updated coverage would be used for decoding, if needed
+        coverage = None
         if self.state.get('maintain_coverage', False):
             coverage = self.coverage_updater(coverage_before, probs, c, cndim,
                                              state_before=state_before, 
                                              given_cov_state_below=given_cov_state_below, given_cov_gater_below=given_cov_gater_below, given_cov_reseter_below=given_cov_reseter_below,
                                              fertility=fertility)
-       
+
+        return ctx, probs, coverage
+
+    def transition_step(self,
+                        state_below,
+                        state_before,
+                        ctx,
+                        previous_word=None,
+                        gater_below=None,
+                        reseter_below=None,
+                        mask=None,
+                        previous_word_gate=None):
+        """
+        Feeds the input and the context vectors `ctx` to the gated
+        recurrent unit and returns the new hidden state.
+        `previous_word_gate`, if given, replaces the contribution of
+        `previous_word` to the context gate.
+        """
+        updater_below = gater_below
+
+        W_hh = self.W_hh
+        G_hh = self.G_hh
+        R_hh = self.R_hh
+
+        # added by Zhaopeng Tu, 2016-01-21
+        if self.state.get('use_context_gate', False):
+            if self.state.get('use_previous_target_word_for_context_gate', False):
+                GA_y = self.GA_y
+            if self.state.get('use_decoding_state_for_context_gate', False):
+                GA_h = self.GA_h
+            if self.state.get('use_current_context_for_context_gate', False):
+                GA_c = self.GA_c
+
+        target_num = state_before.shape[0]
+
         # added by Zhaopeng Tu, 2015-01-21
         # now we compute the gating factor for source and target contexts
         if self.state.get('use_context_gate', False):
             context_gate_content = TT.zeros((target_num, self.n_hids))
             if self.state.get('use_previous_target_word_for_context_gate', False):
-                context_gate_content += TT.dot(previous_word, GA_y)
+                if previous_word_gate is not None:
+                    context_gate_content += previous_word_gate
+                else:
+                    context_gate_content += TT.dot(previous_word, GA_y)
             if self.state.get('use_decoding_state_for_context_gate', False):
                 context_gate_content += TT.dot(state_before, GA_h)
             if self.state.get('use_current_context_for_context_gate', False):
@@ -791,16 +869,35 @@ class RecurrentLayerWithSearch(Layer):
                 mask = mask.dimshuffle(0,'x')
             h = mask * h + (1-mask) * state_before
         
-        # h is the prior result from scan, which is provided to fn in scan
-        results = [h, ctx]
-        if return_alignment:
-            results += [probs]
+        return h
 
-        if self.state.get('maintain_coverage', False):
-            results += [coverage]
-        
-        return results
 
+    def source_projections(self, c):
+        """
+        Projections of the annotations `c` (source_len, source_num, c_dim)
+        which do not depend on the decoder state, so they can be computed
+        once per sentence: the attention keys p_from_c and the coverage
+        input, gater and reseter biases. The coverage biases are zero
+        placeholders unless the recurrent coverage reads the annotations.
+        """
+        p_from_c =  utils.dot(c, self.A_cp).reshape(
+                (c.shape[0], c.shape[1], self.n_hids))
+
+        if self.state.get('maintain_coverage', False) and self.state.get('use_recurrent_coverage', False) and self.state.get('use_input_annotations_for_recurrent_coverage', False):
+            # this is the bias for coverege
+            cov_inputer_from_c = utils.dot(c, self.Cov_inputer_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
+            if self.state.get('use_recurrent_gating_coverage', False):
+                cov_gater_from_c = utils.dot(c, self.Cov_updater_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
+                cov_reseter_from_c = utils.dot(c, self.Cov_reseter_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
+            else:
+                cov_gater_from_c = TT.zeros(cov_inputer_from_c.shape)
+                cov_reseter_from_c = TT.zeros(cov_inputer_from_c.shape)
+        else:
+            cov_inputer_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
+            cov_gater_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
+            cov_reseter_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
+
+        return [p_from_c, cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c]
 
     def fprop(self,
               state_below,
@@ -858,22 +955,8 @@ class RecurrentLayerWithSearch(Layer):
             else:
                 init_state = TT.alloc(floatX(0), self.n_hids)
 
-        p_from_c =  utils.dot(c, self.A_cp).reshape(
-                (c.shape[0], c.shape[1], self.n_hids))
-
-        if self.state.get('maintain_coverage', False) and self.state.get('use_recurrent_coverage', False) and self.state.get('use_input_annotations_for_recurrent_coverage', False):
-            # this is the bias for coverege
-            cov_inputer_from_c = utils.dot(c, self.Cov_inputer_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
-            if self.state.get('use_recurrent_gating_coverage', False):
-                cov_gater_from_c = utils.dot(c, self.Cov_updater_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
-                cov_reseter_from_c = utils.dot(c, self.Cov_reseter_c).reshape((c.shape[0], c.shape[1], self.state['coverage_dim']))
-            else:
-                cov_gater_from_c = TT.zeros(cov_inputer_from_c.shape)
-                cov_reseter_from_c = TT.zeros(cov_inputer_from_c.shape)
-        else:
-            cov_inputer_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
-            cov_gater_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
-            cov_reseter_from_c = TT.zeros((c.shape[0], c.shape[1], 1))
+        p_from_c, cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c = \
+                self.source_projections(c)
 
         if not fertility:
             fertility = TT.zeros((c.shape[0], c.shape[1], 1))
@@ -1147,7 +1230,8 @@ class Encoder(EncoderDecoderBase):
             x_mask=None,
             use_noise=False,
             approx_embeddings=None,
-            return_hidden_layers=False):
+            return_hidden_layers=False,
+            source_tables=None):
         """Create the computational graph of the RNN Encoder
 
         :param x:
@@ -1169,7 +1253,22 @@ class Encoder(EncoderDecoderBase):
         :param return_hidden_layers:
             if True, encoder returns all the activations of the hidden layer
             (WORKS ONLY IN NON-HIERARCHICAL CASE)
+
+        :param source_tables:
+            the tables of build_source_tables, the signals of the words
+            are then their rows (WORKS ONLY IN NON-HIERARCHICAL CASE)
         """
+        if source_tables:
+            assert self.num_levels == 1
+            words = x.flatten() if x.ndim == 2 else x
+            input_signals = [source_tables['input'][words]]
+            update_signals = [source_tables['update'][words]
+                if 'update' in source_tables else 0]
+            reset_signals = [source_tables['reset'][words]
+                if 'reset' in source_tables else 0]
+            return self._build_hidden_layers(x, x_mask, use_noise,
+                    input_signals, update_signals, reset_signals,
+                    return_hidden_layers)
 
         # Low rank embeddings of all the input words.
         # Shape in case of matrix input:
@@ -1191,7 +1290,26 @@ class Encoder(EncoderDecoderBase):
             input_signals.append(self.input_embedders[level](approx_embeddings))
             update_signals.append(self.update_embedders[level](approx_embeddings))
             reset_signals.append(self.reset_embedders[level](approx_embeddings))
-
+        return self._build_hidden_layers(x, x_mask, use_noise,
+                input_signals, update_signals, reset_signals,
+                return_hidden_layers)
+
+    def build_source_tables(self, approx_embedder):
+        """The input, update and reset signals of the first level for
+        every source word embedded by `approx_embedder`, by name"""
+        words = TT.arange(self.state['n_sym_source'], dtype='int64')
+        approx_embeddings = approx_embedder(words)
+        tables = dict(input=self.input_embedders[0](approx_embeddings).out)
+        if prefix_lookup(self.state, self.prefix, 'rec_gating'):
+            tables['update'] = self.update_embedders[0](approx_embeddings).out
+        if prefix_lookup(self.state, self.prefix, 'rec_reseting'):
+            tables['reset'] = self.reset_embedders[0](approx_embeddings).out
+        return tables
+
+    def _build_hidden_layers(self, x, x_mask, use_noise,
+            input_signals, update_signals, reset_signals,
+            return_hidden_layers):
+        """The rest of build_encoder, given the signals of the words"""
         # Hidden layers.
         # Shape in case of matrix input: (max_seq_len, batch_size, dim)
         # Shape in case of vector input: (seq_len, dim)
@@ -1256,6 +1374,9 @@ class Decoder(EncoderDecoderBase):
         # self.compute_alignment = compute_alignment
         # modified by Zhaopeng Tu, 2016-02-29
         self.compute_alignment = True
+        # Shared tables of the embedders of the target words, see
+        # RNNEncoderDecoder.precompute_target_tables
+        self.target_tables = None
 
         # Actually there is a problem here -
         # we don't make difference between number of input layers
@@ -1438,7 +1559,9 @@ class Decoder(EncoderDecoderBase):
             coverage_before=None,
             # added by Zhaopeng Tu, 2015-12-17
             fertility=None,
-            T=1):
+            T=1,
+            compute_grads=True,
+            return_coverage=False):
         """Create the computational graph of the RNN Decoder.
 
         :param c:
@@ -1469,6 +1592,16 @@ class Decoder(EncoderDecoderBase):
 
         :param T:
             sampling temperature
+
+        :param compute_grads:
+            if mode == evaluation, whether the gradients of the cost are
+            computed too
+
+        :param return_coverage:
+            if mode == evaluation, the coverage after each target word
+            (max_seq_len, source_len, batch_size, coverage_dim) and the
+            fertility (source_len, batch_size) are returned after the
+            alignment, None if they are not modelled
         """
 
         # Check parameter consistency
@@ -1719,12 +1852,23 @@ class Decoder(EncoderDecoderBase):
                         state_below=readout.out,
                         temp=T).out
         elif mode == Decoder.EVALUATION:
-            return (self.output_layer.train(
-                    state_below=readout,
-                    target=y,
-                    mask=y_mask,
-                    reg=None),
-                    alignment)
+            if not compute_grads:
+                cost_layer = self.output_layer.evaluate(
+                        state_below=readout,
+                        target=y,
+                        mask=y_mask,
+                        reg=None)
+            else:
+                cost_layer = self.output_layer.train(
+                        state_below=readout,
+                        target=y,
+                        mask=y_mask,
+                        reg=None)
+            if return_coverage:
+                return (cost_layer, alignment,
+                        coverage.out if self.state['maintain_coverage'] else None,
+                        fertility)
+            return (cost_layer, alignment)
         else:
             raise Exception("Unknown mode for build_decoder")
 
@@ -1823,14 +1967,222 @@ class Decoder(EncoderDecoderBase):
         else:
             return (outputs[0], outputs[1]), updates
 
-    def build_next_probs_predictor(self, c, step_num, y, init_states, coverage_before=None, fertility=None):
-        return self.build_decoder(c, y, mode=Decoder.BEAM_SEARCH,
+    def build_next_probs_predictor(self, c, step_num, y, init_states, coverage_before=None, fertility=None, c_mask=None):
+        return self.build_decoder(c, y, c_mask=c_mask, mode=Decoder.BEAM_SEARCH,
                 given_init_states=init_states, step_num=step_num, coverage_before=coverage_before, fertility=fertility)
 
-    def build_next_states_computer(self, c, step_num, y, init_states, coverage_before=None, fertility=None):
-        return self.build_decoder(c, y, mode=Decoder.SAMPLING,
+    def build_next_states_computer(self, c, step_num, y, init_states, coverage_before=None, fertility=None, c_mask=None):
+        return self.build_decoder(c, y, c_mask=c_mask, mode=Decoder.SAMPLING,
                 given_init_states=init_states, step_num=step_num, coverage_before=coverage_before, fertility=fertility)[2:]
 
+    def build_source_projections(self, c):
+        return self.transitions[0].source_projections(c)
+
+    def build_target_tables(self):
+        """The outputs of the layers reading the embedding of the previous
+        word, for every target word, by name: 'input', 'update' and
+        'reset' signals of the transition, 'prev_readout' if `bigram` and
+        'gate_y', the input of the context gate, if it reads the word"""
+        assert self.state['search']
+        words = TT.arange(self.state['n_sym_target'], dtype='int64')
+        approx_embeddings = self.approx_embedder(words)
+        tables = dict(input=self.input_embedders[0](approx_embeddings).out,
+                update=self.update_embedders[0](approx_embeddings).out,
+                reset=self.reset_embedders[0](approx_embeddings).out)
+        if self.state['bigram']:
+            tables['prev_readout'] = self.prev_word_readout(approx_embeddings).out
+        if self.state.get('use_context_gate', False) and self.state.get('use_previous_target_word_for_context_gate', False):
+            tables['gate_y'] = TT.dot(approx_embeddings.out, self.transitions[0].GA_y)
+        return tables
+
+    def build_step_computer(self, c, step_num, y, backpointers, prev_states, prev_ctx,
+            coverage_before=None, fertility=None, c_mask=None, c_projections=None,
+            top_k=None, shortlist=None):
+        """Builds one step of beam search that runs the attention only once.
+
+        The hypotheses chosen at the previous step are the rows
+        `backpointers` of `prev_states`, `prev_ctx` and `coverage_before`
+        extended with the words `y`. They are moved forward by one
+        transition, after which the attention of the new states gives
+        both the distribution of the next word and the new coverage.
+        At the first step (step_num == 0) the transition is skipped and
+        `prev_states` are the initial states.
+        If `backpointers` is None, every hypothesis extends the one in
+        the same row.
+        `c_projections`, if given, are the outputs of
+        build_source_projections for `c`, otherwise they are recomputed.
+        If `target_tables` are set, the signals of the words `y` are
+        rows of these tables instead of products of their embeddings.
+
+        Returns the log-probabilities of the next word, the alignment,
+        the new hidden states, the new contexts and, if maintained,
+        the new coverage. If `top_k` is given, only the `top_k` best
+        log-probabilities of each hypothesis are returned, followed by
+        their word indices. If `shortlist` (a vector of target word
+        indices) is given, the softmax is computed over these words only
+        and the log-probabilities are always followed by the word indices.
+        """
+        assert self.state['search']
+        transition = self.transitions[0]
+
+        tables = self.target_tables
+        if tables:
+            input_signal = tables['input'][y]
+            update_signal = tables['update'][y]
+            reset_signal = tables['reset'][y]
+            previous_word = None
+            previous_word_gate = tables['gate_y'][y] if 'gate_y' in tables else None
+        else:
+            approx_embeddings = self.approx_embedder(y)
+            input_signal = transition.tensor_from_layer(
+                    self.input_embedders[0](approx_embeddings), False)
+            update_signal = transition.tensor_from_layer(
+                    none_if_zero(self.update_embedders[0](approx_embeddings)), False)
+            reset_signal = transition.tensor_from_layer(
+                    none_if_zero(self.reset_embedders[0](approx_embeddings)), False)
+            previous_word = approx_embeddings.out
+            previous_word_gate = None
+
+        if backpointers is None:
+            state_before = prev_states[0]
+        else:
+            state_before = prev_states[0][backpointers]
+            prev_ctx = prev_ctx[backpointers]
+            if self.state['maintain_coverage']:
+                coverage_before = coverage_before[:, backpointers]
+        h = transition.transition_step(input_signal, state_before, prev_ctx,
+                previous_word=previous_word,
+                gater_below=update_signal,
+                reseter_below=reset_signal,
+                previous_word_gate=previous_word_gate)
+        h = ifelse(TT.gt(step_num, 0), h, state_before)
+
+        attention_kwargs = dict(c_mask=c_mask)
+        if c_projections:
+            p_from_c, cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c = c_projections
+            attention_kwargs.update(p_from_c=p_from_c,
+                    given_cov_state_below=cov_inputer_from_c,
+                    given_cov_gater_below=cov_gater_from_c,
+                    given_cov_reseter_below=cov_reseter_from_c)
+        if self.state['maintain_coverage']:
+            attention_kwargs['coverage_before'] = coverage_before
+            if self.state['use_linguistic_coverage'] and self.state['use_fertility_model']:
+                attention_kwargs['fertility'] = fertility
+        ctx, alignment, coverage = transition.attention_step(h, c, **attention_kwargs)
+
+        # the same readout as build_decoder in BEAM_SEARCH mode
+        readout = self.repr_readout(ctx)
+        readout += self.hidden_readouts[0](h[:, :self.state['dim']])
+        if self.state['bigram']:
+            check_first_word = (y > 0
+                if self.state['check_first_word']
+                else TT.ones((y.shape[0]), dtype="float32"))
+            prev_word_readout = (tables['prev_readout'][y]
+                if tables
+                else self.prev_word_readout(approx_embeddings).out)
+            readout += TT.shape_padright(check_first_word) * prev_word_readout
+        for fun in self.output_nonlinearities:
+            readout = fun(readout)
+        if shortlist:
+            output = self.output_layer(state_below=readout.out, temp=1, columns=shortlist)
+        else:
+            output = self.output_layer(state_below=readout.out, temp=1)
+        if hasattr(output, 'preactiv'):
+            log_probs = utils.log_softmax(output.preactiv)
+        else:
+            log_probs = TT.log(output.out)
+
+        if top_k:
+            log_probs, word_indices = utils.top_k(log_probs, top_k)
+            if shortlist:
+                word_indices = shortlist[word_indices]
+            results = [log_probs, word_indices]
+        elif shortlist:
+            results = [log_probs, TT.zeros(log_probs.shape, dtype='int64') + shortlist]
+        else:
+            results = [log_probs]
+        results += [alignment, h, ctx]
+        if self.state['maintain_coverage']:
+            results.append(coverage)
+        return results
+
+    def build_greedy_decoder(self, c, c_mask, c_projections, fertility,
+            init_states, init_coverage, min_lens, max_steps,
+            shortlist=None, ignore_unk=False):
+        """Greedy search of a batch of sentences in a single scan.
+
+        Every sentence keeps one hypothesis, extended at each step with
+        its most probable next word by build_step_computer, until all
+        of them end with the null symbol or ran out of their
+        `max_steps`. The null symbol is not allowed before the
+        `min_lens` step of a sentence, nor UNK at all with `ignore_unk`.
+        Once a sentence is finished its words are the null symbol and
+        its cost and coverage do not change any more.
+
+        Returns the words (n_steps, n_sents), the alignments
+        (n_steps, source_len, n_sents), the costs and the coverage after
+        the last step, and the updates of the scan.
+        """
+        assert self.state['search']
+        n_sents = c.shape[1]
+        eos_id = self.state['null_sym_target']
+        unk_id = self.state['unk_sym_target']
+        n_projections = len(c_projections)
+
+        def greedy_step(step_num, prev_word, prev_state, prev_ctx, coverage_before,
+                cost, finished, *non_sequences):
+            c, c_mask = non_sequences[:2]
+            c_projections = list(non_sequences[2:2 + n_projections])
+            fertility, min_lens, max_steps = non_sequences[2 + n_projections:5 + n_projections]
+            shortlist = non_sequences[5 + n_projections] if len(non_sequences) > 5 + n_projections else None
+            outputs = self.build_step_computer(c, step_num, prev_word, None,
+                    [prev_state], prev_ctx,
+                    coverage_before=coverage_before, fertility=fertility,
+                    c_mask=c_mask, c_projections=c_projections,
+                    shortlist=shortlist)
+            log_probs = outputs[0]
+            if shortlist:
+                candidates = shortlist
+                outputs = outputs[2:]
+            else:
+                candidates = TT.arange(log_probs.shape[1])
+                outputs = outputs[1:]
+            alignment, h, ctx = outputs[:3]
+            coverage = outputs[3] if self.state['maintain_coverage'] else coverage_before
+
+            if ignore_unk:
+                log_probs = TT.switch(TT.eq(candidates, unk_id).dimshuffle('x', 0),
+                        -numpy.inf, log_probs)
+            too_short = TT.lt(step_num, min_lens)
+            log_probs = TT.switch(TT.and_(TT.eq(candidates, eos_id).dimshuffle('x', 0),
+                    too_short.dimshuffle(0, 'x')), -numpy.inf, log_probs)
+            best = TT.argmax(log_probs, axis=1)
+            word = TT.switch(finished, eos_id, candidates[best])
+            cost = cost - TT.switch(finished, 0., log_probs[TT.arange(n_sents), best])
+            coverage = TT.switch(finished.dimshuffle('x', 0, 'x'), coverage_before, coverage)
+            finished = TT.or_(TT.or_(finished, TT.eq(word, eos_id)),
+                    TT.ge(step_num + 1, max_steps))
+            return ([word, h, ctx, coverage, cost, finished, alignment],
+                    theano.scan_module.until(TT.all(finished)))
+
+        non_sequences = [c, c_mask] + list(c_projections) + [fertility, min_lens, max_steps]
+        if shortlist:
+            non_sequences.append(shortlist)
+        outputs_info = [TT.zeros((n_sents,), dtype='int64'),
+                init_states[0],
+                TT.zeros((n_sents, c.shape[2]), dtype='float32'),
+                init_coverage,
+                TT.zeros((n_sents,), dtype='float32'),
+                TT.zeros((n_sents,), dtype='int8'),
+                None]
+        outputs, updates = theano.scan(greedy_step,
+                outputs_info=outputs_info,
+                non_sequences=non_sequences,
+                sequences=[TT.arange(max_steps.max(), dtype='int64')],
+                name="{}_greedy_scan".format(self.prefix))
+        words, _, _, coverage, costs, _, alignment = outputs
+        return words, alignment, costs[-1], coverage[-1], updates
+
 class RNNEncoderDecoder(object):
     """This class encapsulates the translation model.
 
@@ -1863,8 +2215,23 @@ class RNNEncoderDecoder(object):
         self.rng = rng
         self.skip_init = skip_init
         self.compute_alignment = compute_alignment
+        # Shared tables of the encoders, see precompute_source_tables
+        self.source_tables = None
+
+    def build(self, mode='all'):
+        """Builds the computation graphs that `mode` needs:
+
+        'train': the log-likelihood of a batch and its gradients,
+        'score': the log-likelihood of a batch, without the gradients,
+        'beam_search': the encoder of a batch, used by the batched beam search,
+        'sample': none, as in the other modes the graphs of the sampler and
+            of the functions on a single sentence are built when they are
+            first asked for,
+        'all': all of them, including the sampler.
+        """
+        assert mode in ['all', 'train', 'score', 'beam_search', 'sample']
+        self.mode = mode
 
-    def build(self):
         logger.debug("Create input variables")
         self.x = TT.lmatrix('x')
         self.x_mask = TT.matrix('x_mask')
@@ -1872,8 +2239,10 @@ class RNNEncoderDecoder(object):
         self.y_mask = TT.matrix('y_mask')
         self.inputs = [self.x, self.y, self.x_mask, self.y_mask]
 
-        # Annotation for the log-likelihood computation
-        training_c_components = []
+        # Annotation for the log-likelihood computation, not needed when
+        # sampling. The layers are created in the same order in all modes,
+        # so that they get the same initial parameters.
+        build_training_c = mode != 'sample'
 
         logger.debug("Create encoder")
         self.encoder = Encoder(self.state, self.rng,
@@ -1881,48 +2250,110 @@ class RNNEncoderDecoder(object):
                 skip_init=self.skip_init)
         self.encoder.create_layers()
 
-        logger.debug("Build encoding computation graph")
-        forward_training_c = self.encoder.build_encoder(
-                self.x, self.x_mask,
-                use_noise=True,
-                return_hidden_layers=True)
-
         logger.debug("Create backward encoder")
         self.backward_encoder = Encoder(self.state, self.rng,
                 prefix="back_enc",
                 skip_init=self.skip_init)
         self.backward_encoder.create_layers()
 
+        self.state['c_dim'] = self.state['dim'] * sum(1 for key in
+                ['forward', 'last_forward', 'backward', 'last_backward']
+                if self.state[key])
+
+        logger.debug("Create decoder")
+        self.decoder = Decoder(self.state, self.rng,
+                skip_init=self.skip_init, compute_alignment=self.compute_alignment)
+        self.decoder.create_layers()
+        if build_training_c:
+            self.training_c = self._build_annotations(self.x, self.x_mask)
+
+        if mode in ['all', 'train', 'score']:
+            logger.debug("Build log-likelihood computation graph")
+            (self.predictions, self.alignment,
+                self.training_coverage, self.training_fertility) = self.decoder.build_decoder(
+                    c=self.training_c, c_mask=self.x_mask,
+                    y=self.y, y_mask=self.y_mask,
+                    compute_grads=mode != 'score',
+                    return_coverage=True)
+
+        if mode == 'all':
+            self._build_sampling_graph()
+
+        logger.debug("Create auxiliary variables")
+        self.c = TT.matrix("c")
+        self.step_num = TT.lscalar("step_num")
+        self.current_states = [TT.matrix("cur_{}".format(i))
+                for i in range(self.decoder.num_levels)]
+        self.gen_y = TT.lvector("gen_y")
+        # added by Zhaopeng Tu, 2015-11-02
+        self.coverage_before = TT.tensor3("coverage_before")
+        # added by Zhaopeng Tu, 2015-12-17
+        self.fertility = TT.matrix("fertility")
+        # for batched beam search: annotations of several sentences
+        # (source_len, n_sents, c_dim), their mask (source_len, n_sents)
+        # and the sentence each hypothesis belongs to (n_hyps,)
+        self.batch_c = TT.tensor3("batch_c")
+        self.batch_c_mask = TT.matrix("batch_c_mask")
+        self.hyp_sents = TT.lvector("hyp_sents")
+        # for the fused beam search step: the rows of the previous
+        # hypotheses extended at this step and their context vectors
+        self.backpointers = TT.lvector("backpointers")
+        self.prev_ctx = TT.matrix("prev_ctx")
+        self.top_k = TT.lscalar("top_k")
+        self.shortlist = TT.lvector("shortlist")
+        # for the greedy search: the first step each sentence may end at
+        # and the number of steps it may take
+        self.min_lens = TT.lvector("min_lens")
+        self.max_steps = TT.lvector("max_steps")
+        # source-side projections of batch_c, see Decoder.build_source_projections
+        self.batch_c_projections = [TT.tensor3(name) for name in
+                ["batch_p_from_c", "batch_cov_inputer_from_c",
+                 "batch_cov_gater_from_c", "batch_cov_reseter_from_c"]]
+
+
+    def _build_annotations(self, x, x_mask, source_tables=None):
+        """The annotations of the batch of source sentences `x`, made of
+        the states of the forward and backward encoders. `source_tables`
+        are the tables of each encoder by prefix, see
+        precompute_source_tables"""
+        source_tables = source_tables or {}
+        logger.debug("Build encoding computation graph")
+        forward_training_c = self.encoder.build_encoder(
+                x, x_mask,
+                use_noise=True,
+                return_hidden_layers=True,
+                source_tables=source_tables.get('enc'))
+
         logger.debug("Build backward encoding computation graph")
         backward_training_c = self.backward_encoder.build_encoder(
-                self.x[::-1],
-                self.x_mask[::-1],
+                x[::-1],
+                x_mask[::-1],
                 use_noise=True,
-                approx_embeddings=self.encoder.approx_embedder(self.x[::-1]),
-                return_hidden_layers=True)
+                approx_embeddings=(None
+                    if source_tables
+                    else self.encoder.approx_embedder(x[::-1])),
+                return_hidden_layers=True,
+                source_tables=source_tables.get('back_enc'))
         # Reverse time for backward representations.
         backward_training_c.out = backward_training_c.out[::-1]
 
+        training_c_components = []
         if self.state['forward']:
             training_c_components.append(forward_training_c)
         if self.state['last_forward']:
             training_c_components.append(
-                    ReplicateLayer(self.x.shape[0])(forward_training_c[-1]))
+                    ReplicateLayer(x.shape[0])(forward_training_c[-1]))
         if self.state['backward']:
             training_c_components.append(backward_training_c)
         if self.state['last_backward']:
-            training_c_components.append(ReplicateLayer(self.x.shape[0])
+            training_c_components.append(ReplicateLayer(x.shape[0])
                     (backward_training_c[0]))
-        self.state['c_dim'] = len(training_c_components) * self.state['dim']
-        
-        logger.debug("Create decoder")
-        self.decoder = Decoder(self.state, self.rng,
-                skip_init=self.skip_init, compute_alignment=self.compute_alignment)
-        self.decoder.create_layers()
-        logger.debug("Build log-likelihood computation graph")
-        self.predictions, self.alignment = self.decoder.build_decoder(
-                c=Concatenate(axis=2)(*training_c_components), c_mask=self.x_mask,
-                y=self.y, y_mask=self.y_mask)
+        return Concatenate(axis=2)(*training_c_components)
+
+    def _build_sampling_graph(self):
+        """Builds the encoder of a single sentence and the sampler"""
+        if hasattr(self, 'sampling_c'):
+            return
 
         # Annotation for sampling
         sampling_c_components = []
@@ -1960,37 +2391,50 @@ class RNNEncoderDecoder(object):
             self.sample_coverage = sample_results[2]
             if self.state['use_fertility_model'] and self.state['use_linguistic_coverage']:
                 self.sample_fertility = sample_results[3]
- 
-        logger.debug("Create auxiliary variables")
-        self.c = TT.matrix("c")
-        self.step_num = TT.lscalar("step_num")
-        self.current_states = [TT.matrix("cur_{}".format(i))
-                for i in range(self.decoder.num_levels)]
-        self.gen_y = TT.lvector("gen_y")
-        # added by Zhaopeng Tu, 2015-11-02
-        self.coverage_before = TT.tensor3("coverage_before")
-        # added by Zhaopeng Tu, 2015-12-17
-        self.fertility = TT.matrix("fertility")
-
 
     def create_lm_model(self):
         if hasattr(self, 'lm_model'):
             return self.lm_model
+        if self.mode in ['all', 'train']:
+            model_kwargs = dict(cost_layer=self.predictions)
+        else:
+            # Nothing to train, the parameters are only loaded
+            model_kwargs = dict(cost_layer=self.decoder.output_layer,
+                    params=self._layer_params())
         self.lm_model = LM_Model(
-            cost_layer=self.predictions,
-            sample_fn=self.create_sampler(),
+            # the sampler is compiled when first used
+            sample_fn=lambda *args: self.create_sampler()(*args),
             weight_noise_amount=self.state['weight_noise_amount'],
             indx_word=self.state['indx_word_target'],
             indx_word_src=self.state['indx_word'],
-            rng=self.rng)
+            rng=self.rng,
+            **model_kwargs)
         self.lm_model.load_dict(self.state)
         logger.debug("Model params:\n{}".format(
             pprint.pformat(sorted([p.name for p in self.lm_model.params]))))
         return self.lm_model
 
+    def _layer_params(self):
+        """The parameters of the layers of the encoders and the decoder"""
+        params = []
+        for part in [self.encoder, self.backward_encoder, self.decoder]:
+            for name, value in vars(part).items():
+                if part is self.backward_encoder and name == 'approx_embedder':
+                    # the backward encoder reads the forward embeddings
+                    continue
+                for layer in (value if isinstance(value, list) else [value]):
+                    if isinstance(layer, Layer):
+                        params += [p for p in layer.params if p not in params]
+        return params
+
+    def _compile(self, **kwargs):
+        # Reuses the functions compiled by earlier runs if state['compile_cache'] is set
+        return compile_function(self.state.get('compile_cache'), **kwargs)
+
     def create_representation_computer(self):
         if not hasattr(self, "repr_fn"):
-            self.repr_fn = theano.function(
+            self._build_sampling_graph()
+            self.repr_fn = self._compile(
                     inputs=[self.sampling_x],
                     outputs=[self.sampling_c],
                     name="repr_fn")
@@ -2000,7 +2444,8 @@ class RNNEncoderDecoder(object):
     # for fertility model
     def create_fertility_computer(self):
         if not hasattr(self, "fert_fn"):
-            self.fert_fn = theano.function(
+            self._build_sampling_graph()
+            self.fert_fn = self._compile(
                     inputs=[self.sampling_c],
                     outputs=self.decoder.build_fertility_computer(self.sampling_c),
                     name="fert_fn")
@@ -2009,29 +2454,30 @@ class RNNEncoderDecoder(object):
 
     def create_initializers(self):
         if not hasattr(self, "init_fn"):
+            self._build_sampling_graph()
             init_c = self.sampling_c[0, -self.state['dim']:]
-            self.init_fn = theano.function(
+            self.init_fn = self._compile(
                     inputs=[self.sampling_c],
                     outputs=self.decoder.build_initializers(init_c),
                     name="init_fn")
         return self.init_fn
 
     def create_sampler(self, many_samples=False):
-        if hasattr(self, 'sample_fn'):
-            return self.sample_fn
-        logger.debug("Compile sampler")
-        outputs = [self.sample, self.sample_log_prob]
-        # added by Zhaopeng Tu, 2015-12-09
-        if self.state['maintain_coverage']:
-            outputs.append(self.sample_coverage)
-            if self.state['use_fertility_model'] and self.state['use_linguistic_coverage']:
-                outputs.append(self.sample_fertility)
-
-        self.sample_fn = theano.function(
-                inputs=[self.n_samples, self.n_steps, self.T, self.sampling_x],
-                outputs=outputs,
-                updates=self.sampling_updates,
-                name="sample_fn")
+        if not hasattr(self, 'sample_fn'):
+            self._build_sampling_graph()
+            logger.debug("Compile sampler")
+            outputs = [self.sample, self.sample_log_prob]
+            # added by Zhaopeng Tu, 2015-12-09
+            if self.state['maintain_coverage']:
+                outputs.append(self.sample_coverage)
+                if self.state['use_fertility_model'] and self.state['use_linguistic_coverage']:
+                    outputs.append(self.sample_fertility)
+
+            self.sample_fn = self._compile(
+                    inputs=[self.n_samples, self.n_steps, self.T, self.sampling_x],
+                    outputs=outputs,
+                    updates=self.sampling_updates,
+                    name="sample_fn")
         if not many_samples:
             def sampler(*args):
                 # squeeze: Remove broadcastable dimensions from the shape of an array.
@@ -2043,7 +2489,7 @@ class RNNEncoderDecoder(object):
     def create_scorer(self, batch=False):
         if not hasattr(self, 'score_fn'):
             logger.debug("Compile scorer")
-            self.score_fn = theano.function(
+            self.score_fn = self._compile(
                     inputs=self.inputs,
                     outputs=[-self.predictions.cost_per_sample],
                     name="score_fn")
@@ -2058,7 +2504,7 @@ class RNNEncoderDecoder(object):
 
     def create_next_probs_computer(self):
         if not hasattr(self, 'next_probs_fn'):
-            self.next_probs_fn = theano.function(
+            self.next_probs_fn = self._compile(
                     inputs=[self.c, self.step_num, self.gen_y] + self.current_states + [self.coverage_before, self.fertility],
                     outputs=self.decoder.build_next_probs_predictor(
                         self.c, self.step_num, self.gen_y, self.current_states, self.coverage_before, self.fertility),
@@ -2067,7 +2513,7 @@ class RNNEncoderDecoder(object):
 
     def create_next_states_computer(self):
         if not hasattr(self, 'next_states_fn'):
-            self.next_states_fn = theano.function(
+            self.next_states_fn = self._compile(
                     inputs=[self.c, self.step_num, self.gen_y] + self.current_states + [self.coverage_before, self.fertility],
                     outputs=self.decoder.build_next_states_computer(
                         self.c, self.step_num, self.gen_y, self.current_states, self.coverage_before, self.fertility),
@@ -2075,10 +2521,214 @@ class RNNEncoderDecoder(object):
         return self.next_states_fn
 
 
+    def create_batch_representation_computer(self):
+        fn_name = 'batch_repr{}_fn'.format('_tables' if self.source_tables else '')
+        if not hasattr(self, fn_name):
+            c = self.tables_c if self.source_tables else self.training_c
+            setattr(self, fn_name, self._compile(
+                    inputs=[self.x, self.x_mask],
+                    outputs=[c.out] + self.decoder.build_source_projections(c.out),
+                    name=fn_name))
+        return getattr(self, fn_name)
+
+    def precompute_source_tables(self, check_batch=None, rtol=1e-5, atol=1e-6):
+        """Tabulates the input, update and reset signals of the forward and
+        backward encoders for every source word, see
+        Encoder.build_source_tables. To be called once the parameters are
+        loaded; the batch representation computer created afterwards
+        gathers rows of the tables instead of multiplying the embeddings
+        of the words.
+
+        If `check_batch`, a pair (x, x_mask), is given, its annotations
+        are computed with and without the tables, and an exception is
+        raised if they are not close according to numpy.allclose.
+        """
+        assert self.mode != 'sample'
+        tables = dict(enc=self.encoder.build_source_tables(self.encoder.approx_embedder),
+                back_enc=self.backward_encoder.build_source_tables(self.encoder.approx_embedder))
+        keys = [(prefix, name) for prefix in sorted(tables) for name in sorted(tables[prefix])]
+        values = self._compile(inputs=[],
+                outputs=[tables[prefix][name] for prefix, name in keys],
+                name="source_tables_fn")()
+        reference = None
+        if check_batch is not None:
+            reference = self.create_batch_representation_computer()
+        if self.source_tables is None:
+            self.source_tables = {}
+            for (prefix, name), value in zip(keys, values):
+                self.source_tables.setdefault(prefix, {})[name] = theano.shared(value,
+                        name="{}_{}_table".format(prefix, name))
+            self.tables_c = self._build_annotations(self.x, self.x_mask,
+                    self.source_tables)
+        else:
+            for (prefix, name), value in zip(keys, values):
+                self.source_tables[prefix][name].set_value(value)
+        logger.debug("Source tables of {} bytes".format(
+            sum(value.nbytes for value in values)))
+
+        if reference is not None:
+            expected = reference(*check_batch)
+            actual = self.create_batch_representation_computer()(*check_batch)
+            for i, (x, y) in enumerate(zip(expected, actual)):
+                diff = numpy.abs(x - y).max() if x.size else 0.
+                logger.debug("Output {} of the encoder differs by {} with the tables".format(i, diff))
+                if not numpy.allclose(x, y, rtol=rtol, atol=atol):
+                    raise Exception("The source tables change output {} of the encoder by {}".format(i, diff))
+
+    def create_batch_fertility_computer(self):
+        if not hasattr(self, "batch_fert_fn"):
+            fertility = self.decoder.build_fertility_computer(self.batch_c)
+            self.batch_fert_fn = self._compile(
+                    inputs=[self.batch_c],
+                    outputs=fertility.reshape((self.batch_c.shape[0], self.batch_c.shape[1])),
+                    name="batch_fert_fn")
+        return self.batch_fert_fn
+
+    def create_batch_initializers(self):
+        if not hasattr(self, "batch_init_fn"):
+            init_c = self.batch_c[0, :, -self.state['dim']:]
+            self.batch_init_fn = self._compile(
+                    inputs=[self.batch_c],
+                    outputs=self.decoder.build_initializers(init_c),
+                    name="batch_init_fn")
+        return self.batch_init_fn
+
+    def _batch_decoder_inputs(self):
+        # Every hypothesis attends over the annotations of its own sentence
+        return dict(c=self.batch_c[:, self.hyp_sents],
+                c_mask=self.batch_c_mask[:, self.hyp_sents],
+                c_projections=[p[:, self.hyp_sents] for p in self.batch_c_projections],
+                fertility=self.fertility[:, self.hyp_sents])
+
+    def create_step_computer(self, top_k=False, shortlist=False):
+        """Compiles Decoder.build_step_computer over the batched annotations.
+        With `top_k` the function takes the number of candidates kept per
+        hypothesis as an extra input, with `shortlist` it takes the target
+        words to compute the softmax over as the last input."""
+        fn_name = 'step{}{}{}_fn'.format('_top_k' if top_k else '',
+                '_shortlist' if shortlist else '',
+                '_tables' if self.decoder.target_tables else '')
+        if not hasattr(self, fn_name):
+            inputs = [self.batch_c, self.batch_c_mask] + self.batch_c_projections + [self.hyp_sents, self.step_num, self.gen_y, self.backpointers] + self.current_states + [self.prev_ctx, self.coverage_before, self.fertility]
+            if top_k:
+                inputs.append(self.top_k)
+            if shortlist:
+                inputs.append(self.shortlist)
+            setattr(self, fn_name, self._compile(
+                    inputs=inputs,
+                    outputs=self.decoder.build_step_computer(
+                        step_num=self.step_num, y=self.gen_y, backpointers=self.backpointers,
+                        prev_states=self.current_states, prev_ctx=self.prev_ctx,
+                        coverage_before=self.coverage_before,
+                        top_k=self.top_k if top_k else None,
+                        shortlist=self.shortlist if shortlist else None,
+                        **self._batch_decoder_inputs()),
+                    name=fn_name))
+        return getattr(self, fn_name)
+
+    def create_greedy_computer(self, shortlist=False, ignore_unk=False):
+        """Compiles Decoder.build_greedy_decoder over the batched
+        annotations. The function takes the inputs of the step computer
+        at the first step, without the ones selecting the hypotheses,
+        followed by the minimum and maximum lengths of the sentences
+        and, with `shortlist`, the target words to compute the softmax
+        over. It returns the words, the alignments, the costs and the
+        final coverages."""
+        fn_name = 'greedy{}{}{}_fn'.format('_shortlist' if shortlist else '',
+                '_ignore_unk' if ignore_unk else '',
+                '_tables' if self.decoder.target_tables else '')
+        if not hasattr(self, fn_name):
+            inputs = [self.batch_c, self.batch_c_mask] + self.batch_c_projections + self.current_states + [self.coverage_before, self.fertility, self.min_lens, self.max_steps]
+            if shortlist:
+                inputs.append(self.shortlist)
+            words, alignment, costs, coverage, updates = self.decoder.build_greedy_decoder(
+                    self.batch_c, self.batch_c_mask, self.batch_c_projections,
+                    self.fertility, self.current_states, self.coverage_before,
+                    self.min_lens, self.max_steps,
+                    shortlist=self.shortlist if shortlist else None,
+                    ignore_unk=ignore_unk)
+            setattr(self, fn_name, self._compile(
+                    inputs=inputs,
+                    outputs=[words, alignment, costs, coverage],
+                    updates=updates,
+                    name=fn_name))
+        return getattr(self, fn_name)
+
+    def precompute_target_tables(self):
+        """Tabulates the signals computed from the embedding of the previous
+        word for every target word, see Decoder.build_target_tables. To be
+        called once the parameters are loaded; the step computers created
+        afterwards gather rows of the tables instead of multiplying the
+        embeddings of the words"""
+        tables = self.decoder.build_target_tables()
+        names = sorted(tables)
+        values = self._compile(inputs=[],
+                outputs=[tables[name] for name in names],
+                name="target_tables_fn")()
+        if self.decoder.target_tables is None:
+            self.decoder.target_tables = dict((name, theano.shared(value,
+                    name="{}_{}_table".format(self.decoder.prefix, name)))
+                for name, value in zip(names, values))
+        else:
+            for name, value in zip(names, values):
+                self.decoder.target_tables[name].set_value(value)
+        logger.debug("Target tables of {} bytes".format(
+            sum(value.nbytes for value in values)))
+
+    def create_alignment_computer(self):
+        """Compiles the teacher-forced decoding of a padded batch of
+        sentence pairs, with the inputs of the scorer. Returns the cost
+        (minus the log-probability) of each pair and the alignments
+        (max_target_len, source_len, batch_size), followed, if the coverage
+        is maintained, by its value after the last target word of each
+        pair (batch_size, source_len, coverage_dim) and, if the fertility
+        is modelled, by the fertilities (source_len, batch_size)"""
+        if not hasattr(self, 'align_fn'):
+            logger.debug("Compile alignment computer")
+            outputs = [self.predictions.cost_per_sample, self.alignment]
+            if self.state['maintain_coverage']:
+                y_lens = TT.cast(self.y_mask.sum(axis=0), 'int64')
+                outputs.append(self.training_coverage.dimshuffle(0, 2, 1, 3)[
+                    y_lens - 1, TT.arange(self.y.shape[1])])
+                if self.state['use_linguistic_coverage'] and self.state['use_fertility_model']:
+                    outputs.append(self.training_fertility)
+            self.align_fn = self._compile(
+                    inputs=self.inputs,
+                    outputs=outputs,
+                    name="align_fn")
+        return self.align_fn
+
+    def create_encoded_scorer(self):
+        """Compiles the cost (minus the log-probability) of target
+        sentences given the annotations of their source sentences, so
+        that several targets of a source are scored without running the
+        encoder again. The inputs are the annotations and the mask of a
+        batch of source sentences, as returned by the batch representation
+        computer, the source sentence of each target sentence, then the
+        target sentences and their mask. Returns the costs and, if the
+        alignment is computed, the attention each source position got
+        over the target words (source_len, n_targets)"""
+        if not hasattr(self, 'encoded_score_fn'):
+            logger.debug("Compile encoded scorer")
+            predictions, alignment = self.decoder.build_decoder(
+                    c=self.batch_c[:, self.hyp_sents],
+                    c_mask=self.batch_c_mask[:, self.hyp_sents],
+                    y=self.y, y_mask=self.y_mask,
+                    compute_grads=False)
+            outputs = [predictions.cost_per_sample]
+            if self.compute_alignment:
+                # alignment shape: (target_len, source_len, n_targets)
+                outputs.append((alignment * self.y_mask.dimshuffle(0, 'x', 1)).sum(axis=0))
+            self.encoded_score_fn = self._compile(
+                    inputs=[self.batch_c, self.batch_c_mask, self.hyp_sents, self.y, self.y_mask],
+                    outputs=outputs,
+                    name="encoded_score_fn")
+        return self.encoded_score_fn
+
     def create_probs_computer(self, return_alignment=False):
         if not hasattr(self, 'probs_fn'):
             logger.debug("Compile probs computer")
-            self.probs_fn = theano.function(
+            self.probs_fn = self._compile(
                     inputs=self.inputs,
                     outputs=[self.predictions.word_probs, self.alignment],
                     name="probs_fn")
@@ -0,0 +1,203 @@
+"""
+Beam search with an ensemble of models.
+
+`EnsembleEncoderDecoder` puts several models, RNNEncoderDecoder or
+numpy_engine.NumpyEncoderDecoder, behind the methods of
+RNNEncoderDecoder that BeamSearch uses, so that a single beam is
+searched with all of them:
+
+    beam_search = BeamSearch([enc_dec, other_enc_dec], ensemble_weights=[2, 1])
+
+At each step every model moves its own hypotheses forward, and the
+weighted average of their log-probabilities chooses the candidates. The
+models are called concurrently from a pool of threads.
+
+The inputs and outputs of the models are concatenated along their last
+axis (the annotations, their projections, the states, the contexts and
+the coverages), so that the beam search reorders the hypotheses of all
+the models at once without knowing about them. The alignment is the
+weighted average of the ones of the models; the coverage and the
+fertility reported with the translations are the ones of the first
+model.
+"""
+
+import concurrent.futures
+import functools
+import logging
+import os
+
+import numpy
+
+from experiments.nmt.numpy_compat import argpartition
+
+logger = logging.getLogger(__name__)
+
+# The state of the models of an ensemble has to agree on these
+SHARED_KEYS = ['n_sym_source', 'null_sym_source', 'unk_sym_source',
+        'n_sym_target', 'null_sym_target', 'unk_sym_target',
+        'maintain_coverage', 'use_linguistic_coverage', 'use_fertility_model',
+        'coverage_dim', 'coverage_accumulated_operation']
+
+def split(x, sizes, axis):
+    """Cuts `x` along `axis` in parts of the given `sizes`"""
+    return numpy.split(x, numpy.cumsum(sizes)[:-1], axis=axis)
+
+class EnsembleEncoderDecoder(object):
+
+    def __init__(self, models, weights=None, n_threads=None):
+        """`models` share the source and target vocabularies and the kind
+        of coverage, see SHARED_KEYS. Their log-probabilities are averaged
+        with the `weights`, equal by default. `n_threads` is the size of
+        the pool calling them, one thread per model by default."""
+        state = models[0].state
+        for model in models[1:]:
+            for key in SHARED_KEYS:
+                if model.state.get(key) != state.get(key):
+                    raise ValueError("The models of the ensemble differ in {}: {} and {}".format(
+                        key, state.get(key), model.state.get(key)))
+        if weights is None:
+            weights = [1.] * len(models)
+        if len(weights) != len(models):
+            raise ValueError("{} weights for {} models".format(len(weights), len(models)))
+        self.models = models
+        self.weights = numpy.asarray(weights, dtype='float32') / numpy.sum(weights)
+        self.n_threads = n_threads or len(models)
+        self.pool = None
+        self.pool_pid = None
+
+        # The coverages of the models are side by side
+        self.state = dict(state)
+        self.coverage_dims = [state['coverage_dim']] * len(models)
+        if state['maintain_coverage']:
+            self.state['coverage_dim'] = sum(self.coverage_dims)
+        self.use_fertility = (state['maintain_coverage']
+                and state['use_linguistic_coverage']
+                and state['use_fertility_model'])
+
+        # Sizes of the parts of the concatenated arrays, found by the
+        # first calls as they depend on the dimensions of each model
+        self.source_sizes = None
+        self.state_sizes = None
+
+    def _executor(self):
+        # a forked worker process does not have the threads of the pool
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.n_threads)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def _run(self, calls):
+        """Runs the (function, arguments) pairs of `calls` concurrently,
+        returns their results in order"""
+        if len(calls) == 1:
+            fn, args = calls[0]
+            return [fn(*args)]
+        pool = self._executor()
+        futures = [pool.submit(fn, *args) for fn, args in calls]
+        return [future.result() for future in futures]
+
+    def batch_representation(self, x, x_mask):
+        reprs = self._run([(fn, (x, x_mask)) for fn in self.comp_repr])
+        self.source_sizes = [[outputs[i].shape[2] for outputs in reprs]
+                for i in range(len(reprs[0]))]
+        return [numpy.concatenate([outputs[i] for outputs in reprs], axis=2)
+                for i in range(len(reprs[0]))]
+
+    def batch_fertility(self, c):
+        fertility = self._run([(fn, (c_part,)) for fn, c_part in
+            zip(self.comp_fert, split(c, self.source_sizes[0], 2))])
+        # (n_models * source_len, n_sents), the first model comes first
+        return numpy.concatenate(fertility, axis=0)
+
+    def batch_initializers(self, c):
+        states = self._run([(fn, (c_part,)) for fn, c_part in
+            zip(self.comp_init_states, split(c, self.source_sizes[0], 2))])
+        self.state_sizes = [[model_states[level].shape[1] for model_states in states]
+                for level in range(len(states[0]))]
+        return [numpy.concatenate([model_states[level] for model_states in states], axis=1)
+                for level in range(len(states[0]))]
+
+    def step(self, top_k, shortlist, *inputs):
+        """The step_fn of RNNEncoderDecoder.create_step_computer, with the
+        same inputs and outputs"""
+        inputs = list(inputs)
+        n_models = len(self.models)
+        n_sources = len(self.source_sizes) + 1
+        sources, inputs = inputs[:n_sources], inputs[n_sources:]
+        selection, inputs = inputs[:4], inputs[4:]
+        n_levels = len(self.state_sizes)
+        states, inputs = inputs[:n_levels], inputs[n_levels:]
+        contexts, coverages, fertility = inputs[:3]
+        n_cands = inputs[3] if top_k else None
+        columns = inputs[-1] if shortlist else None
+
+        # c, then its mask shared by the models, then the projections
+        c_mask = sources[1]
+        model_sources = [split(x, sizes, 2)
+                for x, sizes in zip([sources[0]] + sources[2:], self.source_sizes)]
+        model_states = [split(x, sizes, 1) for x, sizes in zip(states, self.state_sizes)]
+        model_contexts = split(contexts, self.source_sizes[0], 1)
+        if self.state['maintain_coverage']:
+            model_coverages = split(coverages, self.coverage_dims, 2)
+        else:
+            model_coverages = [coverages] * n_models
+        if self.use_fertility:
+            model_fertility = numpy.split(fertility, n_models, axis=0)
+        else:
+            model_fertility = [fertility] * n_models
+
+        calls = []
+        for m, fn in enumerate(self.comp_step):
+            args = ([model_sources[0][m], c_mask] + [x[m] for x in model_sources[1:]]
+                    + selection + [x[m] for x in model_states]
+                    + [model_contexts[m], model_coverages[m], model_fertility[m]])
+            if shortlist:
+                args.append(columns)
+            calls.append((fn, args))
+        outputs = self._run(calls)
+
+        log_probs = sum(w * out[0] for w, out in zip(self.weights, outputs))
+        first = 2 if shortlist else 1
+        alignment = sum(w * out[first] for w, out in zip(self.weights, outputs))
+        h = [numpy.concatenate([out[first + 1 + level] for out in outputs], axis=1)
+                for level in range(n_levels)]
+        ctx = numpy.concatenate([out[first + 1 + n_levels] for out in outputs], axis=1)
+
+        if top_k:
+            n_cands = min(n_cands, log_probs.shape[1])
+            cand_indices = argpartition(-log_probs, n_cands - 1, axis=1)[:, :n_cands]
+            rows = numpy.arange(len(log_probs))[:, None]
+            results = [log_probs[rows, cand_indices],
+                    outputs[0][1][rows, cand_indices] if shortlist else cand_indices]
+        elif shortlist:
+            results = [log_probs, outputs[0][1]]
+        else:
+            results = [log_probs]
+        results += [alignment] + h + [ctx]
+        if self.state['maintain_coverage']:
+            results.append(numpy.concatenate([out[-1] for out in outputs], axis=2))
+        return results
+
+    # The interface of RNNEncoderDecoder used by BeamSearch.compile
+
+    def create_batch_representation_computer(self):
+        self.comp_repr = [model.create_batch_representation_computer()
+                for model in self.models]
+        return self.batch_representation
+
+    def create_batch_fertility_computer(self):
+        self.comp_fert = [model.create_batch_fertility_computer()
+                for model in self.models]
+        return self.batch_fertility
+
+    def create_batch_initializers(self):
+        self.comp_init_states = [model.create_batch_initializers()
+                for model in self.models]
+        return self.batch_initializers
+
+    def create_step_computer(self, top_k=False, shortlist=False):
+        # the candidates are chosen on the average, so the models return
+        # the whole distribution
+        self.comp_step = [model.create_step_computer(shortlist=shortlist)
+                for model in self.models]
+        return functools.partial(self.step, top_k, shortlist)
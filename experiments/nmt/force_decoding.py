@@ -16,9 +16,7 @@ from experiments.nmt import\
     prototype_search_with_coverage_state,\
     parse_input, parse_target
 
-from experiments.nmt.numpy_compat import argpartition
-
-numpy.set_printoptions(threshold=numpy.nan)
+numpy.set_printoptions(threshold=sys.maxsize)
 
 logger = logging.getLogger(__name__)
 
@@ -33,88 +31,65 @@ class Timer(object):
     def finish(self):
         self.total += time.time() - self.start_time
 
-class BeamSearch(object):
+def pad_batch(seqs, null_sym):
+    """The matrices of words and mask of a batch of sentences, which
+    already end with the null symbol"""
+    lens = [len(seq) for seq in seqs]
+    x = numpy.zeros((max(lens), len(seqs)), dtype='int64') + null_sym
+    x_mask = numpy.zeros((max(lens), len(seqs)), dtype='float32')
+    for idx, seq in enumerate(seqs):
+        x[:len(seq), idx] = seq
+        x_mask[:len(seq), idx] = 1.
+    return x, x_mask
+
+class ForceDecoder(object):
+    """Teacher-forced decoding of sentence pairs in padded batches, with
+    the graph of the log-likelihood used in training, see
+    RNNEncoderDecoder.create_alignment_computer"""
 
     def __init__(self, enc_dec):
         self.enc_dec = enc_dec
-        state = self.enc_dec.state
-        self.eos_id = state['null_sym_target']
-        self.unk_id = state['unk_sym_target']
 
     def compile(self):
-        self.comp_repr = self.enc_dec.create_representation_computer()
-        # added by Zhaopeng Tu, 2015-12-17, for fertility
-        if self.enc_dec.state['maintain_coverage'] and self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
-            self.comp_fert = self.enc_dec.create_fertility_computer()
-        self.comp_init_states = self.enc_dec.create_initializers()
-        self.comp_next_probs = self.enc_dec.create_next_probs_computer()
-        self.comp_next_states = self.enc_dec.create_next_states_computer()
-
-    def search(self, seq, out, ignore_unk=False, minlen=1):
-        c = self.comp_repr(seq)[0]
-        states = [x[None, :] for x in self.comp_init_states(c)]
-        dim = states[0].shape[1]
-        # added by Zhaopeng Tu, 2015-11-02
-        if self.enc_dec.state['maintain_coverage']:
-            coverage_dim = self.enc_dec.state['coverage_dim']
-            if self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['coverage_accumulated_operation'] == 'subtractive':
-                coverages = numpy.ones((c.shape[0], 1, coverage_dim), dtype='float32')
-            else:
-                coverages = numpy.zeros((c.shape[0], 1, coverage_dim), dtype='float32')
-        else:
-            coverages = None
-        
-        if self.enc_dec.state['maintain_coverage'] and self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
-            fertility = self.comp_fert(c)
-        else:
-            fertility = None
-
-        num_levels = len(states)
-
-        aligns = []
-        costs = [0.0]
-
-        for k in range(len(out)):
-            # Compute probabilities of the next words for
-            # all the elements of the beam.
-            last_words = (numpy.array([out[k-1]])
-                    if k > 0
-                    else numpy.zeros(1, dtype="int64"))
-
-            results = self.comp_next_probs(c, k, last_words, *states, coverage_before=coverages, fertility=fertility)
-            log_probs = numpy.log(results[0])
-            alignment = results[1]
-            # alignment shape: (source_len, target_num) where target_num = 1
-            aligns.append(alignment[:,0])
-
-            # Adjust log probs according to search restrictions
-            if ignore_unk:
-                log_probs[:,self.unk_id] = -numpy.inf
-            # TODO: report me in the paper!!!
-            if k < minlen:
-                log_probs[:,self.eos_id] = -numpy.inf
-
-            # costs = numpy.array(costs)[:, None] - log_probs
-
-            inputs = numpy.array([out[k]])
-            states = self.comp_next_states(c, k, inputs, *states, coverage_before=coverages, fertility=fertility)
-            if self.enc_dec.state['maintain_coverage']:
-                coverages = states[-1]
-                states = states[:-1]
-
-        if self.enc_dec.state['maintain_coverage']:
-            coverage = coverages[:,0,0]
-        # aligns shape:  (target_len, source_len)
-        # we reverse it to the shape (source_len, target_len) to show the matrix
-        aligns = numpy.array(aligns).transpose()
-
-        if self.enc_dec.state['maintain_coverage']:
-            if self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
-                return aligns, costs, coverage, fertility
-            else:
-                return aligns, costs, coverage
-        else:
-            return aligns, costs
+        self.comp_align = self.enc_dec.create_alignment_computer()
+
+    def batch_decode(self, seqs, outs):
+        """Force decodes each source sentence of `seqs` into the target
+        sentence of `outs` in a single batch. Returns for each pair the
+        alignment (source_len, target_len) and the list of its cost,
+        followed by the final coverage of the source words and their
+        fertility if they are modelled"""
+        state = self.enc_dec.state
+        x, x_mask = pad_batch(seqs, state['null_sym_source'])
+        y, y_mask = pad_batch(outs, state['null_sym_target'])
+        outputs = self.comp_align(x, y, x_mask, y_mask)
+        costs, alignment = outputs[:2]
+        results = []
+        for i, (seq, out) in enumerate(zip(seqs, outs)):
+            # alignment shape: (target_len, source_len, batch_size)
+            result = [alignment[:len(out), :len(seq), i].transpose(), [costs[i]]]
+            if state['maintain_coverage']:
+                result.append(outputs[2][i, :len(seq), 0])
+                if state['use_linguistic_coverage'] and state['use_fertility_model']:
+                    result.append(outputs[3][:len(seq), i])
+            results.append(tuple(result))
+        return results
+
+    def decode(self, seqs, outs, batch_size):
+        """Force decodes the pairs of `seqs` and `outs` in batches of
+        sentences of similar length and yields (index, result of
+        batch_decode) in the original order"""
+        order = numpy.argsort([len(out) for out in outs], kind='mergesort')
+        done = {}
+        next_idx = 0
+        for start in range(0, len(seqs), batch_size):
+            indices = order[start:start + batch_size]
+            results = self.batch_decode([seqs[i] for i in indices],
+                    [outs[i] for i in indices])
+            done.update(zip(indices, results))
+            while next_idx in done:
+                yield next_idx, done.pop(next_idx)
+                next_idx += 1
 
 def indices_to_words(i2w, seq):
     sen = []
@@ -128,26 +103,12 @@ def force_decoding(lm_model, seq, out,
         sampler=None, beam_search=None,
         ignore_unk=False, normalize=False,
         alpha=1, verbose=False):
-    if lm_model.maintain_coverage:
-        if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-            aligns, costs, coverage, fertility = beam_search.search(seq, out,
-                    ignore_unk=ignore_unk)
-        else:
-            aligns, costs, coverage = beam_search.search(seq, out,
-                    ignore_unk=ignore_unk)
-    else:
-        aligns, costs = beam_search.search(seq, out,
-                ignore_unk=ignore_unk)
+    """Force decodes a single sentence pair with a ForceDecoder given
+    as `beam_search`, see ForceDecoder.batch_decode for the result"""
+    result = list(beam_search.batch_decode([seq], [out])[0])
     if normalize:
-        costs = [co / len(out) for co in costs]
-
-    if lm_model.maintain_coverage:
-        if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-            return aligns, costs, coverage, fertility
-        else:
-            return aligns, costs, coverage
-    else:
-        return aligns, costs
+        result[1] = [co / len(out) for co in result[1]]
+    return tuple(result)
 
 
 def parse_args():
@@ -164,6 +125,9 @@ def parse_args():
             help="File of target sentences")
     parser.add_argument("--aligns",
             help="File to save alignments in")
+    parser.add_argument("--batch-size",
+            type=int, default=32,
+            help="Number of sentence pairs decoded together")
     parser.add_argument("--normalize",
             action="store_true", default=False,
             help="Normalize log-prob with the word count")
@@ -189,49 +153,38 @@ def main():
 
     rng = numpy.random.RandomState(state['seed'])
     enc_dec = RNNEncoderDecoder(state, rng, skip_init=True, compute_alignment=True)
-    enc_dec.build()
+    enc_dec.build(mode='score')
     lm_model = enc_dec.create_lm_model()
     lm_model.load(args.model_path)
     indx_word = pickle.load(open(state['word_indx'],'rb'))
     t_indx_word = pickle.load(open(state['word_indx_trgt'], 'rb'))
 
-    sampler = None
-    beam_search = BeamSearch(enc_dec)
-    beam_search.compile()
+    decoder = ForceDecoder(enc_dec)
+    decoder.compile()
 
     idict_src = pickle.load(open(state['indx_word'],'rb'))
     t_idict_src = pickle.load(open(state['indx_word_target'],'rb'))
 
-
-    fsrc = open(args.source, 'r')
-    ftrg = open(args.target, 'r')
+    with open(args.source, 'r') as fsrc, open(args.target, 'r') as ftrg:
+        parsed = [(parse_input(state, indx_word, seqin.strip(), idx2word=idict_src),
+                    parse_target(state, t_indx_word, seqout.strip(), idx2word=t_idict_src))
+                for seqin, seqout in zip(fsrc, ftrg)]
 
     start_time = time.time()
 
     total_cost = 0.0
-    # for i, line in enumerate(fsrc):
-    i = 0
-    while 1:
-        try:
-            seqin = fsrc.next().strip()
-            seqout = ftrg.next().strip()
-        except StopIteration:
-            break
-
-        seq, parsed_in = parse_input(state, indx_word, seqin, idx2word=idict_src)
-        out, parsed_out = parse_target(state, t_indx_word, seqout, idx2word=t_idict_src)
-
+    seqs = [seq for (seq, _), _ in parsed]
+    outs = [out for _, (out, _) in parsed]
+    for i, result in decoder.decode(seqs, outs, args.batch_size):
+        (_, parsed_in), (out, parsed_out) = parsed[i]
+        aligns, costs = result[:2]
+        if args.normalize:
+            costs = [co / len(out) for co in costs]
         if lm_model.maintain_coverage:
+            coverage = result[2]
             if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-                aligns, costs, coverage, fertility = force_decoding(lm_model, seq, out, sampler=sampler,
-                        beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-            else:
-                aligns, costs, coverage = force_decoding(lm_model, seq, out, sampler=sampler,
-                        beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-        else:
-            aligns, costs = force_decoding(lm_model, seq, out, sampler=sampler,
-                    beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-        
+                fertility = result[3]
+
         print("Parsed Input:", parsed_in)
         print("Parsed Target:", parsed_out)
         print('Aligns:')
@@ -259,8 +212,5 @@ def main():
                     format((time.time() - start_time) / (i + 1)))
     print("Total cost of the translations: {}".format(total_cost))
 
-    fsrc.close()
-    ftrg.close()
-
 if __name__ == "__main__":
     main()
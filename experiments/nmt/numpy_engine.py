@@ -0,0 +1,577 @@
+"""
+Inference of the RNNsearch model with coverage in NumPy only.
+
+`NumpyEncoderDecoder` loads the parameters saved by Container.save and
+computes the encoders, the initial decoder states, the fertility and the
+fused beam search step (see Decoder.build_step_computer) with batched
+NumPy code. It has the methods of RNNEncoderDecoder that BeamSearch uses,
+so that
+
+    beam_search = BeamSearch(NumpyEncoderDecoder(state, model_path))
+    beam_search.compile()
+
+searches without compiling any Theano function and without the overhead
+of calling one at every step. `check_engine` compares its computations
+with the ones of the compiled Theano functions.
+
+The engine also reads the models written by quantize.py, in which the
+approximate embeddings and the softmax weights are stored in int8 or
+float16, see QuantizedMatrix.
+"""
+
+import functools
+import logging
+
+import numpy
+
+from experiments.nmt.numpy_compat import argpartition
+
+logger = logging.getLogger(__name__)
+
+def sigmoid(x):
+    return 1. / (1. + numpy.exp(-x))
+
+class _NNet(object):
+    sigmoid = staticmethod(sigmoid)
+
+class _TT(object):
+    """The functions of theano.tensor used by the activations of the state"""
+    tanh = staticmethod(numpy.tanh)
+    exp = staticmethod(numpy.exp)
+    maximum = staticmethod(numpy.maximum)
+    nnet = _NNet
+
+class Maxout(object):
+    """encdec.Maxout on arrays"""
+
+    def __init__(self, maxout_part):
+        self.maxout_part = int(maxout_part)
+
+    def __call__(self, x):
+        return x.reshape(x.shape[:-1] +
+                (x.shape[-1] // self.maxout_part, self.maxout_part)).max(-1)
+
+class QuantizedMatrix(object):
+    """A matrix stored in int8 with a scale per column, or in float16.
+    Only the rows or the columns that are used are converted to float32"""
+
+    def __init__(self, values, scale=None):
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+        self.block = None
+
+    def _float(self, values, scale):
+        values = values.astype('float32')
+        if scale is not None:
+            values *= scale
+        return values
+
+    def rows(self, indices):
+        return self._float(self.values[indices], self.scale)
+
+    def columns(self, indices):
+        return self._float(self.values[:, indices],
+                self.scale[indices] if self.scale is not None else None)
+
+    def dequantize(self):
+        return self._float(self.values, self.scale)
+
+    def dot(self, x, out, block_size=1024):
+        """numpy.dot(x, self.dequantize(), out=out) converting `block_size`
+        columns at a time, so that the float32 matrix is never in memory"""
+        if self.block is None or self.block.shape[1] != block_size:
+            self.block = numpy.empty((self.shape[0], block_size), dtype='float32')
+        for start in range(0, self.shape[1], block_size):
+            stop = min(start + block_size, self.shape[1])
+            block = self.block[:, :stop - start]
+            block[...] = self.values[:, start:stop]
+            out[:, start:stop] = numpy.dot(x, block)
+            if self.scale is not None:
+                out[:, start:stop] *= self.scale[start:stop]
+        return out
+
+def quantize(matrix, dtype='int8'):
+    """Returns the arrays storing `matrix` in `dtype`, by suffix of their
+    names in the model: the int8 values and the scale of each column, or
+    the float16 values"""
+    if dtype == 'float16':
+        return {'float16': matrix.astype('float16')}
+    assert dtype == 'int8'
+    scale = numpy.abs(matrix).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+    return {'int8': numpy.round(matrix / scale).astype('int8'),
+            'scale': scale.astype('float32')}
+
+def load_params(path):
+    """The parameters of a model saved by Container.save or by
+    quantize.py, the quantized ones as QuantizedMatrix"""
+    model = numpy.load(path)
+    params = {}
+    for key in model.files:
+        if key.endswith('.int8'):
+            name = key[:-len('.int8')]
+            params[name] = QuantizedMatrix(model[key], model[name + '.scale'])
+        elif key.endswith('.float16'):
+            params[key[:-len('.float16')]] = QuantizedMatrix(model[key])
+        elif not key.endswith('.scale'):
+            params[key] = model[key]
+    return params
+
+def activation(definition):
+    """Evaluates an activation of the state, like 'lambda x: TT.tanh(x)'
+    or 'Maxout(2)', with NumPy functions"""
+    return eval(definition, dict(TT=_TT, Maxout=Maxout, numpy=numpy))
+
+class NumpyEncoderDecoder(object):
+
+    def __init__(self, state, params, target_tables=False, source_tables=False):
+        """`params` is the path of a model saved by Container.save or by
+        quantize.py, or the dictionary returned by load_params. With
+        `target_tables` the signals computed from the embedding of the
+        previous word are tabulated for every target word, as by
+        RNNEncoderDecoder.precompute_target_tables. With `source_tables`
+        those of the source words are tabulated for both encoders, as by
+        RNNEncoderDecoder.precompute_source_tables"""
+        assert state['search']
+        assert state['encoder_stack'] == 1 and state['decoder_stack'] == 1
+        if isinstance(params, str):
+            params = load_params(params)
+        self.state = state
+        self.dim = state['dim']
+        self.softmax_name = 'dec_deep_softmax' if state['deep_out'] else 'dec_softmax'
+        # The big matrices stay quantized, the others are converted
+        quantized = ['W_0_enc_approx_embdr', 'W_0_dec_approx_embdr',
+                'W2_' + self.softmax_name, 'W_' + self.softmax_name]
+        self.params = {}
+        for name, value in params.items():
+            if not isinstance(value, QuantizedMatrix):
+                value = numpy.asarray(value, dtype='float32')
+            elif name not in quantized:
+                value = value.dequantize()
+            self.params[name] = value
+        self.rank_n_activ = activation(state['rank_n_activ'])
+        self.unary_activ = activation(state['unary_activ'])
+        self.dec_activ = activation(self._lookup('dec', 'activ'))
+        self.dec_gater = activation(self._lookup('dec', 'rec_gater'))
+        self.dec_reseter = activation(self._lookup('dec', 'rec_reseter'))
+        # Work buffers of the step, reused while the batch does not grow
+        self.buffers = {}
+        # The softmax weights of the last shortlist
+        self.shortlisted = None
+        self.target_tables = None
+        self.source_tables = None
+        if source_tables:
+            words = numpy.arange(state['n_sym_source'], dtype='int64')
+            embeddings = self._embed(words, 'enc_approx_embdr')
+            self.source_tables = dict((prefix, self._source_signals(prefix, words, embeddings))
+                    for prefix in ['enc', 'back_enc'])
+        if target_tables:
+            self.target_tables = self._target_signals(
+                    numpy.arange(state['n_sym_target'], dtype='int64'))
+
+    def _lookup(self, prefix, key):
+        """encdec.prefix_lookup"""
+        return self.state.get('{}_{}'.format(prefix, key), self.state[key])
+
+    def _buffer(self, name, shape, dtype='float32'):
+        size = int(numpy.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = numpy.empty(size, dtype=dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def _gather(self, name, x, indices):
+        """x[:, indices] written in a work buffer"""
+        out = self._buffer(name, (x.shape[0], len(indices)) + x.shape[2:], x.dtype)
+        return numpy.take(x, indices, axis=1, out=out)
+
+    def _dense(self, x, name, activ=None):
+        """The output of the one layer MultiLayer `name`, at inference.
+        The layers without a learnt bias have a zero one"""
+        if 'W_0_' + name in self.params:
+            y = numpy.dot(x, self.params['W_0_' + name])
+        else:
+            y = numpy.dot(numpy.dot(x, self.params['W1_0_' + name]),
+                    self.params['W2_0_' + name])
+        if 'b_0_' + name in self.params:
+            y += self.params['b_0_' + name]
+        return activ(y) if activ else y
+
+    def _embed(self, words, name):
+        """The approximate embeddings of `words` given by the MultiLayer `name`"""
+        W = self.params['W_0_' + name]
+        embeddings = W.rows(words) if isinstance(W, QuantizedMatrix) else W[words]
+        return self.rank_n_activ(embeddings + self.params['b_0_' + name])
+
+    def _source_signals(self, prefix, words, embeddings):
+        """The input, update and reset signals of the encoder `prefix` for
+        the source words `words`, whose approximate embeddings are
+        `embeddings`. The missing signals are None"""
+        if self.source_tables is not None:
+            return [table[words] if table is not None else None
+                    for table in self.source_tables[prefix]]
+        flat = embeddings.reshape((-1, embeddings.shape[-1]))
+        signals = []
+        for embedder in ['input_embdr', 'update_embdr', 'reset_embdr']:
+            name = '{}_{}_0'.format(prefix, embedder)
+            signals.append(self._dense(flat, name).reshape(words.shape + (-1,))
+                    if 'W_0_' + name in self.params
+                    else None)
+        return signals
+
+    def _encode(self, prefix, signals, mask):
+        """Runs the recurrent layer of the encoder `prefix` over the
+        signals of _source_signals for a batch, returns its states
+        (n_steps, n_sents, dim)"""
+        name = '{}_transition_0'.format(prefix)
+        n_steps, n_sents = mask.shape
+        inputs, updates, resets = signals
+        W = self.params['W_' + name]
+        G = self.params.get('G_' + name)
+        R = self.params.get('R_' + name)
+        activ = activation(self._lookup(prefix, 'activ'))
+        gater = activation(self._lookup(prefix, 'rec_gater'))
+        reseter = activation(self._lookup(prefix, 'rec_reseter'))
+
+        h = numpy.zeros((n_sents, W.shape[0]), dtype='float32')
+        states = numpy.empty((n_steps, n_sents, W.shape[0]), dtype='float32')
+        for t in range(n_steps):
+            h_before = h
+            if R is not None and resets is not None:
+                h = reseter(numpy.dot(h_before, R) + resets[t]) * h_before
+            h = activ(numpy.dot(h, W) + inputs[t])
+            if G is not None and updates is not None:
+                gate = gater(numpy.dot(h_before, G) + updates[t])
+                h = gate * h + (1 - gate) * h_before
+            m = mask[t][:, None]
+            h = m * h + (1 - m) * h_before
+            states[t] = h
+        return states
+
+    def source_projections(self, c):
+        """RecurrentLayerWithSearch.source_projections"""
+        name = 'dec_transition_0'
+        source_len, n_sents = c.shape[:2]
+        p_from_c = numpy.dot(c, self.params['A_' + name])
+        state = self.state
+        if state['maintain_coverage'] and state.get('use_recurrent_coverage', False) and state.get('use_input_annotations_for_recurrent_coverage', False):
+            cov_inputer_from_c = numpy.dot(c, self.params['Cov_inputer_c_' + name])
+            if state.get('use_recurrent_gating_coverage', False):
+                cov_gater_from_c = numpy.dot(c, self.params['Cov_updater_c_' + name])
+                cov_reseter_from_c = numpy.dot(c, self.params['Cov_reseter_c_' + name])
+            else:
+                cov_gater_from_c = numpy.zeros_like(cov_inputer_from_c)
+                cov_reseter_from_c = numpy.zeros_like(cov_inputer_from_c)
+        else:
+            cov_inputer_from_c = numpy.zeros((source_len, n_sents, 1), dtype='float32')
+            cov_gater_from_c = numpy.zeros((source_len, n_sents, 1), dtype='float32')
+            cov_reseter_from_c = numpy.zeros((source_len, n_sents, 1), dtype='float32')
+        return [p_from_c, cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c]
+
+    def batch_representation(self, x, x_mask):
+        """The annotations of a batch of source sentences and their
+        source projections, like the batch_repr_fn of RNNEncoderDecoder"""
+        n_steps = x.shape[0]
+        embeddings = None
+        if self.source_tables is None:
+            embeddings = self._embed(x, 'enc_approx_embdr')
+        forward = self._encode('enc',
+                self._source_signals('enc', x, embeddings), x_mask)
+        # the backward encoder reads the embeddings of the forward one
+        backward = self._encode('back_enc',
+                self._source_signals('back_enc', x[::-1],
+                    embeddings[::-1] if embeddings is not None else None),
+                x_mask[::-1])[::-1]
+        components = []
+        if self.state['forward']:
+            components.append(forward)
+        if self.state['last_forward']:
+            components.append(numpy.tile(forward[-1], (n_steps, 1, 1)))
+        if self.state['backward']:
+            components.append(backward)
+        if self.state['last_backward']:
+            components.append(numpy.tile(backward[0], (n_steps, 1, 1)))
+        c = numpy.concatenate(components, axis=2)
+        return [c] + self.source_projections(c)
+
+    def batch_fertility(self, c):
+        fertility = self._dense(c, 'dec_fertility_inputer', sigmoid)
+        return self.state['max_fertility'] * fertility.reshape(c.shape[:2])
+
+    def batch_initializers(self, c):
+        init_c = c[0, :, -self.dim:]
+        if not self.state['bias_code']:
+            return [numpy.zeros_like(init_c)]
+        return [self._dense(init_c, 'dec_initializer_0', activation(self._lookup('dec', 'activ')))]
+
+    def _target_signals(self, words):
+        """The outputs of the layers reading the embedding of the previous
+        words `words`, by name as in Decoder.build_target_tables"""
+        if self.target_tables is not None:
+            return dict((name, table[words]) for name, table in self.target_tables.items())
+        embeddings = self._embed(words, 'dec_approx_embdr')
+        signals = dict(input=self._dense(embeddings, 'dec_input_embdr_0'),
+                update=self._dense(embeddings, 'dec_update_embdr_0'),
+                reset=self._dense(embeddings, 'dec_reset_embdr_0'))
+        if self.state['bigram']:
+            signals['prev_readout'] = self._dense(embeddings, 'dec_prev_readout_0')
+        if self.state.get('use_context_gate', False) and self.state.get('use_previous_target_word_for_context_gate', False):
+            signals['gate_y'] = numpy.dot(embeddings, self.params['GA_y_dec_transition_0'])
+        return signals
+
+    def _transition(self, signals, state_before, ctx):
+        """RecurrentLayerWithSearch.transition_step with the signals of
+        the previous words"""
+        name = 'dec_transition_0'
+        state = self.state
+        state_below = signals['input']
+        updater_below = signals['update']
+        reseter_below = signals['reset']
+        if state.get('use_context_gate', False):
+            gate = numpy.zeros((len(state_before), self.dim), dtype='float32')
+            if state.get('use_previous_target_word_for_context_gate', False):
+                gate += signals['gate_y']
+            if state.get('use_decoding_state_for_context_gate', False):
+                gate += numpy.dot(state_before, self.params['GA_h_' + name])
+            if state.get('use_current_context_for_context_gate', False):
+                gate += numpy.dot(ctx, self.params['GA_c_' + name])
+            gate = self.dec_gater(gate)
+            target_gate = 1. - gate
+            state_before = state_before * target_gate
+            state_below = state_below * target_gate + self._dense(ctx, 'dec_dec_inputer_0') * gate
+            reseter_below = reseter_below * target_gate + self._dense(ctx, 'dec_dec_reseter_0') * gate
+            updater_below = updater_below * target_gate + self._dense(ctx, 'dec_dec_updater_0') * gate
+        else:
+            state_below += self._dense(ctx, 'dec_dec_inputer_0')
+            reseter_below += self._dense(ctx, 'dec_dec_reseter_0')
+            updater_below += self._dense(ctx, 'dec_dec_updater_0')
+
+        reseter = self.dec_reseter(numpy.dot(state_before, self.params['R_' + name]) + reseter_below)
+        h = self.dec_activ(numpy.dot(reseter * state_before, self.params['W_' + name]) + state_below)
+        updater = self.dec_gater(numpy.dot(state_before, self.params['G_' + name]) + updater_below)
+        return updater * h + (1 - updater) * state_before
+
+    def _update_coverage(self, coverage_before, probs, h, cov_projections, fertility):
+        """RecurrentLayerWithSearch.coverage_updater"""
+        name = 'dec_transition_0'
+        state = self.state
+        if not state.get('use_recurrent_coverage', False):
+            if state.get('use_fertility_model', False):
+                probs = probs / fertility
+            if state.get('coverage_accumulated_operation', False) == 'additive':
+                return coverage_before + probs[:, :, None]
+            elif state.get('coverage_accumulated_operation', False) == 'subtractive':
+                return coverage_before - probs[:, :, None]
+            raise Exception("Not a valid accumulated operation: %s" % state.get('coverage_accumulated_operation', False))
+
+        gating = state.get('use_recurrent_gating_coverage', False)
+        shape = coverage_before.shape[:2] + (state['coverage_dim'],)
+        inputs = numpy.zeros(shape, dtype='float32')
+        if gating:
+            gater_below = numpy.zeros(shape, dtype='float32')
+            reseter_below = numpy.zeros(shape, dtype='float32')
+        if state.get('use_probability_for_recurrent_coverage', False):
+            inputs += probs[:, :, None] * self.params['Cov_inputer_p_' + name]
+            if gating:
+                gater_below += probs[:, :, None] * self.params['Cov_updater_p_' + name]
+                reseter_below += probs[:, :, None] * self.params['Cov_reseter_p_' + name]
+        if state.get('use_input_annotations_for_recurrent_coverage', False):
+            inputs += cov_projections[0]
+            if gating:
+                gater_below += cov_projections[1]
+                reseter_below += cov_projections[2]
+        if state.get('use_decoding_state_for_recurrent_coverage', False):
+            inputs += numpy.dot(h, self.params['Cov_inputer_h_' + name])
+            if gating:
+                gater_below += numpy.dot(h, self.params['Cov_updater_h_' + name])
+                reseter_below += numpy.dot(h, self.params['Cov_reseter_h_' + name])
+
+        if not gating:
+            return self.dec_activ(numpy.dot(coverage_before, self.params['Cov_W_' + name]) + inputs)
+        reseter = self.dec_reseter(numpy.dot(coverage_before, self.params['Cov_R_' + name]) + reseter_below)
+        coverage = self.dec_activ(numpy.dot(reseter * coverage_before, self.params['Cov_W_' + name]) + inputs)
+        updater = self.dec_gater(numpy.dot(coverage_before, self.params['Cov_G_' + name]) + gater_below)
+        return updater * coverage + (1 - updater) * coverage_before
+
+    def _attention(self, h, c, c_mask, p_from_c, cov_projections, coverage_before, fertility):
+        """RecurrentLayerWithSearch.attention_step, `c` and its
+        projections are already those of the sentence of each hypothesis"""
+        name = 'dec_transition_0'
+        p = self._buffer('p', p_from_c.shape)
+        numpy.add(p_from_c, numpy.dot(h, self.params['B_' + name]), out=p)
+        if self.state['maintain_coverage']:
+            p += numpy.dot(coverage_before, self.params['C_' + name])
+        numpy.tanh(p, out=p)
+        energy = numpy.exp(numpy.dot(p, self.params['D_' + name])[:, :, 0]) * c_mask
+        probs = energy / energy.sum(axis=0)
+        ctx = numpy.einsum('ijk,ij->jk', c, probs)
+        coverage = None
+        if self.state['maintain_coverage']:
+            coverage = self._update_coverage(coverage_before, probs, h,
+                    cov_projections, fertility)
+        return ctx, probs, coverage
+
+    def _softmax_weights(self, columns):
+        W = self.params.get('W2_' + self.softmax_name, self.params.get('W_' + self.softmax_name))
+        b = self.params['b_' + self.softmax_name]
+        if columns is None:
+            return W, b
+        if self.shortlisted is None or not numpy.array_equal(self.shortlisted[0], columns):
+            W = (W.columns(columns)
+                    if isinstance(W, QuantizedMatrix)
+                    else numpy.ascontiguousarray(W[:, columns]))
+            self.shortlisted = (columns, W, b[columns])
+        return self.shortlisted[1:]
+
+    def step(self, top_k, shortlist, c, c_mask, p_from_c,
+            cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c,
+            hyp_sents, step_num, y, backpointers, prev_state, prev_ctx,
+            coverage_before, fertility, *extra):
+        """The step_fn of RNNEncoderDecoder.create_step_computer, with the
+        same inputs and outputs"""
+        state = self.state
+        extra = list(extra)
+        n_cands = extra.pop(0) if top_k else None
+        columns = extra.pop(0) if shortlist else None
+
+        signals = self._target_signals(y)
+        state_before = prev_state[backpointers]
+        if step_num > 0:
+            h = self._transition(signals, state_before, prev_ctx[backpointers])
+        else:
+            h = state_before
+
+        # Every hypothesis attends over the annotations of its own sentence
+        cov_projections = None
+        if state['maintain_coverage'] and state.get('use_recurrent_coverage', False) and state.get('use_input_annotations_for_recurrent_coverage', False):
+            cov_projections = [self._gather('cov_{}'.format(i), x, hyp_sents)
+                    for i, x in enumerate([cov_inputer_from_c, cov_gater_from_c, cov_reseter_from_c])]
+        ctx, alignment, coverage = self._attention(h,
+                self._gather('c', c, hyp_sents),
+                c_mask[:, hyp_sents],
+                self._gather('p_from_c', p_from_c, hyp_sents),
+                cov_projections,
+                coverage_before[:, backpointers],
+                fertility[:, hyp_sents])
+
+        readout = self._dense(ctx, 'dec_repr_readout')
+        readout += self._dense(h[:, :self.dim], 'dec_hid_readout_0')
+        if state['bigram']:
+            prev_word = signals['prev_readout']
+            if state['check_first_word']:
+                prev_word *= (y > 0)[:, None]
+            readout += prev_word
+        if state['deep_out']:
+            readout = self.unary_activ(readout)
+            if state['dropout'] < 1.:
+                readout *= state['dropout']
+        if 'W1_' + self.softmax_name in self.params:
+            readout = numpy.dot(readout, self.params['W1_' + self.softmax_name])
+        W, b = self._softmax_weights(columns)
+
+        # log-softmax, in place in a work buffer
+        log_probs = self._buffer('log_probs', (len(readout), W.shape[1]))
+        if isinstance(W, QuantizedMatrix):
+            W.dot(readout, out=log_probs)
+        else:
+            numpy.dot(readout, W, out=log_probs)
+        log_probs += b
+        log_probs -= log_probs.max(axis=1, keepdims=True)
+        exps = self._buffer('exps', log_probs.shape)
+        numpy.exp(log_probs, out=exps)
+        log_probs -= numpy.log(exps.sum(axis=1, keepdims=True))
+
+        if top_k:
+            n_cands = min(n_cands, log_probs.shape[1])
+            word_indices = argpartition(-log_probs, n_cands - 1, axis=1)[:, :n_cands]
+            results = [log_probs[numpy.arange(len(log_probs))[:, None], word_indices]]
+            if shortlist:
+                word_indices = columns[word_indices]
+            results.append(word_indices)
+        elif shortlist:
+            results = [log_probs.copy(), numpy.zeros(log_probs.shape, dtype='int64') + columns]
+        else:
+            results = [log_probs.copy()]
+        results += [alignment, h, ctx]
+        if state['maintain_coverage']:
+            results.append(coverage)
+        return results
+
+    # The interface of RNNEncoderDecoder used by BeamSearch.compile
+
+    def create_batch_representation_computer(self):
+        return self.batch_representation
+
+    def create_batch_fertility_computer(self):
+        return self.batch_fertility
+
+    def create_batch_initializers(self):
+        return self.batch_initializers
+
+    def create_step_computer(self, top_k=False, shortlist=False):
+        return functools.partial(self.step, top_k, shortlist)
+
+def check_engine(reference, engine, seqs, n_samples=5, n_steps=10,
+        rtol=1e-3, atol=1e-5):
+    """Compares two sample.BeamSearch, normally one on the compiled Theano
+    functions and one on a NumpyEncoderDecoder, on the source sentences
+    `seqs`: their encodings, then `n_steps` steps continuing the best
+    word of the reference, both steps getting the same inputs.
+    Returns the largest absolute difference of each output, raises
+    ValueError if one of them differs more than numpy.allclose allows."""
+    diffs = {}
+
+    def compare(name, expected, actual):
+        expected = numpy.asarray(expected)
+        actual = numpy.asarray(actual)
+        if expected.shape != actual.shape:
+            raise ValueError("{}: shape {} instead of {}".format(name,
+                actual.shape, expected.shape))
+        diff = float(numpy.abs(expected - actual).max()) if expected.size else 0.
+        diffs[name] = max(diffs.get(name, 0.), diff)
+        if not numpy.allclose(expected, actual, rtol=rtol, atol=atol):
+            raise ValueError("{} differs by up to {}".format(name, diff))
+
+    state = reference.enc_dec.state
+    encoded = reference.encode(seqs)
+    checked = engine.encode(seqs)
+    for name, expected, actual in zip(
+            ['c', 'x_mask', 'p_from_c', 'cov_inputer_from_c', 'cov_gater_from_c', 'cov_reseter_from_c'],
+            encoded.sources, checked.sources):
+        compare(name, expected, actual)
+    for level, (expected, actual) in enumerate(zip(encoded.states, checked.states)):
+        compare('init_state_{}'.format(level), expected, actual)
+    compare('fertility', encoded.fertility, checked.fertility)
+
+    n_sents = len(seqs)
+    num_levels = len(encoded.states)
+    candidates = (reference.shortlist.candidates(seqs)
+            if reference.shortlist is not None
+            else None)
+    hyp_sents = numpy.arange(n_sents)
+    words = numpy.zeros(n_sents, dtype='int64')
+    states = encoded.states
+    contexts = numpy.zeros((n_sents, encoded.sources[0].shape[2]), dtype='float32')
+    coverages = reference.initial_coverages(encoded.sources[0].shape[0], n_sents)
+    for k in range(n_steps):
+        inputs = (encoded.sources, hyp_sents, k, words, hyp_sents,
+                states, contexts, coverages, encoded.fertility, candidates)
+        log_probs, cand_words, outputs = reference.step(n_samples, *inputs)
+        checked_log_probs, _, checked_outputs = engine.step(n_samples, *inputs)
+        # the candidates of top_k come in no particular order
+        compare('log_probs', numpy.sort(log_probs, axis=1),
+                numpy.sort(checked_log_probs, axis=1))
+        names = (['alignment'] + ['state_{}'.format(level) for level in range(num_levels)]
+                + ['context', 'coverage'])
+        for name, expected, actual in zip(names, outputs, checked_outputs):
+            compare(name, expected, actual)
+
+        best = log_probs.argmax(axis=1)
+        words = best if cand_words is None else cand_words[hyp_sents, best]
+        states = list(outputs[1:1 + num_levels])
+        contexts = outputs[1 + num_levels]
+        if state['maintain_coverage']:
+            coverages = outputs[-1]
+    return diffs
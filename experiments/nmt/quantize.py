@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Quantization of the largest matrices of a model for CPU decoding.
+
+The approximate embeddings of the source and target words and the
+weights of the softmax are the largest matrices of a model, and the
+beam search mostly waits for them to come from memory. This script
+writes a copy of a model saved by Container.save in which they are
+stored in int8, each column with its own scale, or in float16:
+
+    python quantize.py --state search_state.pkl model.npz model.int8.npz
+
+`sample.py --quantized model.int8.npz` searches with them, with the
+NumPy engine. Given a development set, the script also translates it
+with both models and reports the difference of BLEU and of speed:
+
+    python quantize.py --state search_state.pkl --dev-source dev.src \\
+        --dev-ref dev.ref0 dev.ref1 model.npz model.int8.npz
+"""
+
+import argparse
+import collections
+import logging
+import pickle
+import time
+
+import numpy
+
+from experiments.nmt import\
+    RNNEncoderDecoder,\
+    prototype_search_with_coverage_state,\
+    parse_input
+from experiments.nmt.numpy_engine import NumpyEncoderDecoder, load_params, quantize
+from experiments.nmt.sample import BeamSearch, batched_translations
+
+logger = logging.getLogger(__name__)
+
+def quantized_names(state):
+    """The names of the parameters worth quantizing"""
+    softmax = 'dec_deep_softmax' if state['deep_out'] else 'dec_softmax'
+    return ['W_0_enc_approx_embdr', 'W_0_dec_approx_embdr',
+            'W1_' + softmax, 'W2_' + softmax, 'W_' + softmax]
+
+def quantize_model(state, params, dtype):
+    """Returns the arrays of the quantized model, by name"""
+    names = quantized_names(state)
+    arrays = {}
+    for name, value in params.items():
+        if name in names:
+            for suffix, array in quantize(value, dtype).items():
+                arrays['{}.{}'.format(name, suffix)] = array
+        else:
+            arrays[name] = value
+    return arrays
+
+def ngrams(words, n):
+    return collections.Counter(tuple(words[i:i + n]) for i in range(len(words) - n + 1))
+
+def corpus_bleu(hypotheses, references, max_n=4):
+    """BLEU of the tokenized `hypotheses`, `references` has a list of
+    tokenized references for each of them. The brevity penalty uses the
+    reference length closest to the hypothesis length"""
+    matches = numpy.zeros(max_n)
+    totals = numpy.zeros(max_n)
+    hyp_len = ref_len = 0
+    for hyp, refs in zip(hypotheses, references):
+        hyp_len += len(hyp)
+        ref_len += min((abs(len(ref) - len(hyp)), len(ref)) for ref in refs)[1]
+        for n in range(1, max_n + 1):
+            max_ref_counts = collections.Counter()
+            for ref in refs:
+                max_ref_counts |= ngrams(ref, n)
+            counts = ngrams(hyp, n)
+            matches[n - 1] += sum(min(count, max_ref_counts[gram])
+                    for gram, count in counts.items())
+            totals[n - 1] += max(len(hyp) - n + 1, 0)
+    if not hyp_len or not matches.all():
+        return 0.
+    brevity = min(0., 1. - float(ref_len) / hyp_len)
+    return 100. * numpy.exp(brevity + numpy.log(matches / totals).mean())
+
+def bleu_report(lm_model, state, models, seqs, references, beam_size, batch_size):
+    """Translates `seqs` with the NumPy engine on each (name, params) of
+    `models`, returns a (name, BLEU, seconds) row for each"""
+    rows = []
+    for name, params in models:
+        beam_search = BeamSearch(NumpyEncoderDecoder(state, params))
+        beam_search.compile()
+        start_time = time.time()
+        hypotheses = []
+        for _, result, _ in batched_translations(lm_model, beam_search, seqs,
+                beam_size, batch_size):
+            trans, costs = result[0], result[2]
+            hypotheses.append(trans[numpy.argmin(costs)].split() if len(trans) else [])
+        elapsed = time.time() - start_time
+        rows.append((name, corpus_bleu(hypotheses, references), elapsed))
+        logger.debug("{}: BLEU {:.2f}, {:.1f}s".format(*rows[-1]))
+    return rows
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Quantize the embeddings and the softmax weights of a model")
+    parser.add_argument("--state",
+            required=True, help="State to use")
+    parser.add_argument("--dtype",
+            choices=['int8', 'float16'], default='int8',
+            help="Type the matrices are stored in")
+    parser.add_argument("--dev-source",
+            help="File of source sentences to compare the models on")
+    parser.add_argument("--dev-ref",
+            nargs="+", help="Files of reference translations of --dev-source")
+    parser.add_argument("--beam-size",
+            type=int, default=10, help="Beam size of the comparison")
+    parser.add_argument("--batch-size",
+            type=int, default=16,
+            help="Number of source sentences searched together")
+    parser.add_argument("model_path",
+            help="Path to the model")
+    parser.add_argument("output",
+            help="File to save the quantized model in")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    state = prototype_search_with_coverage_state()
+    with open(args.state, 'rb') as src:
+        state.update(pickle.load(src))
+    state.update(eval("dict({})".format(args.changes)))
+
+    logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    model = numpy.load(args.model_path)
+    params = dict((name, model[name]) for name in model.files)
+    arrays = quantize_model(state, params, args.dtype)
+    numpy.savez(args.output, **arrays)
+    logger.debug("{} bytes of parameters instead of {}".format(
+        sum(array.nbytes for array in arrays.values()),
+        sum(array.nbytes for array in params.values())))
+
+    if args.dev_source:
+        assert args.dev_ref
+        rng = numpy.random.RandomState(state['seed'])
+        enc_dec = RNNEncoderDecoder(state, rng, skip_init=True)
+        enc_dec.build(mode='sample')
+        lm_model = enc_dec.create_lm_model()
+        indx_word = pickle.load(open(state['word_indx'], 'rb'))
+        with open(args.dev_source) as src:
+            seqs = [parse_input(state, indx_word, line.strip())[0] for line in src]
+        ref_files = [open(path) for path in args.dev_ref]
+        references = [[line.split() for line in lines] for lines in zip(*ref_files)]
+        for ref_file in ref_files:
+            ref_file.close()
+
+        rows = bleu_report(lm_model, state,
+                [('float32', params), (args.dtype, load_params(args.output))],
+                seqs, references, args.beam_size, args.batch_size)
+        for name, bleu, elapsed in rows:
+            print("{:8s} BLEU {:6.2f} {:8.1f}s".format(name, bleu, elapsed))
+        (_, base_bleu, base_time), (_, bleu, elapsed) = rows
+        print("BLEU delta {:+.2f}, speedup {:.2f}x".format(bleu - base_bleu,
+            base_time / elapsed if elapsed else 0.))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Rescoring of n-best lists with a model.
+
+Reads an n-best list in the Moses format, whose first field is the index
+of a line of --source,
+
+    0 ||| a translation ||| LM0= -12.3 TM0= -4.5 ||| -3.4
+
+and writes it back, in the same order, with the cost of each hypothesis
+under the model (minus its log-probability) added to its features:
+
+    python rescore.py --state search_state.pkl --source test.src \\
+        --nbest test.nbest model.npz > test.rescored.nbest
+
+The hypotheses of a source sentence follow each other in the list. The
+source sentences of --window consecutive groups are encoded once, in a
+single batch, then their hypotheses are scored in batches of similar
+length on these annotations, see RNNEncoderDecoder.create_encoded_scorer.
+
+--normalize adds the cost divided by the number of target words,
+--coverage-penalty the coverage penalty of Wu et al. (2016): the sum over
+the source words of the logarithm of the attention they got, capped at
+one.
+"""
+
+import argparse
+import itertools
+import logging
+import pickle
+import sys
+import time
+
+import numpy
+
+from experiments.nmt import\
+    RNNEncoderDecoder,\
+    prototype_search_with_coverage_state,\
+    parse_input,\
+    parse_target
+from experiments.nmt.force_decoding import pad_batch
+
+logger = logging.getLogger(__name__)
+
+class NbestEntry(object):
+    """A hypothesis of an n-best list, and the fields of its line"""
+
+    def __init__(self, line):
+        self.fields = line.rstrip('\n').split(' ||| ')
+        if len(self.fields) < 2:
+            raise ValueError("Not an n-best line: {}".format(line))
+        self.source = int(self.fields[0])
+        self.hypothesis = self.fields[1].strip()
+
+    def line(self, features):
+        """The line of the entry with the `features`, a list of
+        (name, value), added to its features"""
+        fields = list(self.fields)
+        if len(fields) < 3:
+            fields.append('')
+        fields[2] = " ".join([fields[2].strip()] +
+                ["{}= {:.6f}".format(name, value) for name, value in features]).strip()
+        return " ||| ".join(fields)
+
+def windows(entries, n_sources):
+    """Cuts the stream of `entries` in lists holding the hypotheses of at
+    most `n_sources` consecutive source sentences"""
+    window = []
+    n_groups = 0
+    for source, group in itertools.groupby(entries, key=lambda entry: entry.source):
+        window.extend(group)
+        n_groups += 1
+        if n_groups == n_sources:
+            yield window
+            window = []
+            n_groups = 0
+    if window:
+        yield window
+
+class Rescorer(object):
+
+    def __init__(self, enc_dec, batch_size=64):
+        self.enc_dec = enc_dec
+        self.batch_size = batch_size
+
+    def compile(self):
+        self.comp_repr = self.enc_dec.create_batch_representation_computer()
+        self.comp_score = self.enc_dec.create_encoded_scorer()
+
+    def score(self, seqs, hyps, hyp_sents):
+        """The costs of the target sentences `hyps` given the source
+        sentences `seqs`, `hyp_sents` holds the index in `seqs` of the
+        source of each of them. Each source sentence is encoded once.
+        Returns the costs and the attention each source position got
+        (a list of vectors), None if the alignment is not computed"""
+        state = self.enc_dec.state
+        x, x_mask = pad_batch(seqs, state['null_sym_source'])
+        c = self.comp_repr(x, x_mask)[0]
+
+        costs = numpy.zeros(len(hyps), dtype='float32')
+        attention = [None] * len(hyps)
+        order = numpy.argsort([len(hyp) for hyp in hyps], kind='mergesort')
+        for start in range(0, len(hyps), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            y, y_mask = pad_batch([hyps[i] for i in indices], state['null_sym_target'])
+            outputs = self.comp_score(c, x_mask, hyp_sents[indices], y, y_mask)
+            costs[indices] = outputs[0]
+            if len(outputs) > 1:
+                for k, i in enumerate(indices):
+                    attention[i] = outputs[1][:len(seqs[hyp_sents[i]]), k]
+        return costs, attention
+
+def coverage_penalty(attention):
+    return float(numpy.log(numpy.clip(attention, 1e-10, 1.)).sum())
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Add the costs of a model to the hypotheses of an n-best list")
+    parser.add_argument("--state",
+            required=True, help="State to use")
+    parser.add_argument("--source",
+            required=True, help="File of source sentences")
+    parser.add_argument("--nbest",
+            help="N-best list in the Moses format, read from the standard "
+                 "input by default")
+    parser.add_argument("--output",
+            help="File to write the rescored n-best list in, the standard "
+                 "output by default")
+    parser.add_argument("--batch-size",
+            type=int, default=64,
+            help="Number of hypotheses scored together")
+    parser.add_argument("--window",
+            type=int, default=32,
+            help="Number of source sentences encoded together")
+    parser.add_argument("--feature-name",
+            default="NMT", help="Name of the cost in the n-best list")
+    parser.add_argument("--normalize",
+            action="store_true", default=False,
+            help="Also add the cost divided by the number of target words")
+    parser.add_argument("--coverage-penalty",
+            action="store_true", default=False,
+            help="Also add the coverage penalty of the hypothesis")
+    parser.add_argument("model_path",
+            help="Path to the model")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    state = prototype_search_with_coverage_state()
+    with open(args.state, 'rb') as src:
+        state.update(pickle.load(src))
+    state.update(eval("dict({})".format(args.changes)))
+
+    logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    rng = numpy.random.RandomState(state['seed'])
+    enc_dec = RNNEncoderDecoder(state, rng, skip_init=True,
+            compute_alignment=args.coverage_penalty)
+    enc_dec.build(mode='beam_search')
+    lm_model = enc_dec.create_lm_model()
+    lm_model.load(args.model_path)
+    indx_word = pickle.load(open(state['word_indx'], 'rb'))
+    t_indx_word = pickle.load(open(state['word_indx_trgt'], 'rb'))
+
+    rescorer = Rescorer(enc_dec, batch_size=args.batch_size)
+    rescorer.compile()
+
+    with open(args.source) as src:
+        sources = [parse_input(state, indx_word, line.strip())[0] for line in src]
+
+    fnbest = open(args.nbest) if args.nbest else sys.stdin
+    fout = open(args.output, 'w') if args.output else sys.stdout
+    start_time = time.time()
+    n_hyps = 0
+    for window in windows((NbestEntry(line) for line in fnbest if line.strip()), args.window):
+        sent_indices = sorted(set(entry.source for entry in window))
+        position = dict((sent, k) for k, sent in enumerate(sent_indices))
+        hyps = [parse_target(state, t_indx_word, entry.hypothesis)[0] for entry in window]
+        hyp_sents = numpy.array([position[entry.source] for entry in window], dtype='int64')
+        costs, attention = rescorer.score([sources[sent] for sent in sent_indices],
+                hyps, hyp_sents)
+        for i, entry in enumerate(window):
+            features = [(args.feature_name, costs[i])]
+            if args.normalize:
+                features.append((args.feature_name + "Norm", costs[i] / len(hyps[i])))
+            if args.coverage_penalty:
+                features.append((args.feature_name + "Coverage", coverage_penalty(attention[i])))
+            print(entry.line(features), file=fout)
+        n_hyps += len(window)
+        logger.debug("{} hypotheses, {} per second".format(
+            n_hyps, n_hyps / (time.time() - start_time)))
+
+    if args.nbest:
+        fnbest.close()
+    if args.output:
+        fout.close()
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,25 @@ import argparse
 import pickle
 import traceback
 import logging
+import multiprocessing
+import os
 import time
 import sys
 
+BLAS_THREADS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+if __name__ == "__main__":
+    # The BLAS libraries size their thread pools when numpy and theano
+    # load them, which the forked workers inherit, so the number of
+    # threads of the workers has to be set before
+    _parser = argparse.ArgumentParser(add_help=False)
+    _parser.add_argument("--workers", type=int, default=1)
+    _parser.add_argument("--blas-threads", type=int, default=1)
+    _args = _parser.parse_known_args()[0]
+    if _args.workers > 1:
+        for name in BLAS_THREADS_VARIABLES:
+            os.environ[name] = str(_args.blas_threads)
+
 import numpy
 
 import experiments.nmt
@@ -16,7 +32,16 @@ from experiments.nmt import\
     prototype_search_with_coverage_state,\
     parse_input
 
+from experiments.nmt.ensemble import EnsembleEncoderDecoder
 from experiments.nmt.numpy_compat import argpartition
+from experiments.nmt.numpy_engine import NumpyEncoderDecoder, check_engine
+from experiments.nmt.shortlist import Shortlist
+from experiments.nmt.translation_cache import TranslationCache, checkpoint_hash
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 logger = logging.getLogger(__name__)
 
@@ -33,168 +58,576 @@ class Timer(object):
 
 class BeamSearch(object):
 
-    def __init__(self, enc_dec):
+    def __init__(self, enc_dec, top_k=True, shortlist=None,
+            prune_finished=False, prune_relative=None, prune_absolute=None,
+            length_ratio=None, ensemble_weights=None):
+        """`enc_dec` is an RNNEncoderDecoder built for beam search, or a
+        numpy_engine.NumpyEncoderDecoder, or a list of them searched as an
+        ensemble.EnsembleEncoderDecoder with the `ensemble_weights`.
+        If `top_k` is set, the step computer returns only the best
+        candidates of each hypothesis instead of the whole distribution.
+        `shortlist` is an optional shortlist.Shortlist, without it the
+        softmax is computed over the whole target vocabulary.
+
+        Pruning of the live hypotheses of a sentence, all off by default:
+        `prune_finished` drops the ones which already cost more than its
+        best finished translation (costs only grow), `prune_relative`
+        the ones less probable than this fraction of the best candidate
+        of the step, `prune_absolute` the ones costing more than the best
+        candidate of the step plus this margin. `length_ratio` limits
+        the translation length to this many words per source word
+        instead of three."""
+        if isinstance(enc_dec, (list, tuple)):
+            enc_dec = EnsembleEncoderDecoder(enc_dec, weights=ensemble_weights)
         self.enc_dec = enc_dec
         state = self.enc_dec.state
         self.eos_id = state['null_sym_target']
         self.unk_id = state['unk_sym_target']
+        self.top_k = top_k
+        self.shortlist = shortlist
+        self.prune_finished = prune_finished
+        self.prune_relative = prune_relative
+        self.prune_absolute = prune_absolute
+        self.length_ratio = length_ratio
+        # Statistics of the last call of batch_search, one dict per sentence
+        self.last_stats = []
 
     def compile(self):
-        self.comp_repr = self.enc_dec.create_representation_computer()
+        self.comp_repr = self.enc_dec.create_batch_representation_computer()
         # added by Zhaopeng Tu, 2015-12-17, for fertility
         if self.enc_dec.state['maintain_coverage'] and self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
-            self.comp_fert = self.enc_dec.create_fertility_computer()
-        self.comp_init_states = self.enc_dec.create_initializers()
-        self.comp_next_probs = self.enc_dec.create_next_probs_computer()
-        self.comp_next_states = self.enc_dec.create_next_states_computer()
+            self.comp_fert = self.enc_dec.create_batch_fertility_computer()
+        self.comp_init_states = self.enc_dec.create_batch_initializers()
+        self.comp_step = self.enc_dec.create_step_computer(top_k=self.top_k,
+                shortlist=self.shortlist is not None)
+
+    def step(self, n_samples, sources, hyp_sents, k, words, backpointers,
+            states, contexts, coverages, fertility, candidates=None):
+        """Calls the step computer, returns the log-probs of the candidate
+        words, the candidate words (None if the log-probs cover the whole
+        vocabulary) and the rest of its outputs"""
+        inputs = (sources + [hyp_sents, k, words, backpointers]
+                + states + [contexts, coverages, fertility])
+        if self.top_k:
+            # Two extra candidates per hypothesis, so that a full beam is
+            # left after removing UNK and a too early end of sentence
+            n_cands = n_samples + 2
+            if candidates is not None:
+                n_cands = min(n_cands, len(candidates))
+            inputs.append(n_cands)
+        if candidates is not None:
+            inputs.append(candidates)
+        outputs = self.comp_step(*inputs)
+        if not self.top_k and candidates is None:
+            return outputs[0], None, outputs[1:]
+        return outputs[0], outputs[1], outputs[2:]
 
     def search(self, seq, n_samples, ignore_unk=False, minlen=1):
-        c = self.comp_repr(seq)[0]
-        states = [x[None, :] for x in self.comp_init_states(c)]
-        dim = states[0].shape[1]
-        # added by Zhaopeng Tu, 2015-11-02
-        if self.enc_dec.state['maintain_coverage']:
-            coverage_dim = self.enc_dec.state['coverage_dim']
-            if self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['coverage_accumulated_operation'] == 'subtractive':
-                coverages = numpy.ones((c.shape[0], 1, coverage_dim), dtype='float32')
-            else:
-                coverages = numpy.zeros((c.shape[0], 1, coverage_dim), dtype='float32')
-            fin_coverages = []
+        return self.batch_search([seq], n_samples, ignore_unk, [minlen])[0]
+
+    def batch_search(self, seqs, n_samples, ignore_unk=False, minlens=None):
+        """Beam search for several source sentences at once.
+
+        The beams of all the sentences are kept in one flat matrix of
+        hypotheses, `hyp_sents` tells which sentence each row belongs to,
+        so every step is a single call of the step computer.
+        Returns a list with the result of `search` for each sentence,
+        in the order of `seqs`, and sets `last_stats` to their search
+        statistics.
+        """
+        if minlens is None:
+            minlens = [1] * len(seqs)
+        minlens = numpy.asarray(minlens)
+        encoded = self.encode(seqs)
+        lens = encoded.lens
+        if self.length_ratio:
+            # the source and the translation both end with the null symbol
+            max_steps = numpy.maximum(
+                    numpy.ceil(self.length_ratio * (lens - 1)).astype('int64') + 1,
+                    numpy.ceil(minlens).astype('int64') + 1)
         else:
-            coverages = None
-        
-        if self.enc_dec.state['maintain_coverage'] and self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
+            max_steps = 3 * lens
+        results, self.last_stats = self.search_encoded(encoded, n_samples,
+                ignore_unk, minlens, max_steps)
+        return results
+
+    def encode(self, seqs):
+        """Encodes the source sentences, the result is all the search
+        needs from the encoder, and is reused when a search is retried"""
+        state = self.enc_dec.state
+        n_sents = len(seqs)
+        lens = numpy.array([len(seq) for seq in seqs])
+        x, x_mask = pad_sources(state, seqs)
+
+        # the annotations and their projections used by the attention
+        reprs = self.comp_repr(x, x_mask)
+        c = reprs[0]
+        sources = [c, x_mask] + list(reprs[1:])
+        states = list(self.comp_init_states(c))
+        if state['maintain_coverage'] and state['use_linguistic_coverage'] and state['use_fertility_model']:
             fertility = self.comp_fert(c)
         else:
-            fertility = None
+            fertility = numpy.zeros((c.shape[0], n_sents), dtype='float32')
+        return SourceEncoding(seqs, lens, sources, states, fertility)
 
-        num_levels = len(states)
+    def search_encoded(self, encoded, n_samples, ignore_unk, minlens, max_steps,
+            resumed=None):
+        """The search stage of batch_search. Returns the results and the
+        statistics of the sentences of `encoded`.
 
-        fin_trans = []
-        fin_costs = []
-        fin_aligns = []
+        `resumed`, for a single sentence, holds the beam of an earlier
+        search which ran out of steps. The search then continues its
+        hypotheses, for at most `max_steps` further steps, and is not
+        resumed again if it runs out of them too.
+        """
+        state = self.enc_dec.state
+        seqs = encoded.seqs
+        lens = encoded.lens
+        n_sents = len(seqs)
+        sources = encoded.sources
+        fertility = encoded.fertility
+        c = sources[0]
+        source_len = c.shape[0]
+        num_levels = len(encoded.states)
 
-        trans = [[]]
-        aligns = [[]]
-        costs = [0.0]
+        # Target words the softmax is computed over
+        candidates = (self.shortlist.candidates(seqs)
+                if self.shortlist is not None
+                else None)
 
-        for k in range(3 * len(seq)):
-            if n_samples == 0:
-                break
+        # Per-sentence beam width, shrinks as hypotheses finish
+        beam_left = numpy.zeros(n_sents, dtype='int64') + n_samples
+        # (step, slot) of the finished hypotheses of each sentence
+        fin_hyps = [[] for i in range(n_sents)]
+        fin_costs = [[] for i in range(n_sents)]
+        fin_coverages = [[] for i in range(n_sents)]
+        # Hypotheses alive when a sentence ran out of steps,
+        # used only if none of them finished
+        last_hyps = [[] for i in range(n_sents)]
+        last_costs = [[] for i in range(n_sents)]
+        last_coverages = [[] for i in range(n_sents)]
+        # and what is needed to continue them
+        last_beams = [[] for i in range(n_sents)]
+        best_finished = numpy.zeros(n_sents, dtype='float32') + numpy.inf
+        stats = [dict(max_steps=int(max_steps[sent]), steps=0, expanded=0,
+                    pruned_finished=0, pruned_relative=0, pruned_absolute=0,
+                    retries=0)
+                for sent in range(n_sents)]
+
+        if resumed is None:
+            k = 0
+            store = HypothesisStore(max_steps.max(), n_sents * n_samples, source_len)
+            hyp_sents = numpy.arange(n_sents)
+            live_slots = numpy.zeros(n_sents, dtype='int64')
+            costs = numpy.zeros(n_sents, dtype='float32')
+            last_words = numpy.zeros(n_sents, dtype='int64')
+            backpointers = numpy.arange(n_sents)
+            states = encoded.states
+            contexts = numpy.zeros((n_sents, c.shape[2]), dtype='float32')
+            coverages = self.initial_coverages(source_len, n_sents)
+        else:
+            assert n_sents == 1
+            k = resumed.steps
+            max_steps = max_steps + k
+            stats[0]['max_steps'] = int(max_steps[0])
+            n_hyps = len(resumed.costs)
+            store = HypothesisStore(max_steps.max(), n_samples, source_len)
+            store.set_prefixes(resumed.prefixes, resumed.prefix_aligns)
+            hyp_sents = numpy.zeros(n_hyps, dtype='int64')
+            live_slots = numpy.arange(n_hyps)
+            costs = resumed.costs
+            last_words = resumed.words
+            backpointers = numpy.arange(n_hyps)
+            states = resumed.states
+            contexts = resumed.contexts
+            coverages = resumed.coverages
+
+        # The first call of a new search only attends with the initial states
+        step_results = self.step(n_samples, sources, hyp_sents, k,
+                last_words, backpointers, states, contexts, coverages, fertility,
+                candidates)
 
-            # Compute probabilities of the next words for
-            # all the elements of the beam.
-            beam_size = len(trans)
-            last_words = (numpy.array([t[-1] for t in trans])
-                    if k > 0
-                    else numpy.zeros(beam_size, dtype="int64"))
-            results = self.comp_next_probs(c, k, last_words, *states, coverage_before=coverages, fertility=fertility)
-            log_probs = numpy.log(results[0])
-            # alignment shape: (source_len, beam_size)
-            alignment = results[1]
+        while True:
+            # log_probs shape: (n_hyps, n_cands), the candidates are the
+            # words of cand_words or, if it is None, the whole vocabulary
+            log_probs, cand_words, outputs = step_results
+            # alignment shape: (source_len, n_hyps)
+            alignment = outputs[0]
+            states = list(outputs[1:1 + num_levels])
+            contexts = outputs[1 + num_levels]
+            if state['maintain_coverage']:
+                coverages = outputs[-1]
 
             # Adjust log probs according to search restrictions
-            if ignore_unk:
-                log_probs[:,self.unk_id] = -numpy.inf
             # TODO: report me in the paper!!!
-            if k < minlen:
-                log_probs[:,self.eos_id] = -numpy.inf
-
-            # Find the best options by calling argpartition of flatten array
-            next_costs = numpy.array(costs)[:, None] - log_probs
-            flat_next_costs = next_costs.flatten()
-            best_costs_indices = argpartition(
-                    flat_next_costs.flatten(),
-                    n_samples)[:n_samples]
-
-            # Decypher flatten indices
-            voc_size = log_probs.shape[1]
-            trans_indices = best_costs_indices / voc_size
-            word_indices = best_costs_indices % voc_size
-            costs = flat_next_costs[best_costs_indices]
-
-            # Form a beam for the next iteration
-            new_trans = [[]] * n_samples
-
-            new_aligns = [[]] * n_samples
-            new_costs = numpy.zeros(n_samples)
-            new_states = [numpy.zeros((n_samples, dim), dtype="float32") for level
-                    in range(num_levels)]
-            inputs = numpy.zeros(n_samples, dtype="int64")
-            if self.enc_dec.state['maintain_coverage']:
-                new_coverages = numpy.zeros((c.shape[0], n_samples, coverage_dim), dtype='float32')
+            too_short = k < minlens[hyp_sents]
+            if cand_words is None:
+                if ignore_unk:
+                    log_probs[:, self.unk_id] = -numpy.inf
+                log_probs[too_short, self.eos_id] = -numpy.inf
             else:
-                new_coverages = None
-            for i, (orig_idx, next_word, next_cost) in enumerate(
-                    zip(trans_indices, word_indices, costs)):
-                new_trans[i] = trans[orig_idx] + [next_word]
-                # alignment shape: (source_len, beam_size)
-                new_aligns[i] = aligns[orig_idx] + [alignment[:,orig_idx]]
-                new_costs[i] = next_cost
-                for level in range(num_levels):
-                    new_states[level][i] = states[level][orig_idx]
-                inputs[i] = next_word
-                if self.enc_dec.state['maintain_coverage']:
-                    new_coverages[:,i,:] = coverages[:,orig_idx,:]
-            new_states = self.comp_next_states(c, k, inputs, *new_states, coverage_before=new_coverages, fertility=fertility)
-            if self.enc_dec.state['maintain_coverage']:
-                new_coverages = new_states[-1]
-                new_states = new_states[:-1]
+                if ignore_unk:
+                    log_probs[cand_words == self.unk_id] = -numpy.inf
+                log_probs[(cand_words == self.eos_id) & too_short[:, None]] = -numpy.inf
+
+            next_costs = costs[:, None] - log_probs
+            n_cands = log_probs.shape[1]
+            hyps_per_sent = numpy.bincount(hyp_sents, minlength=n_sents)
+            for sent in hyps_per_sent.nonzero()[0]:
+                stats[sent]['steps'] += 1
+                stats[sent]['expanded'] += int(hyps_per_sent[sent])
+
+            # Choose the best continuations separately for each sentence
+            trans_indices = []
+            cand_indices = []
+            best_step = numpy.zeros(n_sents, dtype='float32') + numpy.inf
+            for sent in numpy.unique(hyp_sents):
+                rows = (hyp_sents == sent).nonzero()[0]
+                flat_next_costs = next_costs[rows].flatten()
+                best_costs_indices = argpartition(flat_next_costs,
+                        beam_left[sent])[:beam_left[sent]]
+                best_step[sent] = flat_next_costs[best_costs_indices].min()
+                trans_indices.append(rows[best_costs_indices // n_cands])
+                cand_indices.append(best_costs_indices % n_cands)
+            trans_indices = numpy.concatenate(trans_indices)
+            cand_indices = numpy.concatenate(cand_indices)
+            new_costs = next_costs[trans_indices, cand_indices]
+            word_indices = (cand_indices
+                    if cand_words is None
+                    else cand_words[trans_indices, cand_indices])
+            new_hyp_sents = hyp_sents[trans_indices]
+            store.add(k, live_slots[trans_indices], word_indices, new_costs,
+                    alignment[:, trans_indices].T)
 
             # Filter the sequences that end with end-of-sequence character
-            trans = []
-            aligns = []
-            costs = []
-            indices = []
-            for i in range(n_samples):
-                if new_trans[i][-1] != self.enc_dec.state['null_sym_target']:
-                    trans.append(new_trans[i])
-                    aligns.append(new_aligns[i])
-                    costs.append(new_costs[i])
-                    indices.append(i)
+            finished = word_indices == self.eos_id
+            for i in finished.nonzero()[0]:
+                sent = new_hyp_sents[i]
+                beam_left[sent] -= 1
+                fin_hyps[sent].append((k, i))
+                fin_costs[sent].append(new_costs[i])
+                best_finished[sent] = min(best_finished[sent], new_costs[i])
+                if state['maintain_coverage']:
+                    fin_coverages[sent].append(coverages[:lens[sent], trans_indices[i], 0])
+            live_slots = (~finished).nonzero()[0]
+            backpointers = trans_indices[live_slots]
+            last_words = word_indices[live_slots]
+            hyp_sents = new_hyp_sents[live_slots]
+            costs = new_costs[live_slots]
+            k += 1
+
+            # Prune the hypotheses which are unlikely to give the best translation
+            keep = numpy.ones(len(live_slots), dtype='bool')
+            if self.prune_finished:
+                keep = self._prune(keep, costs >= best_finished[hyp_sents],
+                        hyp_sents, stats, 'pruned_finished')
+            if self.prune_relative:
+                keep = self._prune(keep,
+                        costs > best_step[hyp_sents] - numpy.log(self.prune_relative),
+                        hyp_sents, stats, 'pruned_relative')
+            if self.prune_absolute:
+                keep = self._prune(keep,
+                        costs > best_step[hyp_sents] + self.prune_absolute,
+                        hyp_sents, stats, 'pruned_absolute')
+
+            # Drop the sentences which ran out of steps
+            alive = keep & (k < max_steps[hyp_sents])
+            for i in (keep & ~alive).nonzero()[0]:
+                sent = hyp_sents[i]
+                if not len(fin_hyps[sent]):
+                    last_hyps[sent].append((k - 1, live_slots[i]))
+                    last_costs[sent].append(costs[i])
+                    if state['maintain_coverage']:
+                        last_coverages[sent].append(coverages[:lens[sent], backpointers[i], 0])
+                    last_beams[sent].append((last_words[i],
+                        [x[backpointers[i]] for x in states],
+                        contexts[backpointers[i]],
+                        coverages[:, backpointers[i]]))
+            alive_indices = alive.nonzero()[0]
+            if not len(alive_indices):
+                break
+            live_slots = live_slots[alive_indices]
+            backpointers = backpointers[alive_indices]
+            last_words = last_words[alive_indices]
+            hyp_sents = hyp_sents[alive_indices]
+            costs = costs[alive_indices]
+
+            # Extend the chosen hypotheses and look at the next words
+            step_results = self.step(n_samples, sources, hyp_sents, k,
+                    last_words, backpointers, states, contexts, coverages, fertility,
+                    candidates)
+
+        # Dirty tricks to obtain any translation, the encoder is not run
+        # again and a wider beam continues the hypotheses of the last one
+        retried = {}
+        failed = [sent for sent in range(n_sents) if not len(fin_hyps[sent])]
+        if len(failed) and ignore_unk:
+            logger.warning("Did not manage without UNK")
+            retry_results, retry_stats = self.search_encoded(encoded.select(failed),
+                    n_samples, False, minlens[failed], max_steps[failed])
+            retried.update(zip(failed, zip(retry_results, retry_stats)))
+        elif len(failed) and n_samples < 100 and resumed is None:
+            # The wider beam gets the step budget of the sentence once
+            # more, so that a sentence takes at most twice its limit
+            logger.warning("Still no translations: try beam size {}".format(n_samples * 2))
+            for sent in failed:
+                if not len(last_beams[sent]):
+                    # pruned away, nothing to continue
+                    continue
+                resumed = ResumedBeam(
+                        [store.backtrack(*hyp) for hyp in last_hyps[sent]],
+                        numpy.array(last_costs[sent], dtype='float32'),
+                        last_beams[sent])
+                retry_results, retry_stats = self.search_encoded(encoded.select([sent]),
+                        n_samples * 2, False, minlens[[sent]], max_steps[[sent]],
+                        resumed=resumed)
+                retried[sent] = (retry_results[0], retry_stats[0])
+
+        results = []
+        for sent, seq in enumerate(seqs):
+            if sent in retried:
+                result, retry_stats = retried[sent]
+                results.append(result)
+                stats[sent] = self._retry_stats(stats[sent], retry_stats)
+                continue
+            hyps = fin_hyps[sent]
+            hyp_costs = fin_costs[sent]
+            hyp_coverages = fin_coverages[sent]
+            if not len(hyps):
+                hyps = last_hyps[sent]
+                hyp_costs = last_costs[sent]
+                hyp_coverages = last_coverages[sent]
+                logger.error("Translation failed")
+
+            order = numpy.argsort(hyp_costs)
+            sent_trans = []
+            sent_aligns = []
+            for i in order:
+                trans, aligns = store.backtrack(*hyps[i])
+                sent_trans.append(trans)
+                sent_aligns.append(aligns[:, :lens[sent]])
+            sent_costs = numpy.array(hyp_costs)[order]
+            if state['maintain_coverage']:
+                sent_coverages = numpy.array(hyp_coverages)[order]
+                if state['use_linguistic_coverage'] and state['use_fertility_model']:
+                    results.append((sent_trans, sent_aligns, sent_costs, sent_coverages,
+                        fertility[:lens[sent], sent]))
                 else:
-                    n_samples -= 1
-                    fin_trans.append(new_trans[i])
-                    fin_aligns.append(new_aligns[i])
-                    fin_costs.append(new_costs[i])
-                    if self.enc_dec.state['maintain_coverage']:
-                        fin_coverages.append(new_coverages[:,i,0])
-            states = [x[indices] for x in new_states]
-
-            if self.enc_dec.state['maintain_coverage']:
-                coverages = numpy.zeros((c.shape[0], n_samples, coverage_dim), dtype='float32')
-                for i in range(n_samples):
-                    coverages[:,i,:] = new_coverages[:, indices[i], :]
-
-        # Dirty tricks to obtain any translation
-        if not len(fin_trans):
-            if ignore_unk:
-                logger.warning("Did not manage without UNK")
-                return self.search(seq, n_samples, False, minlen)
-            elif n_samples < 100:
-                logger.warning("Still no translations: try beam size {}".format(n_samples * 2))
-                return self.search(seq, n_samples * 2, False, minlen)
+                    results.append((sent_trans, sent_aligns, sent_costs, sent_coverages))
             else:
-                fin_trans = trans
-                fin_aligns = aligns
-                fin_costs = costs
-                if self.enc_dec.state['maintain_coverage']:
-                    fin_coverages = coverages[:,:,0].transpose().tolist()
-                logger.error("Translation failed")
+                results.append((sent_trans, sent_aligns, sent_costs))
+        return results, stats
+
+    def initial_coverages(self, source_len, n_hyps):
+        """The coverage before the first step, zeros of shape
+        (source_len, n_hyps, 1) if it is not maintained"""
+        state = self.enc_dec.state
+        # added by Zhaopeng Tu, 2015-11-02
+        if state['maintain_coverage']:
+            coverage_dim = state['coverage_dim']
+            if state['use_linguistic_coverage'] and state['coverage_accumulated_operation'] == 'subtractive':
+                return numpy.ones((source_len, n_hyps, coverage_dim), dtype='float32')
+            return numpy.zeros((source_len, n_hyps, coverage_dim), dtype='float32')
+        return numpy.zeros((source_len, n_hyps, 1), dtype='float32')
+
+    def _prune(self, keep, pruned, hyp_sents, stats, name):
+        pruned &= keep
+        for sent in hyp_sents[pruned]:
+            stats[sent][name] += 1
+        return keep & ~pruned
+
+    def _retry_stats(self, failed, retry):
+        """Adds the statistics of the unsuccessful search of a sentence
+        to the ones of its retry"""
+        retry = dict(retry)
+        for key in ['steps', 'expanded', 'pruned_finished', 'pruned_relative', 'pruned_absolute']:
+            retry[key] += failed[key]
+        retry['retries'] += failed['retries'] + 1
+        return retry
 
-        fin_trans = numpy.array(fin_trans)[numpy.argsort(fin_costs)]
-        fin_aligns = numpy.array(fin_aligns)[numpy.argsort(fin_costs)]
-        if self.enc_dec.state['maintain_coverage']:
-            fin_coverages = numpy.array(fin_coverages)[numpy.argsort(fin_costs)]
-        fin_costs = numpy.array(sorted(fin_costs))
+class GreedySearch(BeamSearch):
+    """The search with a beam of size one, as a single compiled scan over
+    the steps for a whole batch of sentences, see
+    RNNEncoderDecoder.create_greedy_computer. The results are in the
+    format of BeamSearch, with one translation per sentence, the beam
+    size given to the search methods is ignored."""
 
-        if self.enc_dec.state['maintain_coverage']:
-            if self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
-                return fin_trans, fin_aligns, fin_costs, fin_coverages, fertility
+    def __init__(self, enc_dec, shortlist=None, length_ratio=None):
+        BeamSearch.__init__(self, enc_dec, top_k=False, shortlist=shortlist,
+                length_ratio=length_ratio)
+
+    def compile(self):
+        self.comp_repr = self.enc_dec.create_batch_representation_computer()
+        if self.enc_dec.state['maintain_coverage'] and self.enc_dec.state['use_linguistic_coverage'] and self.enc_dec.state['use_fertility_model']:
+            self.comp_fert = self.enc_dec.create_batch_fertility_computer()
+        self.comp_init_states = self.enc_dec.create_batch_initializers()
+        # with ignore_unk too, not to compile it in the middle of a search
+        self.comp_greedy = dict((ignore_unk, self.enc_dec.create_greedy_computer(
+                    shortlist=self.shortlist is not None, ignore_unk=ignore_unk))
+                for ignore_unk in [False, True])
+
+    def search_encoded(self, encoded, n_samples, ignore_unk, minlens, max_steps,
+            resumed=None):
+        assert resumed is None
+        state = self.enc_dec.state
+        seqs = encoded.seqs
+        lens = encoded.lens
+        n_sents = len(seqs)
+        c = encoded.sources[0]
+
+        inputs = (encoded.sources + encoded.states
+                + [self.initial_coverages(c.shape[0], n_sents), encoded.fertility,
+                    numpy.ceil(minlens).astype('int64'), max_steps.astype('int64')])
+        if self.shortlist is not None:
+            inputs.append(self.shortlist.candidates(seqs))
+        # words shape: (n_steps, n_sents), alignment: (n_steps, source_len, n_sents)
+        words, alignment, costs, coverages = self.comp_greedy[bool(ignore_unk)](*inputs)
+
+        results = []
+        stats = []
+        failed = []
+        for sent in range(n_sents):
+            ends = (words[:, sent] == self.eos_id).nonzero()[0]
+            if len(ends):
+                length = ends[0] + 1
             else:
-                return fin_trans, fin_aligns, fin_costs, fin_coverages
-        else:
-            return fin_trans, fin_aligns, fin_costs
+                length = max_steps[sent]
+                failed.append(sent)
+            sent_trans = [words[:length, sent]]
+            sent_aligns = [alignment[:length, :lens[sent], sent]]
+            sent_costs = costs[[sent]]
+            if state['maintain_coverage']:
+                sent_coverages = coverages[:lens[sent], sent, 0][None]
+                if state['use_linguistic_coverage'] and state['use_fertility_model']:
+                    results.append((sent_trans, sent_aligns, sent_costs, sent_coverages,
+                        encoded.fertility[:lens[sent], sent]))
+                else:
+                    results.append((sent_trans, sent_aligns, sent_costs, sent_coverages))
+            else:
+                results.append((sent_trans, sent_aligns, sent_costs))
+            stats.append(dict(max_steps=int(max_steps[sent]), steps=int(length),
+                expanded=int(length), pruned_finished=0, pruned_relative=0,
+                pruned_absolute=0, retries=0))
+
+        if len(failed) and ignore_unk:
+            logger.warning("Did not manage without UNK")
+            retry_results, retry_stats = self.search_encoded(encoded.select(failed),
+                    n_samples, False, minlens[failed], max_steps[failed])
+            for sent, result, sent_stats in zip(failed, retry_results, retry_stats):
+                results[sent] = result
+                stats[sent] = self._retry_stats(stats[sent], sent_stats)
+        elif len(failed):
+            logger.error("Translation failed")
+        return results, stats
+
+def load_search_model(state, model_path, numpy_engine=False,
+        target_tables=False, source_tables=False):
+    """Loads another model with the same state for an ensemble, in the
+    NumPy engine or as an RNNEncoderDecoder built for beam search"""
+    if numpy_engine:
+        return NumpyEncoderDecoder(state, model_path,
+                target_tables=target_tables, source_tables=source_tables)
+    enc_dec = RNNEncoderDecoder(state, numpy.random.RandomState(state['seed']),
+            skip_init=True, compute_alignment=True)
+    enc_dec.build(mode='beam_search')
+    enc_dec.create_lm_model().load(model_path)
+    if target_tables:
+        enc_dec.precompute_target_tables()
+    if source_tables:
+        enc_dec.precompute_source_tables()
+    return enc_dec
+
+def pad_sources(state, seqs):
+    """The matrices of words and mask of a batch of source sentences,
+    which already end with the null symbol"""
+    lens = [len(seq) for seq in seqs]
+    x = numpy.zeros((max(lens), len(seqs)), dtype='int64') + state['null_sym_source']
+    x_mask = numpy.zeros((max(lens), len(seqs)), dtype='float32')
+    for idx, seq in enumerate(seqs):
+        x[:len(seq), idx] = seq
+        x_mask[:len(seq), idx] = 1.
+    return x, x_mask
+
+class SourceEncoding(object):
+    """The output of the encoder for a batch of source sentences: the
+    annotations followed by their mask and projections (`sources`, all
+    with the sentences along the second axis), the initial decoder
+    states and the fertilities"""
+
+    def __init__(self, seqs, lens, sources, states, fertility):
+        self.seqs = seqs
+        self.lens = lens
+        self.sources = sources
+        self.states = states
+        self.fertility = fertility
+
+    def select(self, indices):
+        return SourceEncoding([self.seqs[i] for i in indices],
+                self.lens[indices],
+                [x[:, indices] for x in self.sources],
+                [x[indices] for x in self.states],
+                self.fertility[:, indices])
+
+class ResumedBeam(object):
+    """The live hypotheses of a sentence when its search ran out of steps:
+    their words and alignments so far, their costs, and from the list of
+    (last word, states, context, coverage) of each, the inputs needed
+    to continue them"""
+
+    def __init__(self, backtracked, costs, beam):
+        self.prefixes = [trans for trans, _ in backtracked]
+        self.prefix_aligns = [aligns for _, aligns in backtracked]
+        self.steps = len(self.prefixes[0])
+        self.costs = costs
+        self.words = numpy.array([words for words, _, _, _ in beam], dtype='int64')
+        self.states = [numpy.array([states[level] for _, states, _, _ in beam])
+                for level in range(len(beam[0][1]))]
+        self.contexts = numpy.array([ctx for _, _, ctx, _ in beam])
+        self.coverages = numpy.array([cov for _, _, _, cov in beam]).transpose(1, 0, 2)
+
+class HypothesisStore(object):
+    """Preallocated storage for the expansions made by the beam search.
+
+    Every step fills a row of slots: the word chosen at this step, the
+    slot of the parent hypothesis in the previous row, the cost and the
+    alignment. Nothing is copied when the beam is reordered, complete
+    hypotheses are recovered by backtracking from their last slot.
+    """
+
+    def __init__(self, max_steps, n_slots, source_len):
+        self.max_steps = max_steps
+        self.words = numpy.zeros((max_steps, n_slots), dtype='int64')
+        self.backpointers = numpy.zeros((max_steps, n_slots), dtype='int64')
+        self.costs = numpy.zeros((max_steps, n_slots), dtype='float32')
+        # alignment shape: (max_steps, n_slots, source_len)
+        self.aligns = numpy.zeros((max_steps, n_slots, source_len), dtype='float32')
+
+    def add(self, step, parents, words, costs, aligns):
+        n = len(words)
+        self.backpointers[step, :n] = parents
+        self.words[step, :n] = words
+        self.costs[step, :n] = costs
+        self.aligns[step, :n] = aligns
+
+    def set_prefixes(self, prefixes, aligns):
+        """Fills the first steps with complete hypotheses, one per slot,
+        so that they can be continued"""
+        for slot, (words, align) in enumerate(zip(prefixes, aligns)):
+            steps = len(words)
+            self.words[:steps, slot] = words
+            self.backpointers[:steps, slot] = slot
+            self.aligns[:steps, slot, :align.shape[1]] = align
+
+    def backtrack(self, step, slot):
+        """Returns the words and the alignment (target_len, source_len)
+        of the hypothesis ending in `slot` of `step`"""
+        trans = numpy.zeros(step + 1, dtype='int64')
+        aligns = numpy.zeros((step + 1, self.aligns.shape[2]), dtype='float32')
+        for k in range(step, -1, -1):
+            trans[k] = self.words[k, slot]
+            aligns[k] = self.aligns[k, slot]
+            slot = self.backpointers[k, slot]
+        return trans, aligns
 
 def indices_to_words(i2w, seq):
     sen = []
@@ -204,38 +637,128 @@ def indices_to_words(i2w, seq):
         sen.append(i2w[seq[k]])
     return sen
 
+def beam_results_to_sentences(lm_model, results,
+        normalize=False, verbose=False):
+    sentences = []
+    if lm_model.maintain_coverage:
+        if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
+            trans, aligns, costs, coverages, fertility = results
+        else:
+            trans, aligns, costs, coverages = results
+    else:
+        trans, aligns, costs = results
+    if normalize:
+        counts = [len(s) for s in trans]
+        costs = [co / cn for co, cn in zip(costs, counts)]
+    for i in range(len(trans)):
+        sen = indices_to_words(lm_model.word_indxs, trans[i])
+        sentences.append(" ".join(sen))
+    for i in range(len(costs)):
+        if verbose:
+            print("{}: {}".format(costs[i], sentences[i]))
+    if lm_model.maintain_coverage:
+        if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
+            return sentences, aligns, costs, coverages, fertility, trans
+        else:
+            return sentences, aligns, costs, coverages, trans
+    else:
+        return sentences, aligns, costs, trans
+
+def batch_sample(lm_model, seqs, n_samples, beam_search,
+        ignore_unk=False, normalize=False, verbose=False):
+    """Beam search for a list of sentences in one batch, returns
+    a list with what `sample` returns for each of them"""
+    results = beam_search.batch_search(seqs, n_samples,
+            ignore_unk=ignore_unk, minlens=[len(seq) / 2 for seq in seqs])
+    return [beam_results_to_sentences(lm_model, r, normalize, verbose)
+            for r in results]
+
+def batched_translations(lm_model, beam_search, seqs, n_samples, batch_size,
+        ignore_unk=False, normalize=False):
+    """Translates `seqs` in batches of sentences of similar length and
+    yields (index, result, search stats) in the original order of `seqs`"""
+    order = numpy.argsort([len(seq) for seq in seqs], kind='mergesort')
+    done = {}
+    next_idx = 0
+    for start in range(0, len(seqs), batch_size):
+        indices = order[start:start + batch_size]
+        results = batch_sample(lm_model, [seqs[i] for i in indices], n_samples,
+                beam_search, ignore_unk=ignore_unk, normalize=normalize)
+        done.update(zip(indices, zip(results, beam_search.last_stats)))
+        while next_idx in done:
+            result, stats = done.pop(next_idx)
+            yield next_idx, result, stats
+            next_idx += 1
+
+# The translation function of the worker processes, inherited on fork
+_worker_translate = None
+
+def _init_worker(blas_threads):
+    if threadpool_limits:
+        threadpool_limits(blas_threads)
+
+def _translate_chunk(chunk):
+    indices, seqs = chunk
+    return [(indices[i], result, stats) for i, result, stats in _worker_translate(seqs)]
+
+def parallel_translations(translate, seqs, n_workers, chunk_size, blas_threads=1):
+    """Translates `seqs` in `n_workers` forked processes and yields
+    (index, result, search stats) in the original order of `seqs`.
+    `translate` is a function of a list of sentences returning such a
+    generator, the workers call it on chunks of `chunk_size` sentences
+    of similar length. The model has to be compiled before, the workers
+    share it with the calling process."""
+    global _worker_translate
+    _worker_translate = translate
+    if not threadpool_limits and any(os.environ.get(name) != str(blas_threads)
+            for name in BLAS_THREADS_VARIABLES):
+        logger.warning("The BLAS threads of the workers are not limited to {}: "
+                "install threadpoolctl or set {} before starting".format(
+                    blas_threads, ", ".join(BLAS_THREADS_VARIABLES)))
+    order = numpy.argsort([len(seq) for seq in seqs], kind='mergesort')
+    chunks = [(order[start:start + chunk_size],
+                [seqs[i] for i in order[start:start + chunk_size]])
+            for start in range(0, len(seqs), chunk_size)]
+    pool = multiprocessing.get_context('fork').Pool(n_workers,
+            _init_worker, (blas_threads,))
+    try:
+        done = {}
+        next_idx = 0
+        for results in pool.imap_unordered(_translate_chunk, chunks):
+            for i, result, stats in results:
+                done[i] = (result, stats)
+            while next_idx in done:
+                result, stats = done.pop(next_idx)
+                yield next_idx, result, stats
+                next_idx += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+def estimate_length_ratio(state, percentile=99.):
+    """Returns the target to source length ratio that `percentile`
+    percent of the training sentence pairs do not exceed, read from the
+    indices of the training tables"""
+    import tables
+    lengths = []
+    for name in [state['source'][0], state['target'][0]]:
+        with tables.open_file(name, 'r') as table:
+            lengths.append(table.get_node('/indices').col('length').astype('float32'))
+    source_lens, target_lens = lengths
+    nonempty = source_lens > 0
+    return numpy.percentile(target_lens[nonempty] / source_lens[nonempty], percentile)
+
+def format_stats(stats):
+    return " ".join("{}={}".format(key, stats[key]) for key in sorted(stats))
+
 def sample(lm_model, seq, n_samples,
         sampler=None, beam_search=None,
         ignore_unk=False, normalize=False,
         alpha=1, verbose=False):
     if beam_search:
-        sentences = []
-        if lm_model.maintain_coverage:
-            if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-                trans, aligns, costs, coverages, fertility = beam_search.search(seq, n_samples,
-                        ignore_unk=ignore_unk, minlen=len(seq) / 2)
-            else:
-                trans, aligns, costs, coverages = beam_search.search(seq, n_samples,
-                        ignore_unk=ignore_unk, minlen=len(seq) / 2)
-        else:
-            trans, aligns, costs = beam_search.search(seq, n_samples,
-                    ignore_unk=ignore_unk, minlen=len(seq) / 2)
-        if normalize:
-            counts = [len(s) for s in trans]
-            costs = [co / cn for co, cn in zip(costs, counts)]
-        for i in range(len(trans)):
-            sen = indices_to_words(lm_model.word_indxs, trans[i])
-            sentences.append(" ".join(sen))
-        for i in range(len(costs)):
-            if verbose:
-                print("{}: {}".format(costs[i], sentences[i]))
-        if lm_model.maintain_coverage:
-            if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-                return sentences, aligns, costs, coverages, fertility, trans
-            else:
-                return sentences, aligns, costs, coverages, trans
-        else:
-            return sentences, aligns, costs, trans
+        results = beam_search.search(seq, n_samples,
+                ignore_unk=ignore_unk, minlen=len(seq) / 2)
+        return beam_results_to_sentences(lm_model, results, normalize, verbose)
     elif sampler:
         sentences = []
         all_probs = []
@@ -273,6 +796,10 @@ def parse_args():
             required=True, help="State to use")
     parser.add_argument("--beam-search",
             action="store_true", help="Beam size, turns on beam-search")
+    parser.add_argument("--greedy",
+            action="store_true", default=False,
+            help="Search with a beam of size one, with a single compiled "
+                 "function for the whole search of a batch")
     parser.add_argument("--beam-size",
             type=int, help="Beam size")
     parser.add_argument("--ignore-unk",
@@ -282,9 +809,92 @@ def parse_args():
             help="File of source sentences")
     parser.add_argument("--trans",
             help="File to save translations in")
+    parser.add_argument("--batch-size",
+            type=int, default=1,
+            help="Number of source sentences searched together, "
+                 "sentences are sorted by length to build the batches")
+    parser.add_argument("--workers",
+            type=int, default=1,
+            help="Number of processes translating the source file, "
+                 "each gets --batch-size sentences at a time")
+    parser.add_argument("--blas-threads",
+            type=int, default=1,
+            help="Number of BLAS threads of each worker process")
+    parser.add_argument("--shortlist",
+            help="Lexical table built by shortlist.py, if given the softmax "
+                 "is computed only over the shortlisted target words")
+    parser.add_argument("--shortlist-frequent",
+            type=int, default=2000,
+            help="Number of the most frequent target words in the shortlist")
+    parser.add_argument("--shortlist-translations",
+            type=int, default=20,
+            help="Number of shortlisted translations of each source word")
+    parser.add_argument("--prune-finished",
+            action="store_true", default=False,
+            help="Drop the hypotheses costing more than the best finished "
+                 "translation, the best translation is unchanged unless "
+                 "--normalize is used")
+    parser.add_argument("--prune-relative",
+            type=float,
+            help="Drop the hypotheses less probable than this fraction of "
+                 "the best hypothesis of the step")
+    parser.add_argument("--prune-absolute",
+            type=float,
+            help="Drop the hypotheses whose cost exceeds the cost of the best "
+                 "hypothesis of the step by more than this")
+    parser.add_argument("--length-ratio",
+            type=float,
+            help="Maximum number of target words per source word, "
+                 "by default 3")
+    parser.add_argument("--learn-length-ratio",
+            type=float, metavar="PERCENTILE",
+            help="Set the maximum length ratio to this percentile of the "
+                 "ratios in the training data of the state")
+    parser.add_argument("--stats",
+            help="File to save the per-sentence search statistics in")
+    parser.add_argument("--cache",
+            nargs="?", const="", metavar="PATH",
+            help="Reuse the translations of repeated sentences, across runs "
+                 "if the sqlite database PATH is given, not with --shortlist")
+    parser.add_argument("--cache-size",
+            type=int, default=10000,
+            help="Number of translations the cache keeps in memory")
+    parser.add_argument("--cache-alignment",
+            action="store_true", default=False,
+            help="Also cache the alignment and coverage of the translations")
     parser.add_argument("--normalize",
             action="store_true", default=False,
             help="Normalize log-prob with the word count")
+    parser.add_argument("--numpy",
+            action="store_true", default=False,
+            help="Search with the NumPy implementation of the model "
+                 "instead of compiled Theano functions")
+    parser.add_argument("--check-numpy",
+            type=int, default=0, metavar="N",
+            help="Before translating, compare the NumPy implementation "
+                 "with the Theano functions on the first N source sentences")
+    parser.add_argument("--target-tables",
+            action="store_true", default=False,
+            help="Tabulate the projections of the target word embeddings "
+                 "after loading, the search then gathers their rows instead "
+                 "of multiplying the embeddings at every step")
+    parser.add_argument("--source-tables",
+            action="store_true", default=False,
+            help="Tabulate the projections of the source word embeddings "
+                 "of both encoders after loading, checked against the "
+                 "usual encoder on the first sentences of --source")
+    parser.add_argument("--quantized",
+            metavar="PATH",
+            help="Model written by quantize.py, searched with the NumPy "
+                 "implementation (implies --numpy)")
+    parser.add_argument("--ensemble",
+            nargs="+", metavar="PATH",
+            help="Other models with the same state, searched together with "
+                 "the main one with the average of their log-probabilities")
+    parser.add_argument("--ensemble-weights",
+            nargs="+", type=float,
+            help="Weights of the log-probabilities of the main model and "
+                 "of the --ensemble ones, equal by default")
     parser.add_argument("--verbose",
             action="store_true", default=False,
             help="Be verbose")
@@ -293,10 +903,26 @@ def parse_args():
     parser.add_argument("changes",
             nargs="?", default="",
             help="Changes to state")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.greedy and (args.numpy or args.quantized):
+        parser.error("--greedy cannot be used with the NumPy engine, "
+                "which has no greedy search")
+    if args.greedy and args.ensemble:
+        parser.error("--greedy cannot be used with --ensemble, "
+                "the greedy search uses a single model")
+    if args.cache is not None and args.shortlist:
+        # the candidate words are the ones of the sentences searched
+        # together, which depend on the input and on what is cached
+        parser.error("--cache cannot be used with --shortlist")
+    return args
 
 def main():
     args = parse_args()
+    if args.quantized:
+        args.numpy = True
+    if args.greedy:
+        args.beam_search = True
+        args.beam_size = 1
 
     state = prototype_search_with_coverage_state()
     with open(args.state) as src:
@@ -307,7 +933,9 @@ def main():
 
     rng = numpy.random.RandomState(state['seed'])
     enc_dec = RNNEncoderDecoder(state, rng, skip_init=True, compute_alignment=True)
-    enc_dec.build()
+    # the NumPy engine needs none of the Theano graphs
+    theano_search = args.beam_search and (not args.numpy or args.check_numpy)
+    enc_dec.build(mode='beam_search' if theano_search else 'sample')
     lm_model = enc_dec.create_lm_model()
     lm_model.load(args.model_path)
     indx_word = pickle.load(open(state['word_indx'],'rb'))
@@ -315,8 +943,66 @@ def main():
     sampler = None
     beam_search = None
     if args.beam_search:
-        beam_search = BeamSearch(enc_dec)
+        shortlist = None
+        if args.shortlist:
+            shortlist = Shortlist(args.shortlist, state,
+                    n_frequent=args.shortlist_frequent,
+                    n_translations=args.shortlist_translations)
+        length_ratio = args.length_ratio
+        if not length_ratio and args.learn_length_ratio:
+            length_ratio = estimate_length_ratio(state, args.learn_length_ratio)
+            logger.debug("Length ratio: {}".format(length_ratio))
+        if args.target_tables and theano_search:
+            enc_dec.precompute_target_tables()
+        if args.source_tables and theano_search:
+            check_batch = None
+            if args.source:
+                with open(args.source) as src:
+                    seqs = [parse_input(state, indx_word, line.strip())[0]
+                            for line, _ in zip(src, range(16))]
+                if seqs:
+                    check_batch = pad_sources(state, seqs)
+            enc_dec.precompute_source_tables(check_batch)
+        if args.greedy:
+            beam_search = GreedySearch(enc_dec, shortlist=shortlist,
+                    length_ratio=length_ratio)
+        else:
+            search_model = (NumpyEncoderDecoder(state, args.quantized or args.model_path,
+                        target_tables=args.target_tables,
+                        source_tables=args.source_tables)
+                    if args.numpy
+                    else enc_dec)
+            if args.ensemble:
+                search_model = [search_model] + [load_search_model(state, path,
+                        numpy_engine=args.numpy,
+                        target_tables=args.target_tables,
+                        source_tables=args.source_tables)
+                    for path in args.ensemble]
+            beam_search = BeamSearch(search_model,
+                    shortlist=shortlist,
+                    prune_finished=args.prune_finished,
+                    prune_relative=args.prune_relative,
+                    prune_absolute=args.prune_absolute,
+                    length_ratio=length_ratio,
+                    ensemble_weights=args.ensemble_weights)
         beam_search.compile()
+        if args.check_numpy:
+            assert args.source
+            reference = BeamSearch(enc_dec, shortlist=shortlist)
+            reference.compile()
+            engine = beam_search
+            # the quantized model and the ensemble are not expected to match
+            if not args.numpy or args.quantized or args.ensemble:
+                engine = BeamSearch(NumpyEncoderDecoder(state, args.model_path),
+                        shortlist=shortlist)
+                engine.compile()
+            with open(args.source) as src:
+                seqs = [parse_input(state, indx_word, line.strip())[0]
+                        for line, _ in zip(src, range(args.check_numpy))]
+            diffs = check_engine(reference, engine, seqs)
+            logger.debug("The NumPy engine differs by at most {}".format(
+                ", ".join("{} for {}".format(diff, name)
+                    for name, diff in sorted(diffs.items()))))
     else:
         sampler = enc_dec.create_sampler(many_samples=True)
 
@@ -329,26 +1015,70 @@ def main():
 
         fsrc = open(args.source, 'r')
         ftrans = open(args.trans, 'w')
+        fstats = open(args.stats, 'w') if args.stats else None
 
         start_time = time.time()
 
         n_samples = args.beam_size
         total_cost = 0.0
         logging.debug("Beam size: {}".format(n_samples))
-        for i, line in enumerate(fsrc):
-            seqin = line.strip()
-            seq, parsed_in = parse_input(state, indx_word, seqin, idx2word=idict_src)
+        cache = None
+        if args.cache is not None:
+            options = dict(beam_size=n_samples, ignore_unk=args.ignore_unk,
+                    normalize=args.normalize, shortlist=args.shortlist,
+                    shortlist_frequent=args.shortlist_frequent,
+                    shortlist_translations=args.shortlist_translations,
+                    prune_finished=args.prune_finished,
+                    prune_relative=args.prune_relative,
+                    prune_absolute=args.prune_absolute,
+                    length_ratio=length_ratio, numpy=args.numpy,
+                    greedy=args.greedy, ensemble_weights=args.ensemble_weights,
+                    changes=args.changes)
+            model_paths = [args.model_path, args.state]
+            if args.quantized:
+                model_paths.append(args.quantized)
+            model_paths += args.ensemble or []
+            cache = TranslationCache(checkpoint_hash(*model_paths),
+                    options, path=args.cache, capacity=args.cache_size,
+                    keep_alignment=args.cache_alignment or args.verbose)
+        if args.batch_size > 1 or cache or args.workers > 1:
+            def translate(seqs):
+                if args.batch_size > 1:
+                    return batched_translations(lm_model, beam_search, seqs,
+                            n_samples, args.batch_size,
+                            ignore_unk=args.ignore_unk, normalize=args.normalize)
+                return ((i, sample(lm_model, seq, n_samples, beam_search=beam_search,
+                            ignore_unk=args.ignore_unk, normalize=args.normalize),
+                        beam_search.last_stats[0])
+                    for i, seq in enumerate(seqs))
+            if args.batch_size > 1:
+                logging.debug("Batch size: {}".format(args.batch_size))
+            if args.workers > 1:
+                logging.debug("Workers: {}".format(args.workers))
+                translate_serially = translate
+                translate = lambda seqs: parallel_translations(translate_serially, seqs,
+                        args.workers, args.batch_size, args.blas_threads)
+            parsed = [parse_input(state, indx_word, line.strip(), idx2word=idict_src)
+                    for line in fsrc]
+            seqs = [seq for seq, _ in parsed]
+            searched = cache.translations(seqs, translate) if cache else translate(seqs)
+            translations = ((i, parsed[i][1], result, stats)
+                    for i, result, stats in searched)
+        else:
+            def sentence_translations():
+                for i, line in enumerate(fsrc):
+                    seq, parsed_in = parse_input(state, indx_word, line.strip(), idx2word=idict_src)
+                    result = sample(lm_model, seq, n_samples, sampler=sampler,
+                            beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
+                    yield i, parsed_in, result, beam_search.last_stats[0]
+            translations = sentence_translations()
+        for i, parsed_in, result, stats in translations:
+            trans, aligns, costs = result[:3]
             if lm_model.maintain_coverage:
+                coverages = result[3]
                 if lm_model.use_linguistic_coverage and lm_model.use_fertility_model:
-                    trans, aligns, costs, coverages, fertility, _ = sample(lm_model, seq, n_samples, sampler=sampler,
-                            beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-                else:
-                    trans, aligns, costs, coverages, _ = sample(lm_model, seq, n_samples, sampler=sampler,
-                            beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-            else:
-                trans, aligns, costs, _ = sample(lm_model, seq, n_samples, sampler=sampler,
-                        beam_search=beam_search, ignore_unk=args.ignore_unk, normalize=args.normalize)
-            
+                    fertility = result[4]
+
             if args.verbose:
                 print("Parsed Input:", parsed_in)
 
@@ -358,8 +1088,11 @@ def main():
 
             best = numpy.argmin(costs)
             print(trans[best], file=ftrans)
+            if fstats:
+                print(format_stats(stats), file=fstats)
             if args.verbose:
                 print("Translation:", trans[best])
+                print("Search:", format_stats(stats))
                 print("Aligns:")
                 # aligns shape:  (target_len, source_len)
                 # we reverse it to the shape (source_len, target_len) to show the matrix
@@ -386,9 +1119,14 @@ def main():
                 logger.debug("Current speed is {} per sentence".
                         format((time.time() - start_time) / (i + 1)))
         print("Total cost of the translations: {}".format(total_cost))
+        if cache:
+            print("Translation cache: {}".format(cache.report()))
+            cache.close()
 
         fsrc.close()
         ftrans.close()
+        if fstats:
+            fstats.close()
     else:
         while True:
             try:
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+A translation server keeping the model and the compiled beam search in
+memory.
+
+Clients connect to a TCP port or a Unix socket and send one JSON object
+per line, the server answers each with one line:
+
+    {"source": "a source sentence"}
+    -> {"translation": "...", "cost": 12.3, "latency": 0.21, "batch": 8}
+
+    {"stats": true}
+    -> {"requests": ..., "queue_depth": ..., "latency": {...}, ...}
+
+Concurrent requests are gathered into batches of at most --batch-size
+sentences, waiting at most --max-delay seconds after the first one, and
+searched together. client.py is a load test client.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import pickle
+import time
+
+import numpy
+
+from experiments.nmt import\
+    RNNEncoderDecoder,\
+    prototype_search_with_coverage_state,\
+    parse_input
+from experiments.nmt.numpy_engine import NumpyEncoderDecoder
+from experiments.nmt.sample import BeamSearch, batch_sample
+from experiments.nmt.shortlist import Shortlist
+
+logger = logging.getLogger(__name__)
+
+class ServerStats(object):
+    """Latencies of the last `window` requests and the batch counts"""
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.sentences = 0
+        self.start_time = time.time()
+
+    def add_batch(self, latencies):
+        self.batches += 1
+        self.sentences += len(latencies)
+        self.latencies.extend(latencies)
+
+    def report(self, queue_depth):
+        latencies = numpy.array(self.latencies)
+        report = dict(requests=self.requests,
+                sentences=self.sentences,
+                batches=self.batches,
+                mean_batch=float(self.sentences) / self.batches if self.batches else 0.,
+                queue_depth=queue_depth,
+                uptime=time.time() - self.start_time)
+        if len(latencies):
+            report['latency'] = dict(mean=float(latencies.mean()),
+                    **dict(("p{}".format(p), float(numpy.percentile(latencies, p)))
+                        for p in [50, 90, 99]))
+        return report
+
+class TranslationServer(object):
+
+    def __init__(self, lm_model, beam_search, state, indx_word, idict_src,
+            beam_size, batch_size=16, max_delay=0.05,
+            ignore_unk=False, normalize=False):
+        self.lm_model = lm_model
+        self.beam_search = beam_search
+        self.state = state
+        self.indx_word = indx_word
+        self.idict_src = idict_src
+        self.beam_size = beam_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.ignore_unk = ignore_unk
+        self.normalize = normalize
+        self.queue = None
+        self.stats = ServerStats()
+
+    def translate(self, seqs):
+        """Searches a batch of sentences, returns (translation, cost) pairs"""
+        results = batch_sample(self.lm_model, seqs, self.beam_size, self.beam_search,
+                ignore_unk=self.ignore_unk, normalize=self.normalize)
+        best = []
+        for result in results:
+            trans, costs = result[0], result[2]
+            if not len(trans):
+                best.append(('Failed', 0.))
+            else:
+                i = numpy.argmin(costs)
+                best.append((trans[i], float(costs[i])))
+        return best
+
+    async def batcher(self):
+        """Takes the requests from the queue in batches and answers them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            seqs = [seq for seq, _, _ in batch]
+            try:
+                # the search runs in a thread so that the requests keep coming
+                results = await loop.run_in_executor(None, self.translate, seqs)
+            except Exception as e:
+                logger.exception("Search failed")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            now = time.time()
+            self.stats.add_batch([now - received for _, received, _ in batch])
+            for (_, received, future), (trans, cost) in zip(batch, results):
+                future.set_result(dict(translation=trans, cost=cost,
+                    latency=now - received, batch=len(batch)))
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if request.get('stats'):
+                        response = self.stats.report(self.queue.qsize())
+                    else:
+                        self.stats.requests += 1
+                        seq, _ = parse_input(self.state, self.indx_word,
+                                request['source'].strip(), idx2word=self.idict_src)
+                        future = loop.create_future()
+                        await self.queue.put((seq, time.time(), future))
+                        response = await future
+                except Exception as e:
+                    response = dict(error=str(e))
+                writer.write((json.dumps(response) + "\n").encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, path=None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path=path)
+            logger.info("Listening on {}".format(path))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            logger.info("Listening on {}:{}".format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Serve the translations of a model with beam search")
+    parser.add_argument("--state",
+            required=True, help="State to use")
+    parser.add_argument("--beam-size",
+            type=int, default=12, help="Beam size")
+    parser.add_argument("--ignore-unk",
+            default=False, action="store_true",
+            help="Ignore unknown words")
+    parser.add_argument("--normalize",
+            action="store_true", default=False,
+            help="Normalize log-prob with the word count")
+    parser.add_argument("--batch-size",
+            type=int, default=16,
+            help="Maximum number of sentences searched together")
+    parser.add_argument("--max-delay",
+            type=float, default=0.05,
+            help="Seconds a request waits for others to fill its batch")
+    parser.add_argument("--shortlist",
+            help="Lexical table built by shortlist.py")
+    parser.add_argument("--numpy",
+            action="store_true", default=False,
+            help="Search with the NumPy implementation of the model "
+                 "instead of compiled Theano functions")
+    parser.add_argument("--host",
+            default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port",
+            type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--socket",
+            help="Unix socket to listen on instead of a port")
+    parser.add_argument("model_path",
+            help="Path to the model")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    state = prototype_search_with_coverage_state()
+    with open(args.state, 'rb') as src:
+        state.update(pickle.load(src))
+    state.update(eval("dict({})".format(args.changes)))
+
+    logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    rng = numpy.random.RandomState(state['seed'])
+    enc_dec = RNNEncoderDecoder(state, rng, skip_init=True, compute_alignment=True)
+    enc_dec.build(mode='sample' if args.numpy else 'beam_search')
+    lm_model = enc_dec.create_lm_model()
+    lm_model.load(args.model_path)
+    indx_word = pickle.load(open(state['word_indx'], 'rb'))
+    idict_src = pickle.load(open(state['indx_word'], 'rb'))
+
+    shortlist = Shortlist(args.shortlist, state) if args.shortlist else None
+    beam_search = BeamSearch(
+            NumpyEncoderDecoder(state, args.model_path) if args.numpy else enc_dec,
+            shortlist=shortlist)
+    beam_search.compile()
+
+    server = TranslationServer(lm_model, beam_search, state, indx_word, idict_src,
+            args.beam_size, batch_size=args.batch_size, max_delay=args.max_delay,
+            ignore_unk=args.ignore_unk, normalize=args.normalize)
+    asyncio.run(server.serve(args.host, args.port, args.socket))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Source-conditioned target vocabulary shortlists for beam search.
+
+The table is built offline from the word-aligned training bitext: for
+every source word it keeps the target words it is most often aligned to,
+and it keeps all the target words sorted by frequency. When translating,
+the softmax is computed only over the translations of the source words
+and the most frequent target words.
+
+The alignment file has one line per sentence pair with links in the
+usual "i-j" format (source position i, target position j):
+
+    python shortlist.py --state search_state.pkl --source train.src \\
+        --target train.trg --alignment train.align shortlist.pkl
+"""
+
+import argparse
+import pickle
+import logging
+import collections
+
+import numpy
+
+from experiments.nmt import\
+    prototype_search_with_coverage_state,\
+    parse_input, parse_target
+
+logger = logging.getLogger(__name__)
+
+class Shortlist(object):
+
+    def __init__(self, path, state, n_frequent=2000, n_translations=20):
+        """Loads a table built by this script, keeping the `n_frequent`
+        most frequent target words and `n_translations` translations per
+        source word"""
+        with open(path, 'rb') as src:
+            table = pickle.load(src)
+        self.translations = dict((word, trans[:n_translations])
+                for word, trans in table['translations'].items())
+        self.frequent = table['frequent'][:n_frequent]
+        # The end of sentence and the unknown word are always candidates
+        self.always = numpy.array([state['null_sym_target'], state['unk_sym_target']],
+                dtype='int64')
+
+    def candidates(self, seqs):
+        """Returns the sorted target word indices to compute the softmax
+        over when translating the source sentences `seqs` together"""
+        words = [self.frequent, self.always]
+        for seq in seqs:
+            for word in set(seq):
+                if word in self.translations:
+                    words.append(self.translations[word])
+        return numpy.unique(numpy.concatenate(words)).astype('int64')
+
+def build_table(state, source, target, alignment, n_translations):
+    word2idx_src = pickle.load(open(state['word_indx'], 'rb'))
+    word2idx_trg = pickle.load(open(state['word_indx_trgt'], 'rb'))
+
+    links = collections.defaultdict(collections.Counter)
+    frequency = collections.Counter()
+    n_bad_links = 0
+    for i, (src_line, trg_line, align_line) in enumerate(zip(source, target, alignment)):
+        src_seq, _ = parse_input(state, word2idx_src, src_line.strip())
+        trg_seq, _ = parse_target(state, word2idx_trg, trg_line.strip())
+        frequency.update(int(word) for word in trg_seq[:-1])
+        bad_links = 0
+        for link in align_line.split():
+            try:
+                src_pos, trg_pos = [int(pos) for pos in link.split('-')]
+            except ValueError:
+                bad_links += 1
+                continue
+            # the last word of the sequences is the end of sentence
+            if not (0 <= src_pos < len(src_seq) - 1 and 0 <= trg_pos < len(trg_seq) - 1):
+                bad_links += 1
+                continue
+            src_word = int(src_seq[src_pos])
+            if src_word != state['unk_sym_source']:
+                links[src_word][int(trg_seq[trg_pos])] += 1
+        if bad_links:
+            logger.warning("Skipped {} bad alignment links on line {}".format(
+                bad_links, i + 1))
+            n_bad_links += bad_links
+        if (i + 1) % 100000 == 0:
+            logger.debug("{} sentence pairs read".format(i + 1))
+    if n_bad_links:
+        logger.warning("Skipped {} bad alignment links in total".format(n_bad_links))
+
+    translations = dict((word, numpy.array([t for t, _ in counts.most_common(n_translations)],
+                dtype='int64'))
+            for word, counts in links.items())
+    frequent = numpy.array([t for t, _ in frequency.most_common()], dtype='int64')
+    return dict(translations=translations, frequent=frequent)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Build a lexical shortlist table from a word-aligned bitext")
+    parser.add_argument("--state",
+            required=True, help="State to use")
+    parser.add_argument("--source",
+            required=True, help="File of source sentences")
+    parser.add_argument("--target",
+            required=True, help="File of target sentences")
+    parser.add_argument("--alignment",
+            required=True, help="File of word alignments in i-j format")
+    parser.add_argument("--translations",
+            type=int, default=100,
+            help="Number of target words stored for each source word")
+    parser.add_argument("output",
+            help="File to save the table in")
+    parser.add_argument("changes",
+            nargs="?", default="",
+            help="Changes to state")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    state = prototype_search_with_coverage_state()
+    with open(args.state, 'rb') as src:
+        state.update(pickle.load(src))
+    state.update(eval("dict({})".format(args.changes)))
+
+    logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
+
+    with open(args.source) as source, open(args.target) as target, open(args.alignment) as alignment:
+        table = build_table(state, source, target, alignment, args.translations)
+    logger.debug("{} source words, {} target words".format(
+        len(table['translations']), len(table['frequent'])))
+    with open(args.output, 'wb') as dst:
+        pickle.dump(table, dst)
+
+if __name__ == "__main__":
+    main()
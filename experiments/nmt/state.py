@@ -185,10 +185,23 @@ def prototype_state():
     # Turns on trimming the trailing paddings from batches
     # consisting of short sentences.
     state['trim_batches'] = True
+    # When positive, the batches are drawn at random from buckets of
+    # sentence pairs of the whole corpus whose source and target lengths
+    # differ by less than this many words, instead of sorting
+    # sort_k_batches consecutive batches.
+    state['bucket_width'] = 0
     # Loop through the data
     state['use_infinite_loop'] = True
     # Start from a random entry
     state['shuffle'] = False
+    # Number of processes reading and padding the batches in shared
+    # memory, with 0 they are read by a thread of the training process
+    state['loader_workers'] = 0
+    # Number of batches the processes can have ready
+    state['loader_ring_size'] = 16
+    # Take the batches from the processes in turn, so that the order of
+    # the batches does not depend on their speed
+    state['loader_deterministic'] = False
 
     # ----- TRAINING PROCESS -----
 
@@ -224,6 +237,10 @@ def prototype_state():
     # Raise exception if nan
     state['on_nan'] = 'raise'
 
+    # Directory where the compiled functions are kept between runs,
+    # None to compile them every time
+    state['compile_cache'] = None
+
     return state
 
 def prototype_phrase_state():
@@ -50,6 +50,22 @@ class RandomSamplePrinter(object):
                 self.model.get_samples(self.state['seqlen'] + 1, self.state['n_samples'], x[:len(x_words)])
                 sample_idx += 1
 
+def warm_cache(state, enc_dec, lm_model):
+    """Compiles the trainer and decoder functions of the state into
+    state['compile_cache']"""
+    if not state['compile_cache']:
+        raise ValueError("state['compile_cache'] is not set")
+    logger.debug("Compile trainer")
+    eval(state['algo'])(lm_model, state, None)
+    if state['search']:
+        # only needed here, training does not use the decoder
+        from experiments.nmt.sample import BeamSearch, GreedySearch
+        logger.debug("Compile beam search")
+        BeamSearch(enc_dec).compile()
+        logger.debug("Compile greedy search")
+        GreedySearch(enc_dec).compile()
+        enc_dec.create_step_computer(top_k=True, shortlist=True)
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--state", help="State to use")
@@ -57,6 +73,8 @@ def parse_args():
         help="Prototype state to use for state")
     parser.add_argument("--skip-init", action="store_true",
         help="Skip parameter initilization")
+    parser.add_argument("--warm-cache", action="store_true",
+        help="Compile the functions into state['compile_cache'] and exit")
     parser.add_argument("changes",  nargs="*", help="Changes to state", default="")
     return parser.parse_args()
 
@@ -78,8 +96,11 @@ def main():
 
     rng = numpy.random.RandomState(state['seed'])
     enc_dec = RNNEncoderDecoder(state, rng, skip_init=args.skip_init, compute_alignment=True)
-    enc_dec.build()
+    enc_dec.build(mode='train')
     lm_model = enc_dec.create_lm_model()
+    if args.warm_cache:
+        warm_cache(state, enc_dec, lm_model)
+        return
 
     logger.debug("Load data")
     train_data = get_batch_iterator(state)
@@ -0,0 +1,155 @@
+"""
+Memoization of the translations of sample.py.
+
+A translation is identified by the model (a hash of the checkpoint and
+state files), the decoding options and the token ids of the source
+sentence. The best translation of each sentence is kept in an in-memory
+LRU table and, if a path is given, in an sqlite database that outlives
+the run, so repeated sentences are only searched once.
+"""
+
+import collections
+import hashlib
+import logging
+import pickle
+import sqlite3
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+def checkpoint_hash(*paths):
+    """Returns a hash of the contents of the files `paths`"""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def best_result(result, keep_alignment=True):
+    """Reduces a result of sample.sample to its best translation. Without
+    `keep_alignment` the alignment, the coverage and the fertility are
+    dropped"""
+    costs = result[2]
+    if not len(costs):
+        return result
+    best = numpy.argmin(costs)
+    reduced = [[field[best]] for field in result]
+    if len(result) == 6:
+        # the fertility belongs to the source sentence, not to a translation
+        reduced[4] = result[4]
+    if not keep_alignment:
+        reduced[1] = [None]
+        if len(result) > 4:
+            reduced[3] = [None]
+        if len(result) == 6:
+            reduced[4] = None
+    return tuple(reduced)
+
+class TranslationCache(object):
+
+    def __init__(self, model_hash, options, path=None, capacity=10000,
+            keep_alignment=True):
+        """`options` is a dictionary of the decoding options which change
+        the translations. Keeps the `capacity` most recently used
+        translations in memory, and all of them in the sqlite database
+        `path` if it is given"""
+        self.prefix = repr((model_hash, sorted(options.items())))
+        self.capacity = capacity
+        self.keep_alignment = keep_alignment
+        self.memory = collections.OrderedDict()
+        self.db = None
+        self.pending = 0
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS translations "
+                    "(key TEXT PRIMARY KEY, value BLOB)")
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, seq):
+        return hashlib.sha1("{} {}".format(self.prefix,
+            [int(word) for word in seq]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached translation or None, and counts the hit or miss"""
+        entry = self.memory.get(key)
+        from_disk = False
+        if entry is not None:
+            self.memory.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute("SELECT value FROM translations WHERE key = ?",
+                    (key,)).fetchone()
+            if row is not None:
+                entry = pickle.loads(row[0])
+                from_disk = True
+                self._remember(key, entry)
+        # entries saved without the alignment are of no use when it is needed
+        if entry is None or (self.keep_alignment and not entry[0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.disk_hits += from_disk
+        return entry[1]
+
+    def put(self, key, result):
+        entry = (self.keep_alignment, best_result(result, self.keep_alignment))
+        self._remember(key, entry)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?)",
+                    (key, sqlite3.Binary(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))))
+            self.pending += 1
+            if self.pending >= 100:
+                self.db.commit()
+                self.pending = 0
+        return entry[1]
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def translations(self, seqs, translate):
+        """Yields (index, result, search stats) for `seqs` in order, like
+        sample.batched_translations. Only the distinct sentences missing
+        from the cache are translated, by `translate`, a function of a
+        list of sentences returning such a generator. Cached translations
+        have the stats {'cached': 1}"""
+        keys = [self.key(seq) for seq in seqs]
+        found = {}
+        missed = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if key in found or key in missed:
+                # a repetition within the sentences
+                self.hits += 1
+                continue
+            result = self.get(key)
+            if result is None:
+                missed[key] = i
+            else:
+                found[key] = result
+        missed_keys = list(missed)
+        searched = translate([seqs[missed[key]] for key in missed_keys])
+        for i, key in enumerate(keys):
+            if key in missed and missed[key] == i:
+                j, result, stats = next(searched)
+                assert missed_keys[j] == key
+                found[key] = self.put(key, result)
+                yield i, found[key], stats
+            else:
+                yield i, found[key], dict(cached=1)
+
+    def report(self):
+        total = self.hits + self.misses
+        return "{} hits ({} from disk), {} misses, hit rate {:.1%}".format(
+                self.hits, self.disk_hits, self.misses,
+                float(self.hits) / total if total else 0.)
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -17,8 +17,12 @@ import logging
 
 import threading
 import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import traceback
 
 import collections
+import itertools
 
 logger = logging.getLogger(__name__)
 
@@ -159,6 +163,186 @@ class TMIterator(object):
         else:
             return self.output_format(source_data, target_data)
 
+def read_index_block(source_index, target_index, start, stop, max_len):
+    """Reads the rows [start, stop) of the source and target indices at
+    once and returns the numbers of the rows whose phrases are both not
+    longer than `max_len`, with the positions and lengths of these
+    source and target phrases"""
+    source = source_index.read(start, stop)
+    target = target_index.read(start, stop)
+    kept = ((source['length'] <= max_len) & (target['length'] <= max_len)).nonzero()[0]
+    return (start + kept,
+            source['pos'][kept].astype('int64'), source['length'][kept].astype('int64'),
+            target['pos'][kept].astype('int64'), target['length'][kept].astype('int64'))
+
+def read_phrases(data, pos, lens, dtype):
+    """Reads the phrases of `data` starting at `pos` of lengths `lens`
+    with a single read of the range covering them, unless they are too
+    far apart"""
+    if not len(pos):
+        return []
+    start = pos.min()
+    stop = (pos + lens).max()
+    if stop - start > 2 * lens.sum() + 1024:
+        return [data[p:p + l].astype(dtype) for p, l in zip(pos, lens)]
+    chunk = data[start:stop].astype(dtype)
+    return [chunk[p:p + l] for p, l in zip(pos - start, lens)]
+
+def open_bitext(diter):
+    """Opens the source and target tables of `diter`, returns the
+    (phrases, index) nodes of each"""
+    driver = None
+    if diter.can_fit:
+        driver = "H5FD_CORE"
+    nodes = []
+    for path in [diter.source_file, diter.target_file]:
+        table = tables.open_file(path, 'r', driver=driver)
+        nodes.append((table.get_node(diter.table_name),
+            table.get_node(diter.index_name)))
+    return nodes
+
+def iterate_bitext(diter, source, target, offset, start=0, stop=None):
+    """Yields the batches [next offset, source phrases, target phrases]
+    of `diter.batch_size` pairs of the rows [start, stop) of the bitext,
+    from the row `offset` on. Goes back to `start` at the end of the rows
+    if `diter.use_infinite_loop`"""
+    source_data, source_index = source
+    target_data, target_index = target
+    if stop is None:
+        stop = source_index.shape[0]
+    if not start <= offset <= stop:
+        raise ValueError("Offset {} out of the rows [{}, {}]".format(offset, start, stop))
+
+    # The rows of the current block of the indices which are not too
+    # long, from `cursor` on, see read_index_block
+    block_end = offset
+    cursor = 0
+    while True:
+        last_batch = False
+        source_sents = []
+        target_sents = []
+        while len(source_sents) < diter.batch_size:
+            if offset == block_end:
+                if offset == stop:
+                    if diter.use_infinite_loop:
+                        offset = start
+                    else:
+                        last_batch = True
+                        break
+                block_end = min(offset + diter.index_block_size, stop)
+                rows, spos, slen, tpos, tlen = read_index_block(
+                        source_index, target_index, offset, block_end, diter.max_len)
+                cursor = 0
+
+            taken = slice(cursor, cursor + diter.batch_size - len(source_sents))
+            cursor = min(taken.stop, len(rows))
+            if taken.stop <= len(rows):
+                # the batch is full, the next one starts after its last row
+                offset = int(rows[taken.stop - 1]) + 1
+            else:
+                offset = block_end
+            source_sents += read_phrases(source_data, spos[taken], slen[taken], diter.dtype)
+            target_sents += read_phrases(target_data, tpos[taken], tlen[taken], diter.dtype)
+
+        if len(source_sents):
+            yield [int(offset), source_sents, target_sents]
+        if last_batch:
+            return
+
+class LengthBuckets(object):
+    """Groups the pairs of phrases of similar lengths of a bitext, whose
+    lengths are `source_lens` and `target_lens`. A pair goes to the
+    bucket (source length // width, target length // width), pairs longer
+    than `max_len` are left out.
+
+    The batches of an epoch are cut in the shuffled buckets and then
+    shuffled together, so that each bucket gives a share of the batches
+    equal to its share of the pairs"""
+
+    def __init__(self, source_lens, target_lens, batch_size, width, max_len):
+        self.source_lens = np.asarray(source_lens, dtype='int64')
+        self.target_lens = np.asarray(target_lens, dtype='int64')
+        self.batch_size = batch_size
+        self.kept = ((self.source_lens <= max_len) & (self.target_lens <= max_len)).nonzero()[0]
+        keys = ((self.source_lens[self.kept] // width) * (max_len // width + 1)
+                + self.target_lens[self.kept] // width)
+        order = np.argsort(keys, kind='mergesort')
+        bounds = (np.diff(keys[order]) != 0).nonzero()[0] + 1
+        self.buckets = np.split(self.kept[order], bounds) if len(keys) else []
+        self.n_batches = sum((len(bucket) + batch_size - 1) // batch_size
+                for bucket in self.buckets)
+
+    def epoch(self, rng):
+        """The batches of an epoch shuffled with `rng`, as arrays of rows"""
+        batches = []
+        for bucket in self.buckets:
+            rows = rng.permutation(bucket)
+            batches += [rows[k:k + self.batch_size]
+                    for k in range(0, len(rows), self.batch_size)]
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def sequential(self):
+        """The batches of consecutive rows, as the rows are stored"""
+        return [self.kept[k:k + self.batch_size]
+                for k in range(0, len(self.kept), self.batch_size)]
+
+    def padding_efficiency(self, batches):
+        """The fractions of the source and target matrices of `batches`
+        that their masks cover, padded as create_padded_batch of
+        experiments.nmt.encdec does with trim_batches"""
+        efficiency = []
+        for lens in [self.source_lens, self.target_lens]:
+            words = padded = 0
+            for rows in batches:
+                # the mask also covers the end of sequence
+                masked = lens[rows] + 1
+                words += masked.sum()
+                padded += len(rows) * masked.max()
+            efficiency.append(float(words) / padded if padded else 0.)
+        return efficiency
+
+def iterate_buckets(diter, source, target, offset, start=0, stop=None):
+    """Yields the batches [next offset, source phrases, target phrases]
+    of the rows [start, stop) of the bitext drawn from LengthBuckets of
+    width `diter.bucket_width`. The batches of the epoch e are shuffled
+    with the seed `diter.seed + e`, and the offsets count the batches
+    drawn since the first epoch, so that they can be drawn again"""
+    source_data, source_index = source
+    target_data, target_index = target
+    if stop is None:
+        stop = source_index.shape[0]
+    if offset < 0:
+        raise ValueError("Negative number of batches drawn {}".format(offset))
+
+    source_rows = source_index.read(start, stop)
+    target_rows = target_index.read(start, stop)
+    buckets = LengthBuckets(source_rows['length'], target_rows['length'],
+            diter.batch_size, diter.bucket_width, diter.max_len)
+    if not buckets.n_batches:
+        return
+    epoch, position = divmod(offset, buckets.n_batches)
+    batches = buckets.epoch(np.random.RandomState(diter.seed + epoch))
+    logger.info("{} batches from {} buckets, padding efficiency of the "
+            "source {:.1%} and of the target {:.1%}, {:.1%} and {:.1%} "
+            "in the order of the rows".format(
+                buckets.n_batches, len(buckets.buckets),
+                *(buckets.padding_efficiency(batches)
+                    + buckets.padding_efficiency(buckets.sequential()))))
+
+    while True:
+        for rows in batches[position:]:
+            offset += 1
+            yield [offset,
+                    read_phrases(source_data, source_rows['pos'][rows].astype('int64'),
+                        source_rows['length'][rows].astype('int64'), diter.dtype),
+                    read_phrases(target_data, target_rows['pos'][rows].astype('int64'),
+                        target_rows['length'][rows].astype('int64'), diter.dtype)]
+        if not diter.use_infinite_loop:
+            return
+        epoch += 1
+        position = 0
+        batches = buckets.epoch(np.random.RandomState(diter.seed + epoch))
+
 class PytablesBitextFetcher(threading.Thread):
     def __init__(self, parent, start_offset):
         threading.Thread.__init__(self)
@@ -179,55 +363,24 @@ class PytablesBitextFetcher(threading.Thread):
     def run(self):
         diter = self.parent
 
-        driver = None
-        if diter.can_fit:
-            driver = "H5FD_CORE"
-
-        target_table = tables.open_file(diter.target_file, 'r', driver=driver)
-        target_data, target_index = (target_table.get_node(diter.table_name),
-            target_table.get_node(diter.index_name))
-
-        source_table = tables.open_file(diter.source_file, 'r', driver=driver)
-        source_data, source_index = (source_table.get_node(diter.table_name),
-            source_table.get_node(diter.index_name))
-
-        assert source_index.shape[0] == target_index.shape[0]
+        source, target = open_bitext(diter)
+        assert source[1].shape[0] == target[1].shape[0]
         # self.data_len = source_index.shape[0]
 
         offset = self.start_offset
         if offset == -1:
             offset = 0
-            if diter.shuffle:
+            if diter.shuffle and not diter.bucket_width:
                 offset = np.random.randint(self.data_len)
         logger.debug("{} entries".format(self.data_len))
         logger.debug("Starting from the entry {}".format(offset))
 
-        while not diter.exit_flag:
-            last_batch = False
-            source_sents = []
-            target_sents = []
-            while len(source_sents) < diter.batch_size:
-                if offset == self.data_len:
-                    if diter.use_infinite_loop:
-                        offset = 0
-                    else:
-                        last_batch = True
-                        break
-
-                slen, spos = source_index[offset]['length'], source_index[offset]['pos']
-                tlen, tpos = target_index[offset]['length'], target_index[offset]['pos']
-                offset += 1
-
-                if slen > diter.max_len or tlen > diter.max_len:
-                    continue
-                source_sents.append(source_data[spos:spos + slen].astype(diter.dtype))
-                target_sents.append(target_data[tpos:tpos + tlen].astype(diter.dtype))
-
-            if len(source_sents):
-                diter.queue.put([int(offset), source_sents, target_sents])
-            if last_batch:
-                diter.queue.put([None])
+        iterate = iterate_buckets if diter.bucket_width else iterate_bitext
+        for batch in iterate(diter, source, target, offset):
+            if diter.exit_flag:
                 return
+            diter.queue.put(batch)
+        diter.queue.put([None])
 
 class PytablesBitextIterator(object):
 
@@ -243,7 +396,10 @@ class PytablesBitextIterator(object):
                  cache_size=1000,
                  shuffle=True,
                  use_infinite_loop=True,
-                 max_len=1000):
+                 max_len=1000,
+                 index_block_size=65536,
+                 bucket_width=0,
+                 seed=1234):
 
         args = locals()
         args.pop("self")
@@ -260,10 +416,23 @@ class PytablesBitextIterator(object):
         # for halving the learning rate
         self.data_len = self.gather.data_len
 
+    def close(self):
+        """Stops the fetcher thread"""
+        if not hasattr(self, 'gather'):
+            return
+        self.exit_flag = True
+        while self.gather.is_alive():
+            # the fetcher may wait for room in the queue
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.gather.join(0.1)
+        del self.gather
+
     def __del__(self):
-        if hasattr(self, 'gather'):
-            self.gather.exitFlag = True
-            self.gather.join()
+        self.close()
 
     def __iter__(self):
         return self
@@ -275,6 +444,296 @@ class PytablesBitextIterator(object):
         self.next_offset = batch[0]
         return batch[1], batch[2]
 
+class BatchRing(object):
+    """A ring of `size` slots of shared memory, each holding the arrays
+    x, x_mask, y and y_mask of a padded batch of at most `batch_size`
+    columns and `max_rows` rows"""
+
+    def __init__(self, size, batch_size, max_rows, dtype):
+        # the integer arrays first, to keep them aligned
+        self.fields = [('x', np.dtype(dtype)), ('y', np.dtype(dtype)),
+                ('x_mask', np.dtype('float32')), ('y_mask', np.dtype('float32'))]
+        self.size = size
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.capacity = batch_size * max_rows
+        self.slot_bytes = sum(self.capacity * dtype.itemsize for _, dtype in self.fields)
+        self.shm = shared_memory.SharedMemory(create=True, size=size * self.slot_bytes)
+
+    def arrays(self, slot, x_rows, y_rows, cols):
+        """The arrays of `slot` with the given shapes, by name. They are
+        contiguous views of the shared memory"""
+        offset = slot * self.slot_bytes
+        arrays = {}
+        for name, dtype in self.fields:
+            rows = x_rows if name.startswith('x') else y_rows
+            arrays[name] = np.ndarray((rows, cols), dtype=dtype,
+                    buffer=self.shm.buf, offset=offset)
+            offset += self.capacity * dtype.itemsize
+        return arrays
+
+    def write(self, slot, batch):
+        """Copies the arrays of `batch` into `slot`, returns their shapes"""
+        x_rows, cols = batch['x'].shape
+        y_rows = batch['y'].shape[0]
+        if cols > self.batch_size or max(x_rows, y_rows) > self.max_rows:
+            raise ValueError("A batch of {}x{} and {}x{} words does not fit in {}x{}".format(
+                x_rows, cols, y_rows, cols, self.max_rows, self.batch_size))
+        for name, array in self.arrays(slot, x_rows, y_rows, cols).items():
+            array[...] = batch[name]
+        return x_rows, y_rows, cols
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # some batches are still in use, the memory is freed with them
+            logger.debug("Batches of the ring are still referenced")
+        self.shm.unlink()
+
+def _take_slot(free_slots, exit_event):
+    """A free slot of the ring, None when asked to stop"""
+    while not exit_event.is_set():
+        try:
+            return free_slots.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _bitext_worker(loader, worker, start, stop, offset, free_slots, exit_event):
+    """Reads the rows [start, stop) of the bitext from `offset` on and
+    writes the padded batches into the free slots of the ring, then
+    sends (worker, slot, (next offset, x rows, y rows, columns)) to the
+    loader. (worker, None, None) ends the data of the worker,
+    (worker, -1, traceback) reports an error"""
+    full_slots = loader.full_slots
+    try:
+        source, target = open_bitext(loader)
+        iterate = iterate_buckets if loader.bucket_width else iterate_bitext
+        batches = iterate(loader, source, target, offset, start, stop)
+        while not exit_event.is_set():
+            # Sorts sort_k_batches batches by length to pad less, as the
+            # iterator of experiments.nmt.encdec does
+            group = list(itertools.islice(batches, loader.sort_k_batches))
+            if not group:
+                full_slots.put((worker, None, None))
+                return
+            next_offset = group[-1][0]
+            x = list(itertools.chain(*[batch[1] for batch in group]))
+            y = list(itertools.chain(*[batch[2] for batch in group]))
+            order = np.arange(len(x))
+            if len(group) > 1:
+                order = np.argsort([max(len(xx), len(yy)) for xx, yy in zip(x, y)],
+                        kind='mergesort')
+            for k in range(0, len(x), loader.batch_size):
+                indices = order[k:k + loader.batch_size]
+                batch = loader.output_format([[x[i] for i in indices]],
+                        [[y[i] for i in indices]])
+                if not batch:
+                    continue
+                slot = _take_slot(free_slots, exit_event)
+                if slot is None:
+                    return
+                shapes = loader.ring.write(slot, batch)
+                full_slots.put((worker, slot, (next_offset,) + shapes))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        full_slots.put((worker, -1, traceback.format_exc()))
+
+class PytablesBitextLoader(object):
+    """Reads the bitext in `n_workers` processes, each owning a shard of
+    consecutive rows. They pad the batches with `output_format`, called
+    as output_format([source phrases], [target phrases]) and returning a
+    dict of x, x_mask, y and y_mask or None, and write them into a ring of
+    `ring_size` slots of shared memory.
+
+    The batches are views of the ring, valid until the next one is
+    taken. They come in the order the processes have them ready, or in
+    turn from each process if `deterministic`. `next_offset` has the
+    next row of each shard, or the number of batches drawn from it with
+    `bucket_width`, see iterate_buckets, and start() takes it back"""
+
+    def __init__(self,
+                 batch_size,
+                 target_file=None,
+                 source_file=None,
+                 dtype="int64",
+                 table_name='/phrases',
+                 index_name='/indices',
+                 can_fit=False,
+                 output_format=None,
+                 sort_k_batches=1,
+                 n_workers=2,
+                 ring_size=16,
+                 shuffle=True,
+                 use_infinite_loop=True,
+                 max_len=1000,
+                 index_block_size=65536,
+                 bucket_width=0,
+                 deterministic=False,
+                 seed=1234):
+
+        assert output_format is not None, "The loader pads the batches"
+        args = locals()
+        args.pop("self")
+        self.__dict__.update(args)
+
+        self.processes = []
+        self.ring = None
+
+    def shard_offsets(self, bounds, start_offset):
+        """The first row read from each shard, the shards being
+        [bounds[i], bounds[i + 1])"""
+        starts, stops = bounds[:-1], bounds[1:]
+        offsets = np.asarray(start_offset, dtype='int64').ravel()
+        if len(offsets) == 1 and offsets[0] == -1:
+            # no saved offset
+            pass
+        elif len(offsets) == 1 and not self.bucket_width:
+            # an offset in the whole bitext, the shards before it are done
+            return np.clip(offsets[0], starts, stops)
+        elif len(offsets) == len(starts):
+            return offsets
+        else:
+            logger.warning("{} offsets for {} shards, starting over".format(
+                len(offsets), len(starts)))
+        if self.bucket_width:
+            # the offsets count the batches drawn, see iterate_buckets
+            return np.zeros(len(starts), dtype='int64')
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed)
+            return np.array([rng.randint(lo, hi) for lo, hi in zip(starts, stops)])
+        return starts.copy()
+
+    def start(self, start_offset):
+        table = tables.open_file(self.source_file, 'r')
+        self.data_len = table.get_node(self.index_name).shape[0]
+        table.close()
+
+        self.n_workers = max(1, min(self.n_workers, self.data_len))
+        bounds = np.arange(self.n_workers + 1) * self.data_len // self.n_workers
+        self.next_offset = self.shard_offsets(bounds, start_offset)
+        logger.debug("{} entries in {} shards".format(self.data_len, self.n_workers))
+        logger.debug("Starting from the entries {}".format(self.next_offset))
+
+        # every process has its own slots, so that the others cannot
+        # take them all while it is its turn
+        slots_per_worker = max(2, self.ring_size // self.n_workers)
+        self.ring = BatchRing(slots_per_worker * self.n_workers,
+                self.batch_size, self.max_len + 1, self.dtype)
+        context = multiprocessing.get_context('fork')
+        self.exit_event = context.Event()
+        self.full_slots = context.Queue()
+        self.free_slots = []
+        for worker in range(self.n_workers):
+            free_slots = context.Queue()
+            for slot in range(worker * slots_per_worker, (worker + 1) * slots_per_worker):
+                free_slots.put(slot)
+            self.free_slots.append(free_slots)
+
+        self.pending = [collections.deque() for worker in range(self.n_workers)]
+        self.finished = set()
+        self.turn = 0
+        self.current = None
+        self.peeked = None
+        for worker in range(self.n_workers):
+            process = context.Process(target=_bitext_worker,
+                    args=(self, worker, bounds[worker], bounds[worker + 1],
+                        self.next_offset[worker], self.free_slots[worker],
+                        self.exit_event))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def _receive(self):
+        """The next message of the processes"""
+        while True:
+            try:
+                return self.full_slots.get(timeout=1.)
+            except queue.Empty:
+                for worker, process in enumerate(self.processes):
+                    if process.exitcode:
+                        raise RuntimeError("Loader process {} exited with code {}".format(
+                            worker, process.exitcode))
+
+    def _take(self):
+        """The next (worker, slot, shapes) batch, None when all the
+        processes are done"""
+        while True:
+            if self.deterministic:
+                while self.turn in self.finished and len(self.finished) < self.n_workers:
+                    self.turn = (self.turn + 1) % self.n_workers
+            if len(self.finished) == self.n_workers:
+                return None
+            if self.deterministic and self.pending[self.turn]:
+                worker, slot, payload = self.pending[self.turn].popleft()
+                if slot is None:
+                    self.finished.add(worker)
+                    continue
+                self.turn = (self.turn + 1) % self.n_workers
+                return worker, slot, payload
+
+            worker, slot, payload = self._receive()
+            if slot == -1:
+                raise RuntimeError("Loader process {} failed:\n{}".format(worker, payload))
+            if self.deterministic:
+                self.pending[worker].append((worker, slot, payload))
+            elif slot is None:
+                self.finished.add(worker)
+            else:
+                return worker, slot, payload
+
+    def close(self):
+        """Stops the processes and frees the ring"""
+        if not getattr(self, 'processes', None):
+            return
+        self.exit_event.set()
+        for process in self.processes:
+            process.join(5.)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.processes = []
+        for slots in self.free_slots + [self.full_slots]:
+            slots.cancel_join_thread()
+            slots.close()
+        self.current = self.peeked = None
+        self.ring.close()
+        self.ring = None
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self, peek=False):
+        """The next batch, None at the end of the data. A peeked batch is
+        returned again by the next call"""
+        if self.peeked:
+            # Only allow to peek one batch
+            assert not peek
+            taken = self.peeked
+            self.peeked = None
+        else:
+            taken = self._take()
+            if taken is None:
+                return None
+        worker, slot, payload = taken
+        if peek:
+            self.peeked = taken
+        else:
+            # the previous batch is not used anymore
+            if self.current:
+                self.free_slots[self.current[0]].put(self.current[1])
+            self.current = (worker, slot)
+            self.next_offset[worker] = payload[0]
+        return self.ring.arrays(slot, *payload[1:])
+
 class NNJMContextIterator(object):
 
     def __init__(self,
@@ -1,4 +1,5 @@
 from .LM_dataset import LMIterator
 from .TM_dataset import TMIterator
 from .TM_dataset import PytablesBitextIterator
+from .TM_dataset import PytablesBitextLoader
 
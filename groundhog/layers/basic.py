@@ -428,6 +428,26 @@ class Layer(Container):
         new_obj.get_grads(*o_args, **o_kwargs)
         return new_obj
 
+    def evaluate(self, **kwargs):
+        """
+        Compute the cost of the current layer, like `train` but without
+        the gradients.
+        ! Only works for output layers
+        """
+        if not hasattr(self, 'get_cost'):
+            raise TypeError('Non-output layer does not support this method')
+        new_obj = utils.copy(self)
+        try:
+            o_args, o_kwargs = new_obj.prev_args
+        except:
+            o_args, o_kwargs = ([], {})
+        kwargs = dict([(k, new_obj.tensor_from_layer(v)) for k,v in list(kwargs.items())])
+        for (k,v) in list(kwargs.items()):
+            o_kwargs[k] = v
+        new_obj.prev_args = (o_args, o_kwargs)
+        new_obj.get_cost(*o_args, **o_kwargs)
+        return new_obj
+
     def get_sample(self, **kwargs):
         """
         Get a sample from the curren model.
@@ -498,17 +518,30 @@ class Model(Container):
                  sample_fn,
                  indx_word="/data/lisa/data/PennTreebankCorpus/dictionaries.npz",
                  indx_word_src=None,
-                 rng =None):
+                 rng =None,
+                 params=None):
+        """
+        If `params` is given the model is only used for inference: it
+        has these parameters to load and save, but no cost to train, and
+        `output_layer` does not need to have gradients defined.
+        """
         super(Model, self).__init__()
         if rng == None:
             rng = numpy.random.RandomState(123)
-        assert hasattr(output_layer,'grads'), \
+        assert hasattr(output_layer,'grads') or params is not None, \
                 'The model needs to have gradients defined'
         self.rng = rng
         self.trng = RandomStreams(rng.randint(1000)+1)
         self.sample_fn = sample_fn
         self.indx_word = indx_word
         self.indx_word_src = indx_word_src
+        self.output_layer = output_layer
+        self._get_samples = output_layer._get_samples
+        if params is not None:
+            self.params = params
+            self.train_cost = None
+            self.out = None
+            return
         self.param_grads = output_layer.grads
         self.params = output_layer.params
         self.updates = output_layer.updates
@@ -519,9 +552,7 @@ class Model(Container):
         self.train_cost = output_layer.cost
         self.out = output_layer.out
         self.schedules = output_layer.schedules
-        self.output_layer = output_layer
         self.properties = output_layer.properties
-        self._get_samples = output_layer._get_samples
 
     def get_schedules(self):
         return self.schedules
@@ -1022,7 +1022,8 @@ class SoftmaxLayer(CostLayer):
               additional_inputs=None,
               no_noise_bias=False,
               target=None,
-              full_softmax=True):
+              full_softmax=True,
+              columns=None):
         """
         Forward pass through the cost layer.
 
@@ -1041,6 +1042,10 @@ class SoftmaxLayer(CostLayer):
         :type no_noise_bias: bool
         :param no_noise_bias: flag, stating if weight noise should be added
             to the bias as well, or only to the weights
+
+        :type columns: None or int vector
+        :param columns: if given, only these output units are computed and
+            the softmax is normalized over them
         """
         if not full_softmax:
             assert target != None, 'target must be given'
@@ -1059,6 +1064,20 @@ class SoftmaxLayer(CostLayer):
             emb_val = state_below
 
         if full_softmax:
+            b_em = self.b_em
+            if self.weight_noise:
+                nb_em = self.nb_em
+            additional_weights = self.additional_weights
+            noise_additional_weights = self.noise_additional_weights
+            if columns is not None:
+                W_em = W_em[:, columns]
+                b_em = b_em[columns]
+                if self.weight_noise and use_noise and self.noise_params:
+                    nW_em = nW_em[:, columns]
+                    nb_em = nb_em[columns]
+                additional_weights = [w[:, columns] for w in additional_weights]
+                noise_additional_weights = [w[:, columns] for w in noise_additional_weights]
+
             if self.weight_noise and use_noise and self.noise_params:
                 emb_val = TT.dot(emb_val, W_em + nW_em)
             else:
@@ -1067,17 +1086,17 @@ class SoftmaxLayer(CostLayer):
             if additional_inputs:
                 if use_noise and self.noise_params:
                     for inp, weight, noise_weight in zip(
-                        additional_inputs, self.additional_weights,
-                        self.noise_additional_weights):
+                        additional_inputs, additional_weights,
+                        noise_additional_weights):
                         emb_val += utils.dot(inp, (noise_weight + weight))
                 else:
-                    for inp, weight in zip(additional_inputs, self.additional_weights):
+                    for inp, weight in zip(additional_inputs, additional_weights):
                         emb_val += utils.dot(inp, weight)
             if self.weight_noise and use_noise and self.noise_params and \
                not no_noise_bias:
-                emb_val = temp * (emb_val + self.b_em + self.nb_em)
+                emb_val = temp * (emb_val + b_em + nb_em)
             else:
-                emb_val = temp * (emb_val + self.b_em)
+                emb_val = temp * (emb_val + b_em)
         else:
             W_em = W_em[:, target]
             if self.weight_noise:
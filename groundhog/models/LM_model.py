@@ -40,7 +40,8 @@ class LM_Model(Model):
                   indx_word_src=None,
                   character_level = False,
                   exclude_params_for_norm=None,
-                  rng = None):
+                  rng = None,
+                  params = None):
         """
         Constructs a model, that respects the interface required by the
         trainer class.
@@ -97,12 +98,17 @@ class LM_Model(Model):
         :type rng: numpy random generator
         :param rng: numpy random generator
 
+        :type params: None or list of theano shared variables
+        :param params: the parameters of an inference-only model, whose
+            cost layer has no gradients defined
+
         """
         super(LM_Model, self).__init__(output_layer=cost_layer,
                                        sample_fn=sample_fn,
                                        indx_word=indx_word,
                                        indx_word_src=indx_word_src,
-                                       rng=rng)
+                                       rng=rng,
+                                       params=params)
         if exclude_params_for_norm is None:
             self.exclude_params_for_norm = []
         else:
@@ -117,6 +123,11 @@ class LM_Model(Model):
         self.character_level = character_level
 
         self.valid_costs = ['cost','ppl']
+        if self.train_cost is None:
+            # Inference only, there is nothing to train
+            self.add_noise = None
+            self.del_noise = None
+            return
         # Assume a single cost
         # We need to merge these lists
         state_below = self.cost_layer.state_below
@@ -20,6 +20,7 @@ from theano.scan_module import scan
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from groundhog.utils import print_time, print_mem, const
+from groundhog.utils.function_cache import compile_function
 
 
 class SGD(object):
@@ -112,8 +113,8 @@ class SGD(object):
         updates = store_gs + [(s[0], r) for s,r in zip(model.updates, rules)]
         print('Compiling grad function')
         st = time.time()
-        self.train_fn = theano.function(
-            [], outs, name='train_function',
+        self.train_fn = compile_function(
+            state.get('compile_cache'), [], outs, name='train_function',
             updates = updates,
             givens = list(zip(model.inputs, loc_data)),
             profile=self.state['profile'])
@@ -122,8 +123,8 @@ class SGD(object):
 
         self.lr = numpy.float32(state['lr'])
         new_params = [p - s*lr*g for s, p, g in zip(model.params_grad_scale, model.params, self.gs)]
-        self.update_fn = theano.function(
-            [lr], [], name='update_function',
+        self.update_fn = compile_function(
+            state.get('compile_cache'), [lr], [], name='update_function',
             allow_input_downcast=True,
             updates = list(zip(model.params, new_params)),
             profile=self.state['profile'])
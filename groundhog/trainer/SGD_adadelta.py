@@ -21,6 +21,7 @@ from theano.scan_module import scan
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from groundhog.utils import print_time, print_mem, const
+from groundhog.utils.function_cache import compile_function
 
 logger = logging.getLogger(__name__)
 
@@ -128,8 +129,8 @@ class SGD(object):
 
         logger.debug('Compiling grad function')
         st = time.time()
-        self.train_fn = theano.function(
-            [], outs, name='train_function',
+        self.train_fn = compile_function(
+            state.get('compile_cache'), [], outs, name='train_function',
             updates = updates,
             givens = list(zip(model.inputs, loc_data)))
         logger.debug('took {}'.format(time.time() - st))
@@ -146,8 +147,8 @@ class SGD(object):
             for dn2, gn2, g in zip(self.dnorm2, self.gnorm2, self.gs)]
         updates = updates + d2_up
 
-        self.update_fn = theano.function(
-            [], [], name='update_function',
+        self.update_fn = compile_function(
+            state.get('compile_cache'), [], [], name='update_function',
             allow_input_downcast=True,
             updates = updates)
 
@@ -0,0 +1,108 @@
+"""
+Persistent cache of compiled Theano functions.
+
+Compiling the decoder and trainer functions takes minutes, mostly in
+the graph optimizations. `compile_function` pickles each function it
+compiles in a cache directory, keyed by a hash of the graph structure,
+and the next time the same graph is asked for it unpickles the function
+without optimizing it again. The function is pickled with empty
+placeholders of its shared variables, so that the cache does not hold a
+copy of the parameters, and they are swapped for the ones of the caller
+when it is loaded, so that it works on the current parameters.
+"""
+__docformat__ = 'restructedtext en'
+
+import hashlib
+import io
+import logging
+import os
+import pickle
+import time
+
+import numpy
+import theano
+from theano.compile import SharedVariable
+from theano.gof import graph
+
+logger = logging.getLogger(__name__)
+
+def _shared_variables(outputs, updates, givens):
+    """The shared variables of a graph, in a deterministic order"""
+    variables = list(outputs)
+    variables += [value for _, value in updates]
+    variables += [var for var, _ in updates]
+    variables += [value for _, value in givens]
+    shared = []
+    for var in graph.inputs(variables):
+        if isinstance(var, SharedVariable) and var not in shared:
+            shared.append(var)
+    return shared
+
+def _placeholder(var):
+    """A shared variable of the type of `var` holding an empty array, None
+    if `var` is not a tensor"""
+    broadcastable = getattr(var.type, 'broadcastable', None)
+    if broadcastable is None:
+        return None
+    value = numpy.zeros([1 if b else 0 for b in broadcastable], dtype=var.type.dtype)
+    return var.__class__(name=var.name, type=var.type, value=value, strict=False)
+
+def _graph_key(name, inputs, outputs, updates, givens, shared, kwargs):
+    text = io.StringIO()
+    theano.printing.debugprint(list(outputs) + [value for _, value in updates] +
+            [value for _, value in givens], file=text)
+    # the options of theano.function change the compiled function too
+    options = [(key, value if isinstance(value, (str, bool, int, float, type(None)))
+                else str(value))
+            for key, value in sorted(kwargs.items())]
+    digest = hashlib.sha1()
+    digest.update(repr((name, theano.__version__, theano.config.floatX,
+        theano.config.device, theano.config.mode, options, [var.type for var in inputs],
+        [(var.name, var.type, var.get_value(borrow=True).shape) for var in shared])).encode('utf-8'))
+    digest.update(text.getvalue().encode('utf-8'))
+    return digest.hexdigest()
+
+def compile_function(cache_dir, inputs, outputs, name, updates=None, givens=None, **kwargs):
+    """Same as theano.function, but if `cache_dir` is not None the function
+    is loaded from the cache or stored in it after compiling"""
+    if cache_dir is None:
+        return theano.function(inputs, outputs, name=name, updates=updates,
+                givens=givens, **kwargs)
+
+    single = not isinstance(outputs, (list, tuple))
+    outputs_list = [outputs] if single else list(outputs)
+    updates = list(updates.items()) if isinstance(updates, dict) else list(updates or [])
+    givens = list(givens.items()) if isinstance(givens, dict) else list(givens or [])
+    shared = _shared_variables(outputs_list, updates, givens)
+    key = _graph_key(name, inputs, outputs_list, updates, givens, shared, kwargs)
+    path = os.path.join(cache_dir, "{}.{}.pkl".format(name, key))
+
+    if os.path.exists(path):
+        st = time.time()
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(path, 'rb') as src:
+                cached_shared, fn = pickle.load(src)
+            fn = fn.copy(swap=dict(zip(cached_shared, shared)))
+            logger.debug("Loaded {} from the function cache, took {}".format(
+                name, time.time() - st))
+            return fn
+        except Exception:
+            logger.exception("Could not load {} from {}, compiling it".format(name, path))
+        finally:
+            theano.config.reoptimize_unpickled_function = reoptimize
+
+    fn = theano.function(inputs, outputs, name=name, updates=updates,
+            givens=givens, **kwargs)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # the placeholders are pickled with the function to find them back
+    placeholders = [_placeholder(var) or var for var in shared]
+    cached_fn = fn.copy(swap=dict((var, placeholder)
+        for var, placeholder in zip(shared, placeholders) if placeholder is not var))
+    tmp_path = "{}.{}".format(path, os.getpid())
+    with open(tmp_path, 'wb') as dst:
+        pickle.dump((placeholders, cached_fn), dst, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    return fn
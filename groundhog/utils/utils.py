@@ -19,6 +19,11 @@ import theano
 import theano.tensor as TT
 from functools import reduce
 
+try:
+    from theano.tensor.sort import argtopk as _argtopk
+except ImportError:
+    _argtopk = None
+
 def print_time(secs):
     if secs < 120.:
         return '%6.3f sec' % secs
@@ -84,6 +89,26 @@ def softmax(x):
         e = TT.exp(x)
         return e/ TT.sum(e)
 
+def log_softmax(x):
+    """
+    Log of the softmax of each row of the matrix `x`, computed without
+    overflow by subtracting the row maximum first
+    """
+    x = x - TT.max(x, axis=1, keepdims=True)
+    return x - TT.log(TT.sum(TT.exp(x), axis=1, keepdims=True))
+
+def top_k(x, k):
+    """
+    Returns the values and the column indices of the `k` largest
+    elements of each row of the matrix `x`, in no particular order
+    """
+    if _argtopk is not None:
+        indices = _argtopk(x, k, axis=1, sorted=False)
+    else:
+        # older Theano has no partial sort
+        indices = TT.argsort(-x, axis=1)[:, :k]
+    return x[TT.arange(x.shape[0])[:, None], indices], indices
+
 def sample_zeros(sizeX, sizeY, sparsity, scale, rng):
     return numpy.zeros((sizeX, sizeY), dtype=theano.config.floatX)
 
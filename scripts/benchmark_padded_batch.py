@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of experiments.nmt.create_padded_batch against its former
+implementation with Python loops over the sentences, on random batches
+of the shape the training iterator gives it:
+
+    python benchmark_padded_batch.py --batch-size 80 --seqlen 50
+
+Both are checked to give the same matrices first.
+"""
+
+import argparse
+import timeit
+
+import numpy
+
+from experiments.nmt import create_padded_batch
+
+def create_padded_batch_loops(state, x, y, return_dict=False):
+    """The implementation of create_padded_batch with Python loops over
+    the sentences, as a reference"""
+
+    mx = state['seqlen']
+    my = state['seqlen']
+    if state['trim_batches']:
+        # Similar length for all source sequences
+        mx = numpy.minimum(state['seqlen'], max([len(xx) for xx in x[0]]))+1
+        # Similar length for all target sequences
+        my = numpy.minimum(state['seqlen'], max([len(xx) for xx in y[0]]))+1
+
+    # Batch size
+    n = x[0].shape[0]
+
+    X = numpy.zeros((mx, n), dtype='int64')
+    Y = numpy.zeros((my, n), dtype='int64')
+    Xmask = numpy.zeros((mx, n), dtype='float32')
+    Ymask = numpy.zeros((my, n), dtype='float32')
+
+    # Fill X and Xmask
+    for idx in range(len(x[0])):
+        # Insert sequence idx in a column of matrix X
+        if mx < len(x[0][idx]):
+            X[:mx, idx] = x[0][idx][:mx]
+        else:
+            X[:len(x[0][idx]), idx] = x[0][idx][:mx]
+
+        # Mark the end of phrase
+        if len(x[0][idx]) < mx:
+            X[len(x[0][idx]):, idx] = state['null_sym_source']
+
+        # Initialize Xmask column with ones in all positions that
+        # were just set in X
+        Xmask[:len(x[0][idx]), idx] = 1.
+        if len(x[0][idx]) < mx:
+            Xmask[len(x[0][idx]), idx] = 1.
+
+    # Fill Y and Ymask in the same way as X and Xmask in the previous loop
+    for idx in range(len(y[0])):
+        Y[:len(y[0][idx]), idx] = y[0][idx][:my]
+        if len(y[0][idx]) < my:
+            Y[len(y[0][idx]):, idx] = state['null_sym_target']
+        Ymask[:len(y[0][idx]), idx] = 1.
+        if len(y[0][idx]) < my:
+            Ymask[len(y[0][idx]), idx] = 1.
+
+    null_inputs = numpy.zeros(X.shape[1])
+
+    # We say that an input pair is valid if both:
+    # - either source sequence or target sequence is non-empty
+    # - source sequence and target sequence have null_sym ending
+    # Why did not we filter them earlier?
+    for idx in range(X.shape[1]):
+        if numpy.sum(Xmask[:,idx]) == 0 and numpy.sum(Ymask[:,idx]) == 0:
+            null_inputs[idx] = 1
+        if Xmask[-1,idx] and X[-1,idx] != state['null_sym_source']:
+            null_inputs[idx] = 1
+        if Ymask[-1,idx] and Y[-1,idx] != state['null_sym_target']:
+            null_inputs[idx] = 1
+
+    valid_inputs = 1. - null_inputs
+
+    # Leave only valid inputs
+    X = X[:,valid_inputs.nonzero()[0]]
+    Y = Y[:,valid_inputs.nonzero()[0]]
+    Xmask = Xmask[:,valid_inputs.nonzero()[0]]
+    Ymask = Ymask[:,valid_inputs.nonzero()[0]]
+    if len(valid_inputs.nonzero()[0]) <= 0:
+        return None
+
+    # Unknown words
+    X[X >= state['n_sym_source']] = state['unk_sym_source']
+    Y[Y >= state['n_sym_target']] = state['unk_sym_target']
+
+    if return_dict:
+        return {'x' : X, 'x_mask' : Xmask, 'y': Y, 'y_mask' : Ymask}
+    else:
+        return X, Xmask, Y, Ymask
+
+def random_batch(rng, batch_size, seqlen, n_sym, null_sym):
+    """A batch of sentences ending with the null symbol, a few of them
+    longer than `seqlen`, like the ones of PytablesBitextFetcher"""
+    def sentences():
+        seqs = numpy.empty(batch_size, dtype='object')
+        for i in range(batch_size):
+            seq = rng.randint(1, n_sym + 10, size=rng.randint(1, seqlen + 5))
+            seq[-1] = null_sym
+            seqs[i] = seq
+        return seqs
+    return [sentences()], [sentences()]
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Time create_padded_batch against the loop implementation")
+    parser.add_argument("--batch-size",
+            type=int, default=80, help="Number of sentence pairs of a batch")
+    parser.add_argument("--seqlen",
+            type=int, default=50, help="Maximum sentence length")
+    parser.add_argument("--trim-batches",
+            type=int, default=1, help="The trim_batches option of the state")
+    parser.add_argument("--batches",
+            type=int, default=100, help="Number of different batches")
+    parser.add_argument("--repeat",
+            type=int, default=5, help="Number of timings, the best one is kept")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    state = dict(seqlen=args.seqlen, trim_batches=args.trim_batches,
+            null_sym_source=0, null_sym_target=0,
+            n_sym_source=30000, n_sym_target=30000,
+            unk_sym_source=1, unk_sym_target=1)
+    rng = numpy.random.RandomState(1234)
+    batches = [random_batch(rng, args.batch_size, args.seqlen, 30000, 0)
+            for _ in range(args.batches)]
+
+    for x, y in batches:
+        expected = create_padded_batch_loops(state, x, y)
+        actual = create_padded_batch(state, x, y)
+        assert (expected is None) == (actual is None)
+        if expected is not None:
+            for a, b in zip(expected, actual):
+                assert a.dtype == b.dtype and numpy.array_equal(a, b)
+
+    for name, fn in [("loops", create_padded_batch_loops),
+            ("vectorized", create_padded_batch)]:
+        elapsed = min(timeit.repeat(lambda: [fn(state, x, y) for x, y in batches],
+            number=1, repeat=args.repeat))
+        print("{:10s} {:8.1f} us per batch".format(name, 1e6 * elapsed / len(batches)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Padding efficiency of the training batches of a bitext, the fraction of
+the padded source and target matrices covered by their masks, for the
+ways the training iterator can make them:
+
+    python padding_report.py --source train.en.h5 --target train.fr.h5 \\
+        --batch-size 80 --seqlen 50 --sort-k-batches 10 --bucket-width 2 5
+
+- sequential: batches of consecutive rows of the tables
+- sorted: sort_k_batches consecutive batches sorted by length and cut
+  again, as with state['sort_k_batches']
+- buckets: batches drawn from length buckets of the whole bitext, as
+  with state['bucket_width'], for each of the given widths
+"""
+
+import argparse
+
+import numpy
+import tables
+
+from groundhog.datasets.TM_dataset import LengthBuckets
+
+def sorted_batches(buckets, k_batches):
+    """The batches of the rows of `buckets` in the order they are stored,
+    `k_batches` at a time sorted by the longest phrase of each pair"""
+    size = k_batches * buckets.batch_size
+    batches = []
+    for start in range(0, len(buckets.kept), size):
+        rows = buckets.kept[start:start + size]
+        lens = numpy.maximum(buckets.source_lens[rows], buckets.target_lens[rows])
+        rows = rows[numpy.argsort(lens)]
+        batches += [rows[k:k + buckets.batch_size]
+                for k in range(0, len(rows), buckets.batch_size)]
+    return batches
+
+def read_lengths(path, index_name):
+    table = tables.open_file(path, 'r')
+    lens = table.get_node(index_name).read(field='length')
+    table.close()
+    return lens
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            "Report the padding efficiency of the training batches")
+    parser.add_argument("--source",
+            required=True, help="HDF5 file of the source phrases")
+    parser.add_argument("--target",
+            required=True, help="HDF5 file of the target phrases")
+    parser.add_argument("--index-name",
+            default='/indices', help="Node of the index in the files")
+    parser.add_argument("--batch-size",
+            type=int, default=80, help="Number of pairs in a batch")
+    parser.add_argument("--seqlen",
+            type=int, default=50, help="Maximum phrase length")
+    parser.add_argument("--sort-k-batches",
+            type=int, default=10, help="Number of batches sorted together")
+    parser.add_argument("--bucket-width",
+            type=int, nargs="+", default=[2, 5],
+            help="Widths of the length buckets")
+    parser.add_argument("--seed",
+            type=int, default=1234, help="Seed of the shuffling")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    source_lens = read_lengths(args.source, args.index_name)
+    target_lens = read_lengths(args.target, args.index_name)
+    assert len(source_lens) == len(target_lens)
+
+    rows = []
+    buckets = LengthBuckets(source_lens, target_lens, args.batch_size,
+            args.seqlen + 1, args.seqlen)
+    print("{} pairs, {} not longer than {} words".format(
+        len(source_lens), len(buckets.kept), args.seqlen))
+    rows.append(("sequential", buckets.sequential()))
+    rows.append(("sorted k={}".format(args.sort_k_batches),
+        sorted_batches(buckets, args.sort_k_batches)))
+    for width in args.bucket_width:
+        buckets = LengthBuckets(source_lens, target_lens, args.batch_size,
+                width, args.seqlen)
+        rows.append(("buckets w={} ({})".format(width, len(buckets.buckets)),
+            buckets.epoch(numpy.random.RandomState(args.seed))))
+
+    print("{:24s} {:>8s} {:>8s} {:>8s}".format("", "batches", "source", "target"))
+    for name, batches in rows:
+        source, target = buckets.padding_efficiency(batches)
+        print("{:24s} {:8d} {:8.1%} {:8.1%}".format(name, len(batches), source, target))
+
+if __name__ == "__main__":
+    main()